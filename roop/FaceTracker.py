@@ -0,0 +1,201 @@
+import cv2
+import numpy as np
+
+from roop.typing import Frame, Face
+from roop.face_util import get_all_faces, detect_faces, analyse_face
+
+# max. distance in pixels between a point tracked forward and back again
+MAX_FORWARD_BACKWARD_ERROR = 1.5
+# min. part of a face's points which must be tracked reliably
+MIN_GOOD_POINTS_RATIO = 0.6
+# mean absolute difference of two thumbnails above which the scene is treated as cut
+SCENE_CUT_THRESHOLD = 30.0
+SCENE_THUMBNAIL_SIZE = (64, 36)
+
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+# min. overlap of a detected face with a face of the last frame to continue its track
+MIN_TRACK_IOU = 0.3
+# frames after which a track runs through recognition again
+REVERIFY_INTERVAL = 100
+# analysis models whose results stay the same for a track
+IDENTITY_TASKS = ['recognition', 'genderage']
+IDENTITY_ATTRIBUTES = ['embedding', 'gender', 'age', 'target_distances']
+
+
+class FaceTracker():
+    """ Follows the faces of consecutive video frames so the full face analysis only needs
+        to run every 'detect_interval' frames. In between, the kps and landmarks are moved
+        along with sparse optical flow and the bbox follows their motion. After a scene cut,
+        a skipped frame or when a face can't be followed reliably, detection runs again.
+
+        With track_identities, every face gets a track_id. A detected face overlapping a
+        face of the last frame continues its track and reuses its embedding, genderage and
+        target matches, so only new tracks and periodic re-verifications run recognition.
+    """
+
+    def __init__(self, detect_interval: int, track_identities: bool = False):
+        self.detect_interval = max(1, detect_interval)
+        self.track_identities = track_identities
+        self.next_track_id = 0
+        self.reset()
+
+
+    def reset(self):
+        self.last_frame_index = None
+        self.last_gray = None
+        self.last_thumbnail = None
+        self.faces = []
+        self.frames_since_detection = 0
+        self.verified_at = {}
+
+
+    def get_faces(self, frame: Frame, frame_index: int) -> list:
+        """ Returns the faces of frame, either freshly detected or tracked from the last frame """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, SCENE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+        continuous = self.is_continuous(frame_index, thumbnail)
+        faces = None
+        if continuous and len(self.faces) > 0 and self.frames_since_detection + 1 < self.detect_interval:
+            faces = self.track_faces(gray)
+        if faces is None:
+            faces = self.detect(frame, frame_index, continuous)
+            self.frames_since_detection = 0
+        else:
+            self.frames_since_detection += 1
+
+        self.last_frame_index = frame_index
+        self.last_gray = gray
+        self.last_thumbnail = thumbnail
+        self.faces = faces
+        return list(faces)
+
+
+    def is_continuous(self, frame_index: int, thumbnail) -> bool:
+        """ False if frame doesn't directly follow the last one or the scene was cut """
+        if self.last_frame_index is None or frame_index != self.last_frame_index + 1:
+            return False
+        diff = cv2.absdiff(thumbnail, self.last_thumbnail)
+        return float(np.mean(diff)) < SCENE_CUT_THRESHOLD
+
+
+    def detect(self, frame: Frame, frame_index: int, continuous: bool) -> list:
+        if not self.track_identities:
+            faces = get_all_faces(frame)
+            return faces if faces is not None else []
+
+        faces = detect_faces(frame)
+        if faces is None:
+            return []
+        tracks = match_faces(self.faces if continuous else [], faces)
+        verified_at = {}
+        for i, face in enumerate(faces):
+            track = tracks.get(i)
+            if track is not None and frame_index - self.verified_at[track.track_id] < REVERIFY_INTERVAL:
+                for name in IDENTITY_ATTRIBUTES:
+                    if track.get(name) is not None:
+                        face[name] = track[name]
+                face.track_id = track.track_id
+                analyse_face(frame, face, IDENTITY_TASKS)
+                verified_at[face.track_id] = self.verified_at[face.track_id]
+            else:
+                if track is not None:
+                    face.track_id = track.track_id
+                else:
+                    face.track_id = self.next_track_id
+                    self.next_track_id += 1
+                analyse_face(frame, face)
+                verified_at[face.track_id] = frame_index
+        self.verified_at = verified_at
+        return faces
+
+
+    def track_faces(self, gray):
+        points = []
+        for face in self.faces:
+            points.append(get_tracking_points(face))
+        num_points = [len(p) for p in points]
+        prev_points = np.concatenate(points).reshape(-1, 1, 2).astype(np.float32)
+
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self.last_gray, gray, prev_points, None, **LK_PARAMS)
+        if next_points is None:
+            return None
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.last_gray, next_points, None, **LK_PARAMS)
+        if back_points is None:
+            return None
+        fb_error = np.linalg.norm((back_points - prev_points).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error < MAX_FORWARD_BACKWARD_ERROR)
+
+        tracked_faces = []
+        start = 0
+        for face, count in zip(self.faces, num_points):
+            end = start + count
+            face_good = good[start:end]
+            if np.count_nonzero(face_good) < max(3, count * MIN_GOOD_POINTS_RATIO):
+                return None
+            M, _ = cv2.estimateAffinePartial2D(prev_points[start:end][face_good], next_points[start:end][face_good], method=cv2.RANSAC)
+            if M is None:
+                return None
+            tracked_faces.append(transform_face(face, M))
+            start = end
+        return tracked_faces
+
+
+
+def bbox_iou(a, b) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return float(intersection / union)
+
+
+def match_faces(tracked_faces: list, detected_faces: list) -> dict:
+    """ Greedily pairs detected faces with the tracked face they overlap most,
+        returns a dict detected face index -> tracked face
+    """
+    pairs = []
+    for i, face in enumerate(detected_faces):
+        for j, tracked in enumerate(tracked_faces):
+            iou = bbox_iou(face.bbox, tracked.bbox)
+            if iou >= MIN_TRACK_IOU:
+                pairs.append((iou, i, j))
+    pairs.sort(reverse=True)
+    matches = {}
+    used = set()
+    for _, i, j in pairs:
+        if i in matches or j in used:
+            continue
+        matches[i] = tracked_faces[j]
+        used.add(j)
+    return matches
+
+
+def get_tracking_points(face: Face):
+    points = [face.kps]
+    if face.get('landmark_2d_106') is not None:
+        points.append(face.landmark_2d_106)
+    return np.concatenate(points)
+
+
+def transform_points(points, M):
+    return cv2.transform(points.reshape(-1, 1, 2).astype(np.float32), M).reshape(-1, 2)
+
+
+def transform_face(face: Face, M) -> Face:
+    """ Returns a copy of face moved by the 2x3 similarity transform M, identity attributes are kept """
+    tracked = Face(face)
+    x1, y1, x2, y2 = face.bbox
+    corners = transform_points(np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]]), M)
+    tracked.bbox = np.array([corners[:, 0].min(), corners[:, 1].min(), corners[:, 0].max(), corners[:, 1].max()], dtype=face.bbox.dtype)
+    tracked.kps = transform_points(face.kps, M).astype(face.kps.dtype)
+    if face.get('landmark_2d_106') is not None:
+        tracked.landmark_2d_106 = transform_points(face.landmark_2d_106, M).astype(face.landmark_2d_106.dtype)
+    if face.get('landmark_3d_68') is not None:
+        landmarks = face.landmark_3d_68.copy()
+        landmarks[:, :2] = transform_points(face.landmark_3d_68[:, :2], M)
+        tracked.landmark_3d_68 = landmarks
+    return tracked
@@ -0,0 +1,361 @@
+import copyreg
+import multiprocessing
+import queue
+import time
+import traceback
+import cv2
+import numpy as np
+
+from collections import deque
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from threading import Thread
+
+import roop.globals
+from insightface.app.common import Face
+from roop.FrameReorderBuffer import FrameReorderBuffer
+from roop.StageTimer import StageTimer
+import roop.trace_util as trace_util
+
+# frames a worker may hold at once, the second one hides the round trip to the dispatcher
+TASKS_PER_WORKER = 2
+# a frame that crashed this many workers is passed through unprocessed
+MAX_FRAME_RETRIES = 2
+# globals which are only meaningful in the main process
+EXCLUDED_GLOBALS = ['g_current_face_analysis', 'processing']
+
+# Face returns None for every missing attribute, pickle would take that for __setstate__
+copyreg.pickle(Face, lambda face: (Face, (dict(face),)))
+
+
+class SharedFrameRing():
+    """ Fixed number of equally sized frame slots in shared memory, so frames
+        are exchanged between processes without pickling them.
+    """
+
+    def __init__(self, num_slots: int, frame_shape, name: str = None):
+        self.num_slots = num_slots
+        self.frame_shape = tuple(frame_shape)
+        slot_size = int(np.prod(self.frame_shape))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=num_slots * slot_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.frames = np.ndarray((num_slots,) + self.frame_shape, dtype=np.uint8, buffer=self.shm.buf)
+
+
+    def close(self, unlink: bool = False):
+        self.frames = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+
+def get_globals_snapshot() -> dict:
+    snapshot = { 'CFG': roop.globals.CFG }
+    for name, value in vars(roop.globals).items():
+        if name.startswith('_') or name.isupper() or name in EXCLUDED_GLOBALS:
+            continue
+        if value is None or isinstance(value, (bool, int, float, str, list, tuple, dict)):
+            snapshot[name] = value
+    return snapshot
+
+
+
+def worker_main(worker_id, globals_snapshot, input_faces, target_faces, options, input_ring_args, output_ring_args, conn):
+    """ Entry point of a worker process: loads all processors once, then swaps frames
+        from the input ring into the output ring until it receives None.
+    """
+    from roop.ProcessMgr import ProcessMgr
+
+    for name, value in globals_snapshot.items():
+        setattr(roop.globals, name, value)
+    roop.globals.processing = True
+
+    input_ring = SharedFrameRing(*input_ring_args)
+    output_ring = SharedFrameRing(*output_ring_args)
+    process_mgr = ProcessMgr()
+    process_mgr.initialize(input_faces, target_faces, options)
+    # keep the order the main process already picked for 'all_random'
+    process_mgr.input_face_datas = input_faces
+    process_mgr.timer = StageTimer(roop.globals.CFG.timing_report)
+    conn.send(('ready', None, None))
+
+    while True:
+        start = time.perf_counter()
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        process_mgr.timer.add('queue_wait', start)
+        if task is None:
+            if process_mgr.timer.enabled or roop.globals.tracing:
+                conn.send(('stats', None, (process_mgr.timer.samples, trace_util.get_trace())))
+            break
+        frame_index, slot = task
+        start = time.perf_counter()
+        try:
+            frame = input_ring.frames[slot]
+            if process_mgr.options.frame_processing:
+                resimg = process_mgr.run_frame_processors(frame)
+            else:
+                resimg = process_mgr.process_frame(frame)
+            if resimg is not None:
+                if resimg.shape != output_ring.frame_shape:
+                    resimg = cv2.resize(resimg, (output_ring.frame_shape[1], output_ring.frame_shape[0]))
+                output_ring.frames[slot] = resimg
+        except Exception:
+            # reported instead of dying, a restarted worker would only fail on the same frame again
+            conn.send(('error', frame_index, traceback.format_exc()))
+            continue
+        trace_util.add_span('frame', start, args={ 'frame': frame_index })
+        conn.send(('done', frame_index, resimg is not None))
+
+    process_mgr.release_resources()
+    input_ring.close()
+    output_ring.close()
+
+
+
+class FrameProcessPool():
+    """ Runs the frame processing of a video in worker processes instead of threads.
+
+        The reader thread copies decoded frames into free slots of a shared memory ring,
+        the main thread hands slot indices to the workers as soon as they ask for work and
+        the writer thread writes the finished slots in frame order. Every worker talks to
+        the main thread through its own pipe, so a crashed worker can't take a shared
+        queue down with it. It is replaced and the frames it was working on are queued again.
+        An exception while processing a frame aborts the job, like it does with threads.
+    """
+
+    def __init__(self, process_mgr, num_workers: int):
+        self.process_mgr = process_mgr
+        self.num_workers = max(1, num_workers)
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}
+        self.connections = {}
+        self.in_flight = {}
+        self.ready = set()
+        self.next_worker_id = 0
+        self.stopped = False
+
+
+    def start_worker(self):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        conn, worker_conn = self.context.Pipe()
+        worker = self.context.Process(target=worker_main, name=f'swap_proc_{worker_id}', daemon=True,
+                                      args=(worker_id, self.globals_snapshot, self.process_mgr.input_face_datas,
+                                            self.process_mgr.target_face_datas, self.process_mgr.options,
+                                            (self.input_ring.num_slots, self.input_ring.frame_shape, self.input_ring.name),
+                                            (self.output_ring.num_slots, self.output_ring.frame_shape, self.output_ring.name),
+                                            worker_conn))
+        worker.start()
+        worker_conn.close()
+        self.workers[worker_id] = worker
+        self.connections[worker_id] = conn
+        self.in_flight[worker_id] = {}
+
+
+    def read_frames_thread(self, cap, frame_start, frame_end, conn):
+        num_frame = 0
+        total_num = frame_end - frame_start
+
+        timer = self.process_mgr.timer
+        while roop.globals.processing and not self.stopped:
+            start = time.perf_counter()
+            try:
+                slot = self.free_slots.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            timer.add('reader_wait', start)
+            start = time.perf_counter()
+            if hasattr(cap, 'read_into'):
+                # decode straight into shared memory
+                ret = cap.read_into(self.input_ring.frames[slot])
+            else:
+                ret, frame = cap.read()
+                if ret:
+                    self.input_ring.frames[slot] = frame
+            if not ret:
+                self.free_slots.put(slot)
+                break
+            timer.add('decode', start)
+            self.process_mgr.sampler.count('decoded')
+            conn.send(('frame', num_frame, slot))
+            num_frame += 1
+            if num_frame == total_num:
+                break
+        conn.send(('eof', num_frame, None))
+
+
+    def write_frames_thread(self, write_frame):
+        while True:
+            start = time.perf_counter()
+            item = self.reorder_buffer.get()
+            self.process_mgr.timer.add('writer_wait', start)
+            if item is None:
+                return
+            _, (slot, has_frame) = item
+            if has_frame:
+                write_frame(self.output_ring.frames[slot])
+            self.free_slots.put(slot)
+
+
+    def dispatch(self, worker_id):
+        while len(self.in_flight[worker_id]) < TASKS_PER_WORKER and len(self.pending) > 0:
+            frame_index, slot = self.pending.popleft()
+            self.in_flight[worker_id][frame_index] = slot
+            try:
+                self.connections[worker_id].send((frame_index, slot))
+            except OSError:
+                # worker just died, the frame gets requeued when it is replaced
+                return
+
+
+    def replace_worker(self, worker_id):
+        worker = self.workers.pop(worker_id)
+        worker.join()
+        self.connections.pop(worker_id).close()
+        if worker_id not in self.ready:
+            raise RuntimeError(f'Worker process {worker.name} failed to start (exit code {worker.exitcode})')
+        print(f'Worker process {worker.name} died with exit code {worker.exitcode}, restarting it')
+        lost_frames = self.in_flight.pop(worker_id)
+        for frame_index, slot in sorted(lost_frames.items(), reverse=True):
+            self.retries[frame_index] = self.retries.get(frame_index, 0) + 1
+            if self.retries[frame_index] > MAX_FRAME_RETRIES:
+                print(f'Frame {frame_index} keeps crashing workers, using it unprocessed')
+                self.output_ring.frames[slot] = cv2.resize(self.input_ring.frames[slot], (self.output_ring.frame_shape[1], self.output_ring.frame_shape[0]))
+                self.frame_done(frame_index, slot, True)
+            else:
+                self.pending.appendleft((frame_index, slot))
+        self.start_worker()
+
+
+    def frame_done(self, frame_index, slot, has_frame):
+        self.reorder_buffer.put(frame_index, (slot, has_frame))
+        self.num_done += 1
+        self.progress()
+
+
+    def handle_worker_message(self, worker_id):
+        try:
+            message, frame_index, value = self.connections[worker_id].recv()
+        except (EOFError, OSError):
+            # the process is gone, its sentinel takes care of it
+            return False
+        if message == 'ready':
+            self.ready.add(worker_id)
+        elif message == 'done':
+            slot = self.in_flight[worker_id].pop(frame_index)
+            self.frame_done(frame_index, slot, value)
+        elif message == 'error':
+            raise RuntimeError(f'Processing frame {frame_index} failed in {self.workers[worker_id].name}:\n{value}')
+        return True
+
+
+    def collect_stats(self, worker_id):
+        """ Merges the stage timings and trace spans a stopping worker sends as its last message """
+        conn = self.connections[worker_id]
+        try:
+            while conn.poll(10):
+                message, _, value = conn.recv()
+                if message == 'stats':
+                    samples, trace = value
+                    self.process_mgr.timer.merge(samples, f'{self.workers[worker_id].name}/')
+                    trace_util.merge_trace(trace)
+                    return
+        except (EOFError, OSError):
+            pass
+
+
+    def run(self, cap, frame_start, frame_end, input_shape, output_shape, write_frame, progress):
+        num_slots = self.num_workers * TASKS_PER_WORKER * 2
+        self.input_ring = SharedFrameRing(num_slots, input_shape)
+        self.output_ring = SharedFrameRing(num_slots, output_shape)
+        # a frame can't get further ahead than the number of slots, so putting never blocks
+        self.reorder_buffer = FrameReorderBuffer(num_slots)
+        self.free_slots = queue.Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+        self.globals_snapshot = get_globals_snapshot()
+        self.pending = deque()
+        self.retries = {}
+        self.progress = progress
+        self.num_done = 0
+        sampler = self.process_mgr.sampler
+        sampler.add_queue('pending', self.pending.__len__)
+        sampler.add_queue('in_flight', lambda: sum(len(frames) for frames in list(self.in_flight.values())))
+        sampler.add_queue('reorder', self.reorder_buffer.__len__)
+        num_frames = None
+        reader_conn, reader_send_conn = self.context.Pipe(duplex=False)
+        readthread = None
+        writethread = None
+        completed = False
+
+        try:
+            for _ in range(self.num_workers):
+                self.start_worker()
+
+            readthread = Thread(target=self.read_frames_thread, name='reader', args=(cap, frame_start, frame_end, reader_send_conn))
+            readthread.start()
+            writethread = Thread(target=self.write_frames_thread, name='writer', args=(write_frame,))
+            writethread.start()
+
+            while num_frames is None or self.num_done < num_frames:
+                sentinels = { worker.sentinel: worker_id for worker_id, worker in self.workers.items() }
+                conns = { conn: worker_id for worker_id, conn in self.connections.items() }
+                waitables = [reader_conn] if num_frames is None else []
+                for ready in wait(waitables + list(conns.keys()) + list(sentinels.keys())):
+                    if ready is reader_conn:
+                        message, frame_index, slot = reader_conn.recv()
+                        if message == 'frame':
+                            self.pending.append((frame_index, slot))
+                        else:
+                            num_frames = frame_index
+                    elif ready in conns:
+                        self.handle_worker_message(conns[ready])
+
+                # only look at dead workers after all of their results have been read
+                for sentinel, worker_id in sentinels.items():
+                    if not self.workers[worker_id].is_alive():
+                        while self.connections[worker_id].poll() and self.handle_worker_message(worker_id):
+                            pass
+                        self.replace_worker(worker_id)
+
+                for worker_id in self.workers:
+                    self.dispatch(worker_id)
+            completed = True
+        finally:
+            self.stopped = True
+            for conn in self.connections.values():
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+            if self.process_mgr.timer.enabled or roop.globals.tracing:
+                for worker_id in self.workers:
+                    self.collect_stats(worker_id)
+            for worker in self.workers.values():
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+            if readthread is not None:
+                readthread.join()
+            if completed:
+                self.reorder_buffer.finish(num_frames)
+            else:
+                # frames are missing, the writer would wait for them forever
+                self.reorder_buffer.abort()
+            if writethread is not None:
+                writethread.join()
+            for conn in self.connections.values():
+                conn.close()
+            self.workers.clear()
+            self.connections.clear()
+            reader_conn.close()
+            reader_send_conn.close()
+            self.input_ring.close(unlink=True)
+            self.output_ring.close(unlink=True)
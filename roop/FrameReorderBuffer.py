@@ -0,0 +1,64 @@
+from threading import Condition
+
+
+class FrameReorderBuffer():
+    """ Collects processed frames coming in from several workers in any order and hands
+        them out strictly by frame index. A worker whose frame is 'depth' or more frames ahead
+        of the next one to be written waits, which bounds the memory used for buffered frames.
+    """
+
+    def __init__(self, depth: int):
+        self.depth = max(1, depth)
+        self.next_index = 0
+        self.end_index = None
+        self.frames = {}
+        self.aborted = False
+        self.condition = Condition()
+
+
+    def put(self, frame_index: int, frame):
+        """ Adds the result for frame_index, frame may be None for a skipped frame """
+        with self.condition:
+            while frame_index >= self.next_index + self.depth and not self.aborted:
+                self.condition.wait()
+            if self.aborted:
+                return
+            self.frames[frame_index] = frame
+            self.condition.notify_all()
+
+
+    def finish(self, num_frames: int):
+        """ Tells the buffer how many frames there will be in total """
+        with self.condition:
+            self.end_index = num_frames
+            self.condition.notify_all()
+
+
+    def abort(self):
+        """ Gives up after a worker failed: get returns None right away and put doesn't wait anymore """
+        with self.condition:
+            self.aborted = True
+            self.frames.clear()
+            self.condition.notify_all()
+
+
+    def get(self):
+        """ Blocks until the next frame in order is available and returns (frame_index, frame).
+            Returns None after the last frame or once aborted.
+        """
+        with self.condition:
+            while self.next_index not in self.frames:
+                if self.aborted:
+                    return None
+                if self.end_index is not None and self.next_index >= self.end_index:
+                    return None
+                self.condition.wait()
+            frame_index = self.next_index
+            frame = self.frames.pop(frame_index)
+            self.next_index += 1
+            self.condition.notify_all()
+            return frame_index, frame
+
+
+    def __len__(self):
+        return len(self.frames)
@@ -1,26 +1,41 @@
 import os
+import time
 import cv2 
 import numpy as np
-import psutil
+
+from scipy.optimize import linear_sum_assignment
 
 from roop.ProcessOptions import ProcessOptions
 
-from roop.face_util import get_first_face, get_all_faces, rotate_anticlockwise, rotate_clockwise, clamp_cut_values
-from roop.utilities import compute_cosine_distance, get_device, str_to_class, shuffle_array
+from roop.face_util import get_first_face, get_all_faces, get_all_faces_batch, rotate_anticlockwise, rotate_clockwise, clamp_cut_values
+from roop.utilities import get_device, str_to_class, shuffle_array
 import roop.vr_util as vr
+from roop.mask_util import blur_area, get_face_matte, get_mouth_mask
 
 from typing import Any, List, Callable
 from roop.typing import Frame, Face
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Thread, Lock
-from queue import Queue
-from tqdm import tqdm
+from queue import Queue, Empty, Full
 from roop.ffmpeg_writer import FFMPEG_VideoWriter
+from roop.ffmpeg_reader import FFMPEG_VideoReader
 from roop.StreamWriter import StreamWriter
+from roop.FrameReorderBuffer import FrameReorderBuffer
+from roop.FrameProcessPool import FrameProcessPool
+from roop.FaceTracker import FaceTracker
+from roop.StageTimer import StageTimer
+from roop.ProgressSampler import ProgressSampler
+import roop.trace_util as trace_util
 import roop.globals
 
 
 
+# min. number of consecutive frames a worker gets when tracking face identities
+MIN_TRACKING_RUN = 8
+# seconds the reader and workers wait on the frame queue before checking if the job was aborted
+QUEUE_POLL_TIME = 0.5
+
+
 # Poor man's enum to be able to compare to int
 class eNoFaceAction():
     USE_ORIGINAL_FRAME = 0
@@ -31,6 +46,20 @@ class eNoFaceAction():
 
 
 
+class FaceJob():
+    """ Everything needed to swap a single face, collected before the batched swap and pasted afterwards """
+
+    def __init__(self, face_index, inputface: Face, target_face: Face):
+        self.face_index = face_index
+        self.inputface = inputface
+        self.target_face = target_face
+        self.aligned_img = None
+        self.fake_frame = None
+        self.rotation_action = None
+        self.cut_region = None
+
+
+
 def create_queue(temp_frame_paths: List[str]) -> Queue[str]:
     queue: Queue[str] = Queue()
     for frame_path in temp_frame_paths:
@@ -64,18 +93,25 @@ class ProcessMgr():
     lock = Lock()
 
     frames_queue = None
-    processed_queue = None
+    reorder_buffer = None
 
     videowriter= None
     streamwriter = None
 
     total_frames = 0
+    face_detection_interval = 1
 
     num_frames_no_face = 0
     last_swapped_frame = None
 
     output_to_file = None
     output_to_cam = None
+    # replaced by an enabled one for jobs which write a timing report
+    timer = StageTimer(False)
+    # counts frames and feeds the progress bar while a job runs
+    sampler = ProgressSampler()
+    # called with every progress sample, see ProgressSampler.sample
+    status_callback = None
 
 
     plugins =  { 
@@ -107,15 +143,17 @@ class ProcessMgr():
     def initialize(self, input_faces, target_faces, options):
         self.input_face_datas = input_faces
         self.target_face_datas = target_faces
+        self.target_embeddings = None
+        if len(target_faces) > 0:
+            self.target_embeddings = np.stack([tf.embedding for tf in target_faces]).astype(np.float32)
+            self.target_embeddings /= np.linalg.norm(self.target_embeddings, axis=1, keepdims=True)
         self.num_frames_no_face = 0
         self.last_swapped_frame = None
         self.options = options
         devicename = get_device()
 
-        roop.globals.g_desired_face_analysis=["landmark_3d_68", "landmark_2d_106","detection","recognition"]
-        if options.swap_mode == "all_female" or options.swap_mode == "all_male":
-            roop.globals.g_desired_face_analysis.append("genderage")
-        elif options.swap_mode == "all_random":
+        roop.globals.g_desired_face_analysis = self.get_required_face_analysis()
+        if options.swap_mode == "all_random":
             # don't modify original list
             self.input_face_datas = input_faces.copy()
             shuffle_array(self.input_face_datas)
@@ -149,6 +187,9 @@ class ProcessMgr():
             else:
                 print(f"Not using {module}")
         self.processors = newprocessors
+        for p in self.processors:
+            if p.type == 'swap':
+                p.PrepareLatents(self.input_face_datas)
 
 
 
@@ -174,17 +215,33 @@ class ProcessMgr():
 
 
 
+    def get_required_face_analysis(self) -> list:
+        """ Face analysis modules whose results are read with the current options, the others aren't run at all """
+        modules = ["detection"]
+        if self.options.swap_mode == "selected":
+            modules.append("recognition")
+        elif self.options.swap_mode == "all_female" or self.options.swap_mode == "all_male":
+            modules.append("genderage")
+        # mouth restore, autorotate and DMDNet work with the 106 landmarks, the tracker follows them too
+        if (self.options.restore_original_mouth or roop.globals.autorotate_faces or "dmdnet" in self.options.processors
+                or roop.globals.CFG.face_detection_interval > 1):
+            modules.append("landmark_2d_106")
+        return modules
+
+
+
     def run_batch(self, source_files, target_files, threads:int = 1):
-        progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
         self.total_frames = len(source_files)
         self.num_threads = threads
-        with tqdm(total=self.total_frames, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        self.timer = StageTimer(roop.globals.CFG.timing_report)
+        self.sampler = self.create_sampler('frame')
+        with self.sampler:
             with ThreadPoolExecutor(max_workers=threads) as executor:
                 futures = []
                 queue = create_queue(source_files)
                 queue_per_future = max(len(source_files) // threads, 1)
                 while not queue.empty():
-                    future = executor.submit(self.process_frames, source_files, target_files, pick_queue(queue, queue_per_future), lambda: self.update_progress(progress))
+                    future = executor.submit(self.process_frames, source_files, target_files, pick_queue(queue, queue_per_future), self.update_progress)
                     futures.append(future)
                 for future in as_completed(futures):
                     future.result()
@@ -195,85 +252,164 @@ class ProcessMgr():
             if not roop.globals.processing:
                 return
             
+            frame_start_time = time.perf_counter()
             # Decode the byte array into an OpenCV image
+            start = time.perf_counter()
             temp_frame = cv2.imdecode(np.fromfile(f, dtype=np.uint8), cv2.IMREAD_COLOR)
+            self.timer.add('decode', start)
             if temp_frame is not None:
                 if self.options.frame_processing:
+                    start = time.perf_counter()
                     for p in self.processors:
                         frame = p.Run(temp_frame)
                     resimg = frame
+                    self.timer.add('frame_processing', start)
                 else:
                     resimg = self.process_frame(temp_frame)
                 if resimg is not None:
                     i = source_files.index(f)
                     # Also let numpy write the file to support utf-8/16 filenames
+                    start = time.perf_counter()
                     cv2.imencode(f'.{roop.globals.CFG.output_image_format}',resimg)[1].tofile(target_files[i])
+                    self.timer.add('encode', start)
+            trace_util.add_span('frame', frame_start_time, args={ 'file': os.path.basename(f) })
             if update:
                 update()
 
 
 
-    def read_frames_thread(self, cap, frame_start, frame_end, num_threads):
+    def read_frames_thread(self, cap, frame_start, frame_end, num_threads, frames_per_item):
         num_frame = 0
         total_num = frame_end - frame_start
-        if frame_start > 0:
-            cap.set(cv2.CAP_PROP_POS_FRAMES,frame_start)
 
+        # runs of consecutive frames go to the same worker, so its face tracker can follow them
+        frames = []
         while True and roop.globals.processing:
+            start = time.perf_counter()
             ret, frame = cap.read()
             if not ret:
                 break
+            self.timer.add('decode', start)
+            self.sampler.count('decoded')
                 
-            self.frames_queue[num_frame % num_threads].put(frame, block=True)
+            frames.append((num_frame, frame))
             num_frame += 1
+            if len(frames) == frames_per_item:
+                start = time.perf_counter()
+                queued = self.put_frames(frames)
+                self.timer.add('reader_wait', start)
+                if not queued:
+                    return
+                frames = []
             if num_frame == total_num:
                 break
 
-        for i in range(num_threads):
-            self.frames_queue[i].put(None)
+        if len(frames) > 0 and not self.put_frames(frames):
+            return
+        self.reorder_buffer.finish(num_frame)
+        for _ in range(num_threads):
+            if not self.put_frames(None):
+                return
 
 
+    def put_frames(self, item) -> bool:
+        """ Queues an item for the workers, gives up and returns False once the job was aborted """
+        while True:
+            try:
+                self.frames_queue.put(item, timeout=QUEUE_POLL_TIME)
+                return True
+            except Full:
+                if self.reorder_buffer.aborted:
+                    return False
 
-    def process_videoframes(self, threadindex, progress) -> None:
+
+    def get_frames(self):
+        """ Next item of the queue, None at the end or once the job was aborted """
         while True:
-            frame = self.frames_queue[threadindex].get()
-            if frame is None:
-                self.processing_threads -= 1
-                self.processed_queue[threadindex].put((False, None))
-                return
-            else:
-                if self.options.frame_processing:
-                    for p in self.processors:
-                        frame = p.Run(frame)
-                    resimg = frame
-                else:                            
-                    resimg = self.process_frame(frame)
-                self.processed_queue[threadindex].put((True, resimg))
-                del frame
-                progress()
+            try:
+                return self.frames_queue.get(timeout=QUEUE_POLL_TIME)
+            except Empty:
+                if self.reorder_buffer.aborted:
+                    return None
+
+
+
+    def process_videoframes(self, threadindex, progress) -> None:
+        # every worker pulls the next frames as soon as it is free,
+        # the reorder buffer puts them back into order for the writer
+        tracker = None
+        if self.face_detection_interval > 1 or roop.globals.CFG.track_face_identities:
+            tracker = FaceTracker(self.face_detection_interval, roop.globals.CFG.track_face_identities)
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.get_frames()
+                self.timer.add('queue_wait', start)
+                if item is None or self.reorder_buffer.aborted:
+                    return
+                done = 0
+                try:
+                    faces_per_frame = [None] * len(item)
+                    if tracker is None and len(item) > 1 and not self.options.frame_processing:
+                        # micro-batch, all faces of these frames are analysed together
+                        start = time.perf_counter()
+                        faces_per_frame = get_all_faces_batch([frame for _, frame in item])
+                        self.timer.add('detection', start)
+                    for (frame_index, frame), faces in zip(item, faces_per_frame):
+                        start = time.perf_counter()
+                        if self.options.frame_processing:
+                            resimg = self.run_frame_processors(frame)
+                        else:
+                            resimg = self.process_frame(frame, tracker, frame_index, faces)
+                        self.reorder_buffer.put(frame_index, resimg)
+                        done += 1
+                        trace_util.add_span('frame', start, args={ 'frame': frame_index })
+                        del frame
+                        progress()
+                except BaseException:
+                    # hand in the frames of this item nobody will process, then stop the reader,
+                    # the writer and the other workers instead of leaving them waiting forever
+                    for frame_index, _ in item[done:]:
+                        self.reorder_buffer.put(frame_index, None)
+                    self.reorder_buffer.abort()
+                    raise
+        finally:
+            self.processing_threads -= 1
 
 
     def write_frames_thread(self):
-        nextindex = 0
-        num_producers = self.num_threads
-        
         while True:
-            process, frame = self.processed_queue[nextindex % self.num_threads].get()
-            nextindex += 1
+            start = time.perf_counter()
+            item = self.reorder_buffer.get()
+            self.timer.add('writer_wait', start)
+            if item is None:
+                return
+            _, frame = item
             if frame is not None:
-                if self.output_to_file:
-                    self.videowriter.write_frame(frame)
-                if self.output_to_cam:
-                    self.streamwriter.WriteToStream(frame)
+                self.write_frame(frame)
                 del frame
-            elif process == False:
-                num_producers -= 1
-                if num_producers < 1:
-                    return
-            
 
 
-    def run_batch_inmem(self, output_method, source_video, target_video, frame_start, frame_end, fps, threads:int = 1):
+    def write_frame(self, frame:Frame):
+        start = time.perf_counter()
+        if self.output_to_file:
+            self.videowriter.write_frame(frame)
+        if self.output_to_cam:
+            self.streamwriter.WriteToStream(frame)
+        self.timer.add('encode', start)
+        self.sampler.count('written')
+
+
+    def run_frame_processors(self, frame:Frame):
+        start = time.perf_counter()
+        for p in self.processors:
+            frame = p.Run(frame)
+        self.timer.add('frame_processing', start)
+        return frame
+
+
+
+    def run_batch_inmem(self, output_method, source_video, target_video, frame_start, frame_end, fps, threads:int = 1, with_audio:bool = False):
         if len(self.processors) < 1:
             print("No processor defined!")
             return
@@ -283,6 +419,16 @@ class ProcessMgr():
         frame_count = (frame_end - frame_start) + 1
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        input_shape = (height, width, 3)
+        # timestamps in the source, the output fps might differ
+        source_fps = cap.get(cv2.CAP_PROP_FPS)
+        if source_fps <= 0:
+            source_fps = fps
+        if roop.globals.CFG.video_reader == 'ffmpeg':
+            cap.release()
+            cap = FFMPEG_VideoReader(source_video, (width, height), source_fps, frame_start, frame_end - frame_start)
+        elif frame_start > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES,frame_start)
 
         processed_resolution = None
         for p in self.processors:
@@ -296,70 +442,107 @@ class ProcessMgr():
 
         self.total_frames = frame_count
         self.num_threads = threads
-
-        self.processing_threads = self.num_threads
-        self.frames_queue = []
-        self.processed_queue = []
-        for _ in range(threads):
-            self.frames_queue.append(Queue(1))
-            self.processed_queue.append(Queue(1))
+        self.timer = StageTimer(roop.globals.CFG.timing_report)
 
         self.output_to_file = output_method != "Virtual Camera"
         self.output_to_cam = output_method == "Virtual Camera" or output_method == "Both"
 
         if self.output_to_file:
-            self.videowriter = FFMPEG_VideoWriter(target_video, (width, height), fps, codec=roop.globals.video_encoder, crf=roop.globals.video_quality, audiofile=None)
+            if with_audio:
+                # mux the audio of the processed range while encoding, saves a second pass over the output
+                self.videowriter = FFMPEG_VideoWriter(target_video, (width, height), fps, codec=roop.globals.video_encoder, crf=roop.globals.video_quality,
+                                                      audiofile=source_video, audio_start=frame_start / source_fps, audio_end=frame_end / source_fps)
+            else:
+                self.videowriter = FFMPEG_VideoWriter(target_video, (width, height), fps, codec=roop.globals.video_encoder, crf=roop.globals.video_quality, audiofile=None)
         if self.output_to_cam:
             self.streamwriter = StreamWriter((width, height), int(fps))
 
-        readthread = Thread(target=self.read_frames_thread, args=(cap, frame_start, frame_end, threads))
-        readthread.start()
-
-        writethread = Thread(target=self.write_frames_thread)
-        writethread.start()
-
-        progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
-        with tqdm(total=self.total_frames, desc='Processing', unit='frames', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-            with ThreadPoolExecutor(thread_name_prefix='swap_proc', max_workers=self.num_threads) as executor:
-                futures = []
-                
-                for threadindex in range(threads):
-                    future = executor.submit(self.process_videoframes, threadindex, lambda: self.update_progress(progress))
-                    futures.append(future)
-                
-                for future in as_completed(futures):
-                    future.result()
-        # wait for the task to complete
-        readthread.join()
-        writethread.join()
-        cap.release()
-        if self.output_to_file:
-            self.videowriter.close()
-        if self.output_to_cam:
-            self.streamwriter.Close()
-
-        self.frames_queue.clear()
-        self.processed_queue.clear()
-
-
-
-
-    def update_progress(self, progress: Any = None) -> None:
-        process = psutil.Process(os.getpid())
-        memory_usage = process.memory_info().rss / 1024 / 1024 / 1024
-        progress.set_postfix({
-            'memory_usage': '{:.2f}'.format(memory_usage).zfill(5) + 'GB',
-            'execution_threads': self.num_threads
-        })
-        progress.update(1)
+        try:
+            if roop.globals.CFG.worker_mode == 'processes':
+                self.run_videoframes_in_processes(cap, frame_start, frame_end, input_shape, (height, width, 3))
+            else:
+                self.run_videoframes_in_threads(cap, frame_start, frame_end)
+        finally:
+            cap.release()
+            if self.output_to_file:
+                self.videowriter.close()
+            if self.output_to_cam:
+                self.streamwriter.Close()
 
 
 
-    def process_frame(self, frame:Frame):
+    def run_videoframes_in_threads(self, cap, frame_start, frame_end):
+        self.processing_threads = self.num_threads
+        self.face_detection_interval = roop.globals.CFG.face_detection_interval
+        frames_per_item = 1
+        if not self.options.frame_processing:
+            if roop.globals.CFG.track_face_identities:
+                # every run starts new tracks, so make them long enough to pay off
+                frames_per_item = max(self.face_detection_interval, MIN_TRACKING_RUN)
+            elif self.face_detection_interval > 1:
+                frames_per_item = self.face_detection_interval
+            else:
+                frames_per_item = max(1, roop.globals.CFG.detection_batch_size)
+        self.frames_queue = Queue(max(self.num_threads, self.num_threads * 2 // frames_per_item))
+        reorder_depth = roop.globals.CFG.reorder_buffer_depth
+        if reorder_depth < 1:
+            reorder_depth = max(self.num_threads * 4, (self.num_threads + 1) * frames_per_item)
+        self.reorder_buffer = FrameReorderBuffer(reorder_depth)
+
+        self.sampler = self.create_sampler('frames')
+        # items of the queue can hold several frames
+        self.sampler.add_queue('queue', self.frames_queue.qsize)
+        self.sampler.add_queue('reorder', self.reorder_buffer.__len__)
+        with self.sampler:
+            readthread = Thread(target=self.read_frames_thread, name='reader', args=(cap, frame_start, frame_end, self.num_threads, frames_per_item))
+            readthread.start()
+
+            writethread = Thread(target=self.write_frames_thread, name='writer')
+            writethread.start()
+
+            try:
+                with ThreadPoolExecutor(thread_name_prefix='swap_proc', max_workers=self.num_threads) as executor:
+                    futures = []
+                    
+                    for threadindex in range(self.num_threads):
+                        future = executor.submit(self.process_videoframes, threadindex, self.update_progress)
+                        futures.append(future)
+                    
+                    for future in as_completed(futures):
+                        future.result()
+            finally:
+                # wait for the task to complete, after a failure they stop at the aborted buffer
+                readthread.join()
+                writethread.join()
+        self.frames_queue = None
+        self.reorder_buffer = None
+
+
+    def run_videoframes_in_processes(self, cap, frame_start, frame_end, input_shape, output_shape):
+        # every worker process loads its own copy of the models,
+        # frames are exchanged through shared memory instead of being pickled
+        pool = FrameProcessPool(self, self.num_threads)
+        self.sampler = self.create_sampler('frames')
+        with self.sampler:
+            pool.run(cap, frame_start, frame_end, input_shape, output_shape, self.write_frame, self.update_progress)
+
+
+    def create_sampler(self, unit: str) -> ProgressSampler:
+        callbacks = [self.status_callback] if self.status_callback is not None else []
+        return ProgressSampler(self.total_frames, unit, self.num_threads, callbacks)
+
+
+    def update_progress(self) -> None:
+        """ Called by the workers for every frame, the progress bar is updated by the sampler """
+        self.sampler.count('processed')
+
+
+
+    def process_frame(self, frame:Frame, tracker:FaceTracker = None, frame_index:int = None, faces:list = None):
         if len(self.input_face_datas) < 1 and not self.options.show_face_masking:
             return frame
         temp_frame = frame.copy()
-        num_swapped, temp_frame = self.swap_faces(frame, temp_frame)
+        num_swapped, temp_frame = self.swap_faces(frame, temp_frame, tracker, frame_index, faces)
         if num_swapped > 0:
             if roop.globals.no_face_action == eNoFaceAction.SKIP_FRAME_IF_DISSIMILAR:
                 if len(self.input_face_datas) > num_swapped:
@@ -403,61 +586,75 @@ class ProcessMgr():
         
 
 
-    def swap_faces(self, frame, temp_frame):
+    def swap_faces(self, frame, temp_frame, tracker:FaceTracker = None, frame_index:int = None, faces:list = None):
         num_faces_found = 0
+        swap_jobs = []
 
         if self.options.swap_mode == "first":
-            face = get_first_face(frame)
+            start = time.perf_counter()
+            if faces is None and tracker is not None:
+                faces = tracker.get_faces(frame, frame_index)
+            if faces is not None:
+                face = min(faces, key=lambda x: x.bbox[0]) if len(faces) > 0 else None
+            else:
+                face = get_first_face(frame)
+            self.timer.add('detection', start)
 
             if face is None:
                 return num_faces_found, frame
             
             num_faces_found += 1
-            temp_frame = self.process_face(self.options.selected_index, face, temp_frame)
-            del face
+            swap_jobs.append((self.options.selected_index, face))
 
         else:
-            faces = get_all_faces(frame)
+            start = time.perf_counter()
+            if faces is None and tracker is not None:
+                faces = tracker.get_faces(frame, frame_index)
+            elif faces is None:
+                faces = get_all_faces(frame)
+            self.timer.add('detection', start)
             if faces is None:
                 return num_faces_found, frame
             
             if self.options.swap_mode == "all":
                 for face in faces:
                     num_faces_found += 1
-                    temp_frame = self.process_face(self.options.selected_index, face, temp_frame)
+                    swap_jobs.append((self.options.selected_index, face))
 
             elif self.options.swap_mode == "all_input" or self.options.swap_mode == "all_random":
                 for i,face in enumerate(faces):
                     num_faces_found += 1
                     if i < len(self.input_face_datas):
-                        temp_frame = self.process_face(i, face, temp_frame)
+                        swap_jobs.append((i, face))
                     else:
                         break
             
             elif self.options.swap_mode == "selected":
                 num_targetfaces = len(self.target_face_datas) 
                 use_index = num_targetfaces == 1
-                for i,tf in enumerate(self.target_face_datas):
-                    for face in faces:
-                        if compute_cosine_distance(tf.embedding, face.embedding) <= self.options.face_distance_threshold:
-                            if i < len(self.input_face_datas):
-                                if use_index:
-                                    temp_frame = self.process_face(self.options.selected_index, face, temp_frame)
-                                else:
-                                    temp_frame = self.process_face(i, face, temp_frame)
-                                num_faces_found += 1
-                            if not roop.globals.vr_mode and num_faces_found == num_targetfaces:
-                                break
+                # targets without an input face are never swapped, so they must not take faces away from the others
+                num_usable = min(num_targetfaces, len(self.input_face_datas))
+                # distance table faces x targets
+                distances = self.get_target_distances(faces)[:, :num_usable]
+                matches = distances <= self.options.face_distance_threshold
+                # stereo images show every target face twice
+                if roop.globals.CFG.unique_face_matching and not roop.globals.vr_mode:
+                    matches = self.assign_unique_targets(distances, matches)
+                for i in range(num_usable):
+                    for j in np.flatnonzero(matches[:, i]):
+                        if use_index:
+                            swap_jobs.append((self.options.selected_index, faces[j]))
+                        else:
+                            swap_jobs.append((i, faces[j]))
+                        num_faces_found += 1
             elif self.options.swap_mode == "all_female" or self.options.swap_mode == "all_male":
                 gender = 'F' if self.options.swap_mode == "all_female" else 'M'
                 for face in faces:
                     if face.sex == gender:
                         num_faces_found += 1
-                        temp_frame = self.process_face(self.options.selected_index, face, temp_frame)
+                        swap_jobs.append((self.options.selected_index, face))
             
             # might be slower but way more clean to release everything here
-            for face in faces:
-                del face
             faces.clear()
 
 
@@ -469,6 +666,9 @@ class ProcessMgr():
         if num_faces_found == 0:
             return num_faces_found, frame
 
+        temp_frame = self.process_faces(swap_jobs, frame, temp_frame)
+        swap_jobs.clear()
+
         #maskprocessor = next((x for x in self.processors if x.type == 'mask'), None)
 
         if self.options.imagemask is not None and self.options.imagemask.shape == frame.shape:
@@ -476,6 +676,33 @@ class ProcessMgr():
         return num_faces_found, temp_frame
 
 
+    def get_target_distances(self, faces):
+        """ Cosine distances of all faces to all target faces, one row per face.
+            Tracked faces keep their row from frame to frame, so only new ones are computed.
+        """
+        if self.target_embeddings is None:
+            return np.empty((len(faces), 0), dtype=np.float32)
+        missing = [face for face in faces if face.target_distances is None]
+        if len(missing) > 0:
+            embeddings = np.stack([face.embedding for face in missing]).astype(np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+            distances = 1.0 - embeddings @ self.target_embeddings.T
+            for face, row in zip(missing, distances):
+                face.target_distances = row
+        if len(faces) < 1:
+            return np.empty((0, len(self.target_face_datas)), dtype=np.float32)
+        return np.stack([face.target_distances for face in faces])
+
+
+    def assign_unique_targets(self, distances, matches):
+        # every target face gets at most one face and vice versa, picking the pairs with the smallest total distance
+        distances = np.where(matches, distances, 2.0)
+        unique_matches = np.zeros_like(matches)
+        for j, i in zip(*linear_sum_assignment(distances)):
+            unique_matches[j, i] = matches[j, i]
+        return unique_matches
+
+
     def rotation_action(self, original_face:Face, frame:Frame):
         (height, width) = frame.shape[:2]
 
@@ -541,15 +768,35 @@ class ProcessMgr():
 
 
     def process_face(self,face_index, target_face:Face, frame:Frame):
+        return self.process_faces([(face_index, target_face)], frame, frame.copy())
+
+
+    def process_faces(self, swap_jobs, frame:Frame, temp_frame:Frame):
+        """ Swaps all faces of a frame at once. The aligned crops are gathered first,
+            swapped in a single batch and the results are then scattered back and pasted
+            face by face into temp_frame, which is modified in place.
+        """
+        start = time.perf_counter()
+        face_jobs = [self.prepare_face(face_index, target_face, frame) for face_index, target_face in swap_jobs]
+        self.timer.add('alignment', start)
+        start = time.perf_counter()
+        self.swap_prepared_faces(face_jobs)
+        self.timer.add('swap', start)
+        for job in face_jobs:
+            temp_frame = self.finish_face(job, temp_frame)
+        face_jobs.clear()
+        return temp_frame
+
+
+    def prepare_face(self, face_index, target_face:Face, frame:Frame):
         from roop.face_util import align_crop
 
-        enhanced_frame = None
         if(len(self.input_face_datas) > 0):
             inputface = self.input_face_datas[face_index].faces[0]
         else:
             inputface = None
 
-        rotation_action = None
+        job = FaceJob(face_index, inputface, target_face)
         if roop.globals.autorotate_faces:
             # check for sideways rotation of face
             rotation_action = self.rotation_action(target_face, frame)
@@ -565,12 +812,11 @@ class ProcessMgr():
                     rotcutframe = rotate_clockwise(rotcutframe)
                 # rotate image and re-detect face to correct wonky landmarks
                 rotface = get_first_face(rotcutframe)
-                if rotface is None:
-                    rotation_action = None
-                else:
-                    saved_frame = frame.copy()
+                if rotface is not None:
+                    job.rotation_action = rotation_action
+                    job.cut_region = (startX, startY, endX, endY)
                     frame = rotcutframe
-                    target_face = rotface
+                    job.target_face = rotface
 
 
 
@@ -595,54 +841,97 @@ class ProcessMgr():
 
             # img = vr.GetPerspective(frame, 90, theta, phi, 1280, 1280)  # Generate perspective image
 
+        model_output_size = self.options.swap_output_size
+        subsample_size = max(self.options.subsample_size, model_output_size)
+        job.aligned_img, M = align_crop(frame, job.target_face.kps, subsample_size)
+        job.fake_frame = job.aligned_img
+        job.target_face.matrix = M
+        return job
 
+
+    def swap_prepared_faces(self, face_jobs):
         """ Code ported/adapted from Facefusion which borrowed the idea from Rope:
             Kind of subsampling the cutout and aligned face image and faceswapping slices of it up to
             the desired output resolution. This works around the current resolution limitations without using enhancers.
         """
+        swap_processor = next((p for p in self.processors if p.type == 'swap'), None)
+        jobs = [job for job in face_jobs if job.inputface is not None]
+        if swap_processor is None or len(jobs) < 1:
+            return
+
         model_output_size = self.options.swap_output_size
         subsample_size = max(self.options.subsample_size, model_output_size)
         subsample_total = subsample_size // model_output_size
-        aligned_img, M = align_crop(frame, target_face.kps, subsample_size)
 
-        fake_frame = aligned_img
-        target_face.matrix = M
+        num_slices = subsample_total ** 2
+        # all slices of all faces go through the swapper as one batch
+        latents = np.concatenate([swap_processor.CalcLatent(job.inputface) for job in jobs])
+        latents = np.repeat(latents, num_slices, axis=0)
+        swap_batch = np.concatenate([self.implode_pixel_boost(job.aligned_img, model_output_size, subsample_total) for job in jobs])
+        for _ in range(0,self.options.num_swap_steps):
+            swap_batch = self.prepare_crop_frame(swap_batch)
+            swap_batch = swap_processor.RunBatch(latents, swap_batch)
+            swap_batch = self.normalize_swap_frame(swap_batch)
+
+        for i, job in enumerate(jobs):
+            swap_result_frames = swap_batch[i * num_slices:(i + 1) * num_slices]
+            fake_frame = self.explode_pixel_boost(swap_result_frames, model_output_size, subsample_total, subsample_size)
+            job.fake_frame = fake_frame.astype(np.uint8)
+
+
+    def finish_face(self, job, frame:Frame):
+        target_face = job.target_face
+        rotation_action = job.rotation_action
+        if rotation_action is not None:
+            (startX, startY, endX, endY) = job.cut_region
+            saved_frame = frame
+            frame = frame[startY:endY, startX:endX]
+            if rotation_action == "rotate_anticlockwise":
+                frame = rotate_anticlockwise(frame)
+            elif rotation_action == "rotate_clockwise":
+                frame = rotate_clockwise(frame)
+            frame = np.ascontiguousarray(frame)
 
+        enhanced_frame = None
+        scale_factor = 0.0
+        fake_frame = job.fake_frame
         for p in self.processors:
             if p.type == 'swap':
-                swap_result_frames = []
-                subsample_frames = self.implode_pixel_boost(aligned_img, model_output_size, subsample_total)
-                for sliced_frame in subsample_frames:
-                    for _ in range(0,self.options.num_swap_steps):
-                        sliced_frame = self.prepare_crop_frame(sliced_frame)
-                        sliced_frame = p.Run(inputface, target_face, sliced_frame)
-                        sliced_frame = self.normalize_swap_frame(sliced_frame)
-                    swap_result_frames.append(sliced_frame)
-                fake_frame = self.explode_pixel_boost(swap_result_frames, model_output_size, subsample_total, subsample_size)
-                fake_frame = fake_frame.astype(np.uint8)
-                scale_factor = 0.0
+                continue
             elif p.type == 'mask':
-                fake_frame = self.process_mask(p, aligned_img, fake_frame)
+                start = time.perf_counter()
+                fake_frame = self.process_mask(p, job.aligned_img, fake_frame)
+                self.timer.add('mask', start)
             else:
-                enhanced_frame, scale_factor = p.Run(self.input_face_datas[face_index], target_face, fake_frame)
+                start = time.perf_counter()
+                enhanced_frame, scale_factor = p.Run(self.input_face_datas[job.face_index], target_face, fake_frame)
+                self.timer.add('enhancer', start)
 
         upscale = 512
         orig_width = fake_frame.shape[1]
         if orig_width != upscale:
             fake_frame = cv2.resize(fake_frame, (upscale, upscale), cv2.INTER_CUBIC)
-        mask_offsets = (0,0,0,0,1,20) if inputface is None else inputface.mask_offsets
+        mask_offsets = (0,0,0,0,1,20) if job.inputface is None else job.inputface.mask_offsets
 
-        
+        # pasting happens in place, so cut out the original mouth first
+        if self.options.restore_original_mouth:
+            start = time.perf_counter()
+            mouth_cutout, mouth_bb = self.create_mouth_mask(target_face, frame)
+            self.timer.add('mouth', start)
+
+        start = time.perf_counter()
         if enhanced_frame is None:
             scale_factor = int(upscale / orig_width)
             result = self.paste_upscale(fake_frame, fake_frame, target_face.matrix, frame, scale_factor, mask_offsets)
         else:
             result = self.paste_upscale(fake_frame, enhanced_frame, target_face.matrix, frame, scale_factor, mask_offsets)
+        self.timer.add('paste', start)
 
         # Restore mouth before unrotating
         if self.options.restore_original_mouth:
-            mouth_cutout, mouth_bb = self.create_mouth_mask(target_face, frame)
+            start = time.perf_counter()
             result = self.apply_mouth_area(result, mouth_cutout, mouth_bb)
+            self.timer.add('mouth', start)
 
         if rotation_action is not None:
             fake_frame = self.auto_unrotate_frame(result, rotation_action)
@@ -679,97 +968,109 @@ class ProcessMgr():
 
 
     def paste_upscale(self, fake_face, upsk_face, M, target_img, scale_factor, mask_offsets):
+        """ Blends the face back into target_img in place. The matte comes eroded and blurred
+            from a cache in aligned face space and gets warped along with the face. Warping
+            and blending only cover the region the face lands in, which is found by mapping
+            the corners of the aligned face back with the inverse affine.
+        """
         M_scale = M * scale_factor
         IM = cv2.invertAffineTransform(M_scale)
 
-        face_matte = np.full((target_img.shape[0],target_img.shape[1]), 255, dtype=np.uint8)
-        # Generate white square sized as a upsk_face
-        img_matte = np.zeros((upsk_face.shape[0],upsk_face.shape[1]), dtype=np.uint8)
-
-        w = img_matte.shape[1]
-        h = img_matte.shape[0]
-
-        top = int(mask_offsets[0] * h)
-        bottom = int(h - (mask_offsets[1] * h))
-        left = int(mask_offsets[2] * w)
-        right = int(w - (mask_offsets[3] * w))
-        img_matte[top:bottom,left:right] = 255
-
-        # Transform white square back to target_img
-        img_matte = cv2.warpAffine(img_matte, IM, (target_img.shape[1], target_img.shape[0]), flags=cv2.INTER_NEAREST, borderValue=0.0) 
+        face_matte = get_face_matte(upsk_face.shape[0], mask_offsets)
+        region = self.get_paste_region(IM, face_matte.shape, target_img.shape)
+        if region is None:
+            return target_img
+        (start_x, start_y, end_x, end_y) = region
+        region_size = (end_x - start_x, end_y - start_y)
+        # maps onto the pixels of the region instead of the whole frame
+        IM_region = IM.copy()
+        IM_region[0, 2] -= start_x
+        IM_region[1, 2] -= start_y
+
+        # Transform matte back to target_img
+        img_matte = cv2.warpAffine(face_matte, IM_region, region_size, flags=cv2.INTER_LINEAR, borderValue=0.0)
         ##Blacken the edges of face_matte by 1 pixels (so the mask in not expanded on the image edges)
-        img_matte[:1,:] = img_matte[-1:,:] = img_matte[:,:1] = img_matte[:,-1:] = 0
-
-        img_matte = self.blur_area(img_matte, mask_offsets[4], mask_offsets[5])
-        #Normalize images to float values and reshape
-        img_matte = img_matte.astype(np.float32)/255
-        face_matte = face_matte.astype(np.float32)/255
-        img_matte = np.minimum(face_matte, img_matte)
-        if self.options.show_face_area_overlay:
-            # Additional steps for green overlay
-            green_overlay = np.zeros_like(target_img)
-            green_color = [0, 255, 0]  # RGB for green
-            for i in range(3):  # Apply green color where img_matte is not zero
-                green_overlay[:, :, i] = np.where(img_matte > 0, green_color[i], 0)        ##Transform upcaled face back to target_img
+        if start_y == 0:
+            img_matte[:1,:] = 0
+        if end_y == target_img.shape[0]:
+            img_matte[-1:,:] = 0
+        if start_x == 0:
+            img_matte[:,:1] = 0
+        if end_x == target_img.shape[1]:
+            img_matte[:,-1:] = 0
         img_matte = np.reshape(img_matte, [img_matte.shape[0],img_matte.shape[1],1]) 
-        paste_face = cv2.warpAffine(upsk_face, IM, (target_img.shape[1], target_img.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+        ##Transform upcaled face back to target_img
+        paste_face = cv2.warpAffine(upsk_face, IM_region, region_size, borderMode=cv2.BORDER_REPLICATE)
         if upsk_face is not fake_face:
-            fake_face = cv2.warpAffine(fake_face, IM, (target_img.shape[1], target_img.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+            fake_face = cv2.warpAffine(fake_face, IM_region, region_size, borderMode=cv2.BORDER_REPLICATE)
             paste_face = cv2.addWeighted(paste_face, self.options.blend_ratio, fake_face, 1.0 - self.options.blend_ratio, 0)
 
         # Re-assemble image
+        target_region = target_img[start_y:end_y, start_x:end_x]
         paste_face = img_matte * paste_face
-        paste_face = paste_face + (1-img_matte) * target_img.astype(np.float32)
+        paste_face = paste_face + (1-img_matte) * target_region.astype(np.float32)
+        target_region[:] = paste_face.astype(np.uint8)
         if self.options.show_face_area_overlay:
             # Overlay the green overlay on the final image
-            paste_face = cv2.addWeighted(paste_face.astype(np.uint8), 1 - 0.5, green_overlay, 0.5, 0)
-        return paste_face.astype(np.uint8)
+            green_overlay = np.zeros_like(target_img)
+            green_overlay[start_y:end_y, start_x:end_x][img_matte[:, :, 0] > 0] = [0, 255, 0]
+            target_img[:] = cv2.addWeighted(target_img, 1 - 0.5, green_overlay, 0.5, 0)
+        return target_img
+
+
+    def get_paste_region(self, IM, face_shape, frame_shape):
+        """ Bounding rectangle (start_x, start_y, end_x, end_y) in frame_shape of the aligned
+            face mapped by IM, None if the face is completely outside of the frame.
+        """
+        h, w = face_shape[:2]
+        corners = np.array([[0, 0, 1], [w, 0, 1], [w, h, 1], [0, h, 1]], dtype=np.float64)
+        corners = corners @ IM.T
+        min_x, min_y = corners.min(axis=0)
+        max_x, max_y = corners.max(axis=0)
+
+        start_x = max(int(np.floor(min_x)) - 1, 0)
+        start_y = max(int(np.floor(min_y)) - 1, 0)
+        end_x = min(int(np.ceil(max_x)) + 2, frame_shape[1])
+        end_y = min(int(np.ceil(max_y)) + 2, frame_shape[0])
+        if start_x >= end_x or start_y >= end_y:
+            return None
+        return start_x, start_y, end_x, end_y
 
 
     def blur_area(self, img_matte, num_erosion_iterations, blur_amount):
-        # Detect the affine transformed white area
-        mask_h_inds, mask_w_inds = np.where(img_matte==255) 
-        # Calculate the size (and diagonal size) of transformed white area width and height boundaries
-        mask_h = np.max(mask_h_inds) - np.min(mask_h_inds) 
-        mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
-        mask_size = int(np.sqrt(mask_h*mask_w))
-        # Calculate the kernel size for eroding img_matte by kernel (insightface empirical guess for best size was max(mask_size//10,10))
-        # k = max(mask_size//12, 8)
-        k = max(mask_size//(blur_amount // 2) , blur_amount // 2)
-        kernel = np.ones((k,k),np.uint8)
-        img_matte = cv2.erode(img_matte,kernel,iterations = num_erosion_iterations)
-        #Calculate the kernel size for blurring img_matte by blur_size (insightface empirical guess for best size was max(mask_size//20, 5))
-        # k = max(mask_size//24, 4) 
-        k = max(mask_size//blur_amount, blur_amount//5) 
-        kernel_size = (k, k)
-        blur_size = tuple(2*i+1 for i in kernel_size)
-        return cv2.GaussianBlur(img_matte, blur_size, 0)
+        return blur_area(img_matte, num_erosion_iterations, blur_amount)
 
 
     def prepare_crop_frame(self, swap_frame):
+        """ Takes a single HWC crop or a NHWC batch of crops, returns a NCHW float32 batch """
         model_type = 'inswapper'
         model_mean = [0.0, 0.0, 0.0]
         model_standard_deviation = [1.0, 1.0, 1.0]
 
+        if swap_frame.ndim == 3:
+            swap_frame = np.expand_dims(swap_frame, axis = 0)
         if model_type == 'ghost':
-            swap_frame = swap_frame[:, :, ::-1] / 127.5 - 1
+            swap_frame = swap_frame[..., ::-1] / 127.5 - 1
         else:
-            swap_frame = swap_frame[:, :, ::-1] / 255.0
+            swap_frame = swap_frame[..., ::-1] / 255.0
         swap_frame = (swap_frame - model_mean) / model_standard_deviation
-        swap_frame = swap_frame.transpose(2, 0, 1)
-        swap_frame = np.expand_dims(swap_frame, axis = 0).astype(np.float32)
+        swap_frame = swap_frame.transpose(0, 3, 1, 2).astype(np.float32)
         return swap_frame
 
 
     def normalize_swap_frame(self, swap_frame):
+        """ Takes a single CHW result or a NCHW batch, returns it as HWC / NHWC """
         model_type = 'inswapper'
-        swap_frame = swap_frame.transpose(1, 2, 0)
+        if swap_frame.ndim == 3:
+            swap_frame = swap_frame.transpose(1, 2, 0)
+        else:
+            swap_frame = swap_frame.transpose(0, 2, 3, 1)
 
         if model_type == 'ghost':
             swap_frame = (swap_frame * 127.5 + 127.5).round()
         else:
             swap_frame = (swap_frame * 255.0).round()
-        swap_frame = swap_frame[:, :, ::-1]
+        swap_frame = swap_frame[..., ::-1]
         return swap_frame
 
     def implode_pixel_boost(self, aligned_face_frame, model_size, pixel_boost_total : int):
@@ -824,14 +1125,6 @@ class ProcessMgr():
 
 
 
-    def create_feathered_mask(self, shape, feather_amount=30):
-        mask = np.zeros(shape[:2], dtype=np.float32)
-        center = (shape[1] // 2, shape[0] // 2)
-        cv2.ellipse(mask, center, (shape[1] // 2 - feather_amount, shape[0] // 2 - feather_amount), 
-                    0, 0, 360, 1, -1)
-        mask = cv2.GaussianBlur(mask, (feather_amount*2+1, feather_amount*2+1), 0)
-        return mask / np.max(mask)
-
     def apply_mouth_area(self, frame: np.ndarray, mouth_cutout: np.ndarray, mouth_box: tuple) -> np.ndarray:
         min_x, min_y, max_x, max_y = mouth_box
         box_width = max_x - min_x
@@ -855,8 +1148,7 @@ class ProcessMgr():
             color_corrected_mouth = self.apply_color_transfer(resized_mouth_cutout, roi)
             
             # Create a feathered mask with increased feather amount
-            feather_amount = min(30, box_width // 15, box_height // 15)
-            mask = self.create_feathered_mask(resized_mouth_cutout.shape, feather_amount)
+            mask = get_mouth_mask(resized_mouth_cutout.shape[1], resized_mouth_cutout.shape[0])
             
             # Blend the color-corrected mouth cutout with the ROI using the feathered mask
             mask = mask[:,:,np.newaxis]  # Add channel dimension to mask
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+import psutil
+
+from tqdm import tqdm
+
+# seconds between two samples, also how often the progress bar and status callbacks are updated
+SAMPLE_INTERVAL = 0.5
+PROGRESS_BAR_FORMAT = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+# short names of the counted stages in the progress bar
+STAGE_NAMES = { 'decoded': 'dec', 'processed': 'proc', 'written': 'enc' }
+
+
+class ProgressSampler():
+    """ Shows the progress of a job without slowing its workers down.
+
+        Workers only count their frames, in counters of their own thread. A background thread
+        sums them up at a fixed interval, together with the memory used and the depths of the
+        queues in between the stages, and updates the progress bar and status callbacks from
+        that sample.
+    """
+
+    def __init__(self, total: int = 0, unit: str = 'frames', num_threads: int = 1, callbacks: list = None, interval: float = SAMPLE_INTERVAL):
+        self.total = total
+        self.unit = unit
+        self.num_threads = num_threads
+        self.callbacks = callbacks if callbacks is not None else []
+        self.interval = interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # stage -> count, one dict per counting thread
+        self.thread_counts = []
+        # name -> function returning the current depth
+        self.queues = {}
+        self.latest = None
+        self.progress = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+
+    def count(self, stage: str = 'processed', num: int = 1):
+        """ Counts frames done by a stage, only touches counters of the calling thread """
+        counts = getattr(self.local, 'counts', None)
+        if counts is None:
+            counts = self.local.counts = {}
+            with self.lock:
+                self.thread_counts.append(counts)
+        counts[stage] = counts.get(stage, 0) + num
+
+
+    def add_queue(self, name: str, get_depth):
+        self.queues[name] = get_depth
+
+
+    def __enter__(self):
+        self.process = psutil.Process(os.getpid())
+        self.start_time = self.last_time = time.perf_counter()
+        self.last_counts = {}
+        self.progress = tqdm(total=self.total, desc='Processing', unit=self.unit, dynamic_ncols=True, bar_format=PROGRESS_BAR_FORMAT)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='progress_sampler', daemon=True)
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *args):
+        self.stop_event.set()
+        self.thread.join()
+        # the final counts
+        self.update()
+        self.progress.close()
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+
+    def sample(self) -> dict:
+        """ Current counts, rates per second since the last sample, memory and queue depths """
+        now = time.perf_counter()
+        with self.lock:
+            thread_counts = list(self.thread_counts)
+        counts = {}
+        for stage_counts in thread_counts:
+            for stage, num in list(stage_counts.items()):
+                counts[stage] = counts.get(stage, 0) + num
+        elapsed = max(now - self.last_time, 1e-6)
+        rates = { stage: (num - self.last_counts.get(stage, 0)) / elapsed for stage, num in counts.items() }
+        self.last_time = now
+        self.last_counts = counts
+
+        rss = self.process.memory_info().rss
+        for child in self.process.children():
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        queues = {}
+        for name, get_depth in list(self.queues.items()):
+            try:
+                queues[name] = get_depth()
+            except Exception:
+                queues[name] = None
+        return { 'time': now - self.start_time, 'counts': counts, 'rates': rates, 'rss': rss, 'queues': queues, 'total': self.total }
+
+
+    def update(self):
+        sample = self.sample()
+        self.latest = sample
+        postfix = {
+            'memory_usage': '{:.2f}'.format(sample['rss'] / 1024 / 1024 / 1024).zfill(5) + 'GB',
+            'execution_threads': self.num_threads
+        }
+        if len(sample['rates']) > 1:
+            postfix['fps'] = ' '.join(f'{STAGE_NAMES.get(stage, stage)} {rate:.1f}' for stage, rate in sample['rates'].items())
+        if len(sample['queues']) > 0:
+            postfix['queues'] = ' '.join(f'{name} {depth}' for name, depth in sample['queues'].items())
+        self.progress.set_postfix(postfix, refresh=False)
+        done = sample['counts'].get('processed', 0) - self.progress.n
+        if done > 0:
+            self.progress.update(done)
+        else:
+            self.progress.refresh()
+        for callback in self.callbacks:
+            callback(sample)
@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import cv2
+
+import roop.globals
+import roop.util_ffmpeg as ffmpeg
+import roop.utilities as util
+from roop.FrameProcessPool import get_globals_snapshot
+from roop.StageTimer import StageTimer
+import roop.trace_util as trace_util
+
+# shorter segments don't amortize loading the models in their process
+MIN_SEGMENT_FRAMES = 50
+# seconds between two checks of the main process if the job was cancelled
+CANCEL_POLL_TIME = 0.5
+
+# set by the main process when the job is cancelled or a segment failed
+CANCEL_EVENT = None
+
+
+def init_segment_process(cancel_event):
+    global CANCEL_EVENT
+
+    CANCEL_EVENT = cancel_event
+
+
+def watch_cancel_event():
+    CANCEL_EVENT.wait()
+    roop.globals.processing = False
+
+
+def render_segment(globals_snapshot, input_faces, target_faces, options, source_video, segment_video, frame_start, frame_end, fps, threads):
+    """ Entry point of a segment process: renders frame_start..frame_end with its own reader and encoder,
+        returns if it succeeded, its stage timings and trace spans
+    """
+    from roop.ProcessMgr import ProcessMgr
+
+    for name, value in globals_snapshot.items():
+        setattr(roop.globals, name, value)
+    roop.globals.processing = True
+    threading.Thread(target=watch_cancel_event, name='cancel_watcher', daemon=True).start()
+    multiprocessing.current_process().name = os.path.splitext(os.path.basename(segment_video))[0]
+    # the segments already run in parallel processes
+    roop.globals.CFG.worker_mode = 'threads'
+
+    process_mgr = ProcessMgr()
+    process_mgr.initialize(input_faces, target_faces, options)
+    # keep the order the main process already picked for 'all_random'
+    process_mgr.input_face_datas = input_faces
+    process_mgr.run_batch_inmem("File", source_video, segment_video, frame_start, frame_end, fps, threads)
+    process_mgr.release_resources()
+    # a cancelled segment is incomplete
+    return os.path.isfile(segment_video) and roop.globals.processing, process_mgr.timer.samples, trace_util.get_trace()
+
+
+def split_segments(keyframes: list, frame_start: int, frame_end: int, num_segments: int) -> list:
+    """ Splits frame_start..frame_end into about equal (start, end) ranges. The boundaries are moved
+        to the nearest keyframe, so no segment reader has to decode frames in front of its start.
+    """
+    num_segments = max(1, min(num_segments, (frame_end - frame_start) // MIN_SEGMENT_FRAMES))
+    boundaries = [frame_start]
+    for i in range(1, num_segments):
+        target = frame_start + (frame_end - frame_start) * i // num_segments
+        candidates = [k for k in keyframes if boundaries[-1] + MIN_SEGMENT_FRAMES <= k <= frame_end - MIN_SEGMENT_FRAMES]
+        if len(keyframes) > 0:
+            if len(candidates) < 1:
+                break
+            target = min(candidates, key=lambda k: abs(k - target))
+        boundaries.append(target)
+    boundaries.append(frame_end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+
+class SegmentRenderer():
+    """ Renders a video as independent segments in parallel processes, each one with its own
+        ProcessMgr, reader and encoder, and joins the encoded segments without encoding them again.
+        Scales with cores and GPUs which a single pipeline can't saturate, at the cost of loading
+        the models once per segment.
+    """
+
+    def __init__(self, process_mgr, num_segments: int):
+        self.process_mgr = process_mgr
+        self.num_segments = num_segments
+
+
+    def get_segments(self, source_video, frame_start, frame_end):
+        cap = cv2.VideoCapture(source_video)
+        source_fps = cap.get(cv2.CAP_PROP_FPS)
+        cap.release()
+        keyframes = []
+        if source_fps > 0:
+            keyframe_times = ffmpeg.get_keyframes(source_video)
+            if len(keyframe_times) > 0:
+                keyframes = [int(round((t - keyframe_times[0]) * source_fps)) for t in keyframe_times]
+        return split_segments(keyframes, frame_start, frame_end, self.num_segments), source_fps
+
+
+    def run(self, source_video, target_video, frame_start, frame_end, fps, threads:int = 1, with_audio:bool = False):
+        segments, source_fps = self.get_segments(source_video, frame_start, frame_end)
+        if len(segments) < 2:
+            self.process_mgr.run_batch_inmem("File", source_video, target_video, frame_start, frame_end, fps, threads, with_audio)
+            return
+
+        print(f'Rendering {len(segments)} segments: {", ".join(f"{s}-{e}" for s, e in segments)}')
+        util.create_temp(source_video)
+        temp_directory = util.get_temp_directory_path(source_video)
+        extension = os.path.splitext(target_video)[1]
+        segment_videos = [os.path.join(temp_directory, f'segment_{i:03d}{extension}') for i in range(len(segments))]
+        threads_per_segment = max(1, threads // len(segments))
+
+        timer = StageTimer(roop.globals.CFG.timing_report)
+        globals_snapshot = get_globals_snapshot()
+        ctx = multiprocessing.get_context('spawn')
+        # handed over when the processes start, synchronization primitives can't be sent with a task
+        cancel_event = ctx.Event()
+        rendered = []
+        try:
+            with ProcessPoolExecutor(max_workers=len(segments), mp_context=ctx, initializer=init_segment_process, initargs=(cancel_event,)) as executor:
+                try:
+                    futures = [executor.submit(render_segment, globals_snapshot, self.process_mgr.input_face_datas, self.process_mgr.target_face_datas,
+                                               self.process_mgr.options, source_video, segment_video, start, end, fps, threads_per_segment)
+                               for segment_video, (start, end) in zip(segment_videos, segments)]
+                    pending = futures
+                    while len(pending) > 0:
+                        done, pending = wait(pending, timeout=CANCEL_POLL_TIME)
+                        # a failed segment stops the others too
+                        if not roop.globals.processing or any(future.exception() is not None for future in done):
+                            cancel_event.set()
+                    for i, future in enumerate(futures):
+                        success, samples, trace = future.result()
+                        rendered.append(success)
+                        timer.merge(samples, f'segment_{i}/')
+                        trace_util.merge_trace(trace)
+                except BaseException:
+                    cancel_event.set()
+                    raise
+            self.process_mgr.timer = timer
+
+            if not roop.globals.processing:
+                return
+            if all(rendered):
+                if with_audio and source_fps > 0:
+                    ffmpeg.join_videos(segment_videos, target_video, True, source_video, frame_start / source_fps, frame_end / source_fps)
+                else:
+                    ffmpeg.join_videos(segment_videos, target_video, True)
+            else:
+                print('Rendering segments failed')
+        finally:
+            for segment_video in segment_videos:
+                if os.path.isfile(segment_video):
+                    os.remove(segment_video)
+            util.clean_temp(source_video)
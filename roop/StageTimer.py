@@ -0,0 +1,94 @@
+import json
+import threading
+import time
+
+from array import array
+
+import numpy as np
+
+import roop.globals
+import roop.trace_util as trace_util
+
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer():
+    """ Collects how long the stages of a job take (decode, detection, swap, encode, waits...).
+
+        Every thread appends to its own arrays, so workers never wait for each other while
+        timing. Samples of worker processes and segments are merged in afterwards and the
+        report sums them up per stage and per worker.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # worker name -> stage -> durations in seconds
+        self.samples = {}
+        self.start_time = time.perf_counter()
+
+
+    def get_stage_samples(self, stage: str):
+        worker_samples = getattr(self.local, 'samples', None)
+        if worker_samples is None:
+            with self.lock:
+                worker_samples = self.samples.setdefault(threading.current_thread().name, {})
+            self.local.samples = worker_samples
+        stage_samples = worker_samples.get(stage)
+        if stage_samples is None:
+            stage_samples = worker_samples[stage] = array('d')
+        return stage_samples
+
+
+    def add(self, stage: str, start: float):
+        """ Records a stage of the calling thread which started at perf_counter() start and ends now,
+            also as a span if tracing is on
+        """
+        if self.enabled or roop.globals.tracing:
+            end = time.perf_counter()
+            if self.enabled:
+                self.get_stage_samples(stage).append(end - start)
+            trace_util.add_span(stage, start, end)
+
+
+    def merge(self, samples: dict, prefix: str = ''):
+        """ Adds the samples of another timer, e.g. one from a worker process """
+        with self.lock:
+            for worker, stages in samples.items():
+                worker_samples = self.samples.setdefault(prefix + worker, {})
+                for stage, durations in stages.items():
+                    worker_samples.setdefault(stage, array('d')).extend(durations)
+
+
+    def summarize(self, num_frames: int = None) -> dict:
+        wall_time = time.perf_counter() - self.start_time
+        stages = {}
+        workers = {}
+        with self.lock:
+            for worker, worker_samples in self.samples.items():
+                workers[worker] = {}
+                for stage, durations in worker_samples.items():
+                    stages.setdefault(stage, []).append(np.array(durations, dtype=np.float64))
+                    workers[worker][stage] = { 'count': len(durations), 'total': float(sum(durations)) }
+
+        summary = { 'wall_time': wall_time, 'frames': num_frames, 'stages': {}, 'workers': workers }
+        if num_frames:
+            summary['fps'] = num_frames / wall_time
+        for stage, arrays in stages.items():
+            durations = np.concatenate(arrays)
+            if len(durations) < 1:
+                continue
+            stage_summary = { 'count': len(durations), 'total': float(durations.sum()), 'mean_ms': 1000.0 * float(durations.mean()) }
+            for p, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+                stage_summary[f'p{p}_ms'] = 1000.0 * float(value)
+            summary['stages'][stage] = stage_summary
+        return summary
+
+
+    def save_report(self, filename: str, num_frames: int = None):
+        summary = self.summarize(num_frames)
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f'Stage timings written to {filename}')
+        return summary
@@ -0,0 +1,46 @@
+import argparse
+import sys
+
+import roop.globals
+from settings import Settings
+from roop.benchmark import detectors, kernels, pipeline
+
+
+def parse_args():
+    program = argparse.ArgumentParser(prog='python -m roop.benchmark', formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
+    program.add_argument('--config', help='Settings file to use', dest='config', default='config.yaml')
+    program.add_argument('--execution-provider', help='Execution provider, e.g. cpu or cuda', dest='execution_provider', default='cpu')
+    benchmarks = program.add_subparsers(dest='benchmark', required=True)
+    detectors.add_arguments(benchmarks.add_parser('detectors', help='Speed and agreement of face analysis model packs compared to buffalo_l'))
+    kernels.add_arguments(benchmarks.add_parser('kernels', help='Timings and outputs of the per face kernels compared to a baseline'))
+    pipeline.add_arguments(benchmarks.add_parser('pipeline', help='Frames per second and memory of the processing paths, with stand-in models and synthetic faces'))
+    return program.parse_args()
+
+
+def run():
+    args = parse_args()
+    roop.globals.CFG = Settings(args.config)
+    roop.globals.cascade_detection = roop.globals.CFG.cascade_detection
+    roop.globals.execution_providers = get_execution_providers(args.execution_provider)
+    if args.benchmark == 'detectors':
+        detectors.run(args)
+    elif args.benchmark == 'kernels':
+        if not kernels.run(args):
+            sys.exit(1)
+    elif args.benchmark == 'pipeline':
+        if not pipeline.run(args):
+            sys.exit(1)
+
+
+def get_execution_providers(name: str) -> list:
+    import onnxruntime
+
+    providers = [p for p in onnxruntime.get_available_providers() if p.replace('ExecutionProvider', '').lower() == name.lower()]
+    if len(providers) == 0:
+        print(f'Execution provider {name} not available, using CPU')
+        return ['CPUExecutionProvider']
+    return providers
+
+
+if __name__ == '__main__':
+    run()
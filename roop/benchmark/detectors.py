@@ -0,0 +1,174 @@
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+import roop.globals
+from roop.face_util import create_face_analyser, faces_from_detection
+from roop.FaceTracker import bbox_iou
+from roop.utilities import has_image_extension, is_video
+
+REFERENCE_PACK = 'buffalo_l'
+# min. overlap of a face with a buffalo_l face to count as the same detection
+MIN_MATCH_IOU = 0.5
+BENCHMARK_MODULES = ['detection', 'recognition']
+
+
+def add_arguments(parser):
+    parser.add_argument('packs', nargs='+', help='Model packs to compare, official ones or folders in models/')
+    parser.add_argument('--samples', help='Folder with sample images and videos', dest='samples', required=True)
+    parser.add_argument('--frames-per-video', help='Frames taken evenly from every video', dest='frames_per_video', type=int, default=10)
+    parser.add_argument('--repeat', help='Timed runs per sample', dest='repeat', type=int, default=3)
+    parser.add_argument('--output', help='Also write the results to this JSON file', dest='output', default=None)
+
+
+def run(args):
+    samples = load_samples(args.samples, args.frames_per_video)
+    if len(samples) < 1:
+        print(f'No images or videos found in {args.samples}')
+        return
+    print(f'{len(samples)} sample frames, detection size {"640" if roop.globals.default_det_size else "320"}')
+
+    reference = measure_pack(REFERENCE_PACK, samples, args.repeat)
+    results = [summarize(reference, reference)]
+    for pack in args.packs:
+        if pack != REFERENCE_PACK:
+            results.append(summarize(measure_pack(pack, samples, args.repeat), reference))
+
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({ 'samples': len(samples), 'reference': REFERENCE_PACK, 'results': results }, f, indent=2)
+
+
+def load_samples(folder: str, frames_per_video: int) -> list:
+    samples = []
+    for name in sorted(os.listdir(folder)):
+        filename = os.path.join(folder, name)
+        if has_image_extension(filename):
+            image = cv2.imdecode(np.fromfile(filename, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is not None:
+                samples.append(image)
+        elif is_video(filename):
+            cap = cv2.VideoCapture(filename)
+            frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            for frame_number in np.linspace(0, max(0, frame_total - 1), frames_per_video, dtype=int):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                ret, frame = cap.read()
+                if ret:
+                    samples.append(frame)
+            cap.release()
+    return samples
+
+
+def measure_pack(pack: str, samples: list, repeat: int) -> dict:
+    """ Times detection and recognition of a model pack over all samples and keeps the faces found """
+    analyser = create_face_analyser(pack, BENCHMARK_MODULES, roop.globals.execution_providers)
+    det_model = analyser.det_model
+    recognizer = analyser.models.get('recognition')
+    # first runs include session warmup
+    det_model.detect(samples[0], max_num=0, metric='default')
+
+    faces_per_sample = []
+    start = time.perf_counter()
+    for sample in samples:
+        for _ in range(max(1, repeat)):
+            bboxes, kpss = det_model.detect(sample, max_num=0, metric='default')
+        faces_per_sample.append(faces_from_detection(bboxes, kpss))
+    detection_time = (time.perf_counter() - start) / max(1, repeat)
+
+    num_faces = sum(len(faces) for faces in faces_per_sample)
+    recognition_time = None
+    if recognizer is not None and num_faces > 0:
+        start = time.perf_counter()
+        for sample, faces in zip(samples, faces_per_sample):
+            for face in faces:
+                recognizer.get(sample, face)
+        recognition_time = time.perf_counter() - start
+
+    del analyser
+    return { 'pack': pack, 'faces': faces_per_sample, 'detection_time': detection_time,
+             'recognition_time': recognition_time, 'num_samples': len(samples), 'num_faces': num_faces }
+
+
+def summarize(result: dict, reference: dict) -> dict:
+    matched = []
+    num_reference_faces = 0
+    for faces, reference_faces in zip(result['faces'], reference['faces']):
+        num_reference_faces += len(reference_faces)
+        matched.extend(match_detections(faces, reference_faces))
+
+    summary = {
+        'pack': result['pack'],
+        'detections_per_second': result['num_samples'] / result['detection_time'],
+        'ms_per_detection': 1000.0 * result['detection_time'] / result['num_samples'],
+        'ms_per_embedding': None,
+        'faces': result['num_faces'],
+        'recall': len(matched) / num_reference_faces if num_reference_faces > 0 else None,
+        'precision': len(matched) / result['num_faces'] if result['num_faces'] > 0 else None,
+        'mean_iou': float(np.mean([iou for _, _, iou in matched])) if len(matched) > 0 else None,
+    }
+    if result['recognition_time'] is not None:
+        summary['ms_per_embedding'] = 1000.0 * result['recognition_time'] / result['num_faces']
+    summary.update(embedding_agreement(matched))
+    return summary
+
+
+def match_detections(faces: list, reference_faces: list) -> list:
+    """ Greedily pairs the faces with the reference faces they overlap most, returns (face, reference face, iou) """
+    pairs = []
+    for i, face in enumerate(faces):
+        for j, reference_face in enumerate(reference_faces):
+            iou = bbox_iou(face.bbox, reference_face.bbox)
+            if iou >= MIN_MATCH_IOU:
+                pairs.append((iou, i, j))
+    pairs.sort(reverse=True)
+    matched = []
+    used_faces = set()
+    used_references = set()
+    for iou, i, j in pairs:
+        if i in used_faces or j in used_references:
+            continue
+        used_faces.add(i)
+        used_references.add(j)
+        matched.append((faces[i], reference_faces[j], iou))
+    return matched
+
+
+def embedding_agreement(matched: list) -> dict:
+    """ Embeddings of different recognizers can't be compared directly. Instead this checks how often
+        both decide the same whether two of the matched faces are the same person, using the face
+        distance threshold, and whether they pick the same most similar face.
+    """
+    matched = [m for m in matched if m[0].get('embedding') is not None and m[1].get('embedding') is not None]
+    if len(matched) < 2:
+        return { 'same_person_agreement': None, 'nearest_face_agreement': None }
+
+    distances = []
+    for index in range(2):
+        embeddings = np.stack([m[index].embedding for m in matched]).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        distance = 1.0 - embeddings @ embeddings.T
+        np.fill_diagonal(distance, np.inf)
+        distances.append(distance)
+
+    pairs = np.triu_indices(len(matched), 1)
+    same_person = [d[pairs] <= roop.globals.distance_threshold for d in distances]
+    nearest = [np.argmin(d, axis=1) for d in distances]
+    return { 'same_person_agreement': float(np.mean(same_person[0] == same_person[1])),
+             'nearest_face_agreement': float(np.mean(nearest[0] == nearest[1])) }
+
+
+def print_results(results: list):
+    columns = [('pack', 'Pack', '{}'), ('detections_per_second', 'Det/s', '{:.1f}'), ('ms_per_embedding', 'ms/Emb', '{:.1f}'),
+               ('faces', 'Faces', '{}'), ('recall', 'Recall', '{:.3f}'), ('precision', 'Precision', '{:.3f}'),
+               ('mean_iou', 'IoU', '{:.3f}'), ('same_person_agreement', 'Same person', '{:.3f}'),
+               ('nearest_face_agreement', 'Nearest face', '{:.3f}')]
+    rows = [[title for _, title, _ in columns]]
+    for result in results:
+        rows.append(['-' if result[key] is None else fmt.format(result[key]) for key, _, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
@@ -0,0 +1,242 @@
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+import roop.globals
+from roop.benchmark.pipeline import get_environment, get_revision
+from roop.face_util import arcface_dst, estimate_norm
+
+MODEL_SIZE = 128
+UPSCALE_SIZE = 512
+MASK_OFFSETS = (0, 0, 0, 0, 1, 20)
+# slower than the baseline by more than this fails
+DEFAULT_THRESHOLD = 0.25
+
+
+def add_arguments(parser):
+    parser.add_argument('kernels', nargs='*', help=f'Kernels to run, all by default: {", ".join(KERNELS.keys())}')
+    parser.add_argument('--resolution', help='Frame sizes, WxH', dest='resolutions', nargs='+', default=['1280x720', '1920x1080'])
+    parser.add_argument('--face-size', help='Face sizes in the frame in pixels', dest='face_sizes', type=int, nargs='+', default=[128, 384])
+    parser.add_argument('--subsample-size', help='Sizes of the aligned face, multiples of 128', dest='subsample_sizes', type=int, nargs='+', default=[128, 256, 512])
+    parser.add_argument('--repeat', help='Timed calls per case', dest='repeat', type=int, default=50)
+    parser.add_argument('--baseline', help='Baseline timings, the outputs go into a .npz next to it', dest='baseline', default='benchmark_kernels.json')
+    parser.add_argument('--update-baseline', help='Replace the baseline with this run', dest='update_baseline', action='store_true')
+    parser.add_argument('--threshold', help='Relative slowdown against the baseline which fails', dest='threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--exact', help='Outputs have to match the baseline bit by bit', dest='exact', action='store_true')
+
+
+def run(args) -> bool:
+    """ Times the per face kernels for all cases and checks them against the baseline,
+        returns False if one is too slow or its output differs too much
+    """
+    from roop.ProcessMgr import ProcessMgr
+    from roop.ProcessOptions import ProcessOptions
+
+    process_mgr = ProcessMgr()
+    process_mgr.options = ProcessOptions('InSwapper 128', { 'faceswap': {} }, roop.globals.distance_threshold, roop.globals.blend_ratio,
+                                         'all', 0, None, None, 1, 128, False, False)
+    unknown = [k for k in args.kernels if k not in KERNELS]
+    if len(unknown) > 0:
+        print(f'Unknown kernels: {", ".join(unknown)}')
+        return False
+    resolutions = [tuple(int(v) for v in r.lower().split('x')) for r in args.resolutions]
+    cases = get_cases(args.kernels or list(KERNELS.keys()), resolutions, args.face_sizes, args.subsample_sizes)
+
+    results = {}
+    outputs = {}
+    for name, kernel, params in cases:
+        _, setup, _ = KERNELS[kernel]
+        reset, call = setup(process_mgr, **params)
+        durations, output = measure(reset, call, args.repeat)
+        results[name] = { 'kernel': kernel, 'params': params, 'median_ms': 1000.0 * float(np.median(durations)),
+                          'min_ms': 1000.0 * float(np.min(durations)), 'shape': list(output.shape), 'dtype': str(output.dtype) }
+        outputs[name] = output
+
+    baseline_outputs_file = os.path.splitext(args.baseline)[0] + '.npz'
+    if args.update_baseline or not os.path.isfile(args.baseline):
+        print_results(results, {}, outputs, None, args.threshold, args.exact)
+        with open(args.baseline, 'w') as f:
+            json.dump({ 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'revision': get_revision(), 'environment': get_environment(),
+                        'repeat': args.repeat, 'kernels': results }, f, indent=2)
+        np.savez_compressed(baseline_outputs_file, **outputs)
+        print(f'Baseline written to {args.baseline}')
+        return True
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    print(f'Compared to the baseline of {baseline["time"]} ({baseline.get("revision") or "unknown revision"})')
+    if baseline.get('environment') != get_environment():
+        print('The baseline was taken in a different environment, timings may not be comparable')
+    with np.load(baseline_outputs_file) as baseline_outputs:
+        failures = print_results(results, baseline['kernels'], outputs, baseline_outputs, args.threshold, args.exact)
+    return failures == 0
+
+
+def get_cases(kernels: list, resolutions: list, face_sizes: list, subsample_sizes: list) -> list:
+    """ (name, kernel, params) for every combination of the parameters a kernel depends on """
+    values = { 'resolution': resolutions, 'face_size': face_sizes, 'subsample_size': subsample_sizes }
+    cases = []
+    for kernel in kernels:
+        param_names = KERNELS[kernel][0]
+        combinations = [{}]
+        for param in param_names:
+            combinations = [dict(c, **{ param: v }) for c in combinations for v in values[param]]
+        for params in combinations:
+            description = ','.join('x'.join(str(v) for v in params[p]) if p == 'resolution' else str(params[p]) for p in param_names)
+            cases.append((f'{kernel}[{description}]', kernel, params))
+    return cases
+
+
+def measure(reset, call, repeat: int):
+    """ Durations of the calls, reset runs untimed before each of them. The first call is a warmup. """
+    durations = np.empty(max(1, repeat))
+    if reset is not None:
+        reset()
+    output = call()
+    for i in range(len(durations)):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        output = call()
+        durations[i] = time.perf_counter() - start
+    return durations, np.array(output)
+
+
+def make_frame(width: int, height: int):
+    """ Smooth BGR test frame, compresses well in the baseline """
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:, :, 0] = 64 + 128 * x * y
+    frame[:, :, 1] = 96 + 64 * np.sin(12 * x) * np.cos(8 * y)
+    frame[:, :, 2] = 200 - 150 * x
+    return frame
+
+
+def make_kps(face_size: int, center: tuple):
+    """ Face keypoints of a slightly tilted face_size face around center """
+    points = (arcface_dst - 56.0) * (face_size / 112.0)
+    angle = np.deg2rad(8.0)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]], dtype=np.float32)
+    return (points @ rotation.T + np.array(center, dtype=np.float32)).astype(np.float32)
+
+
+def make_crops(subsample_size: int):
+    """ Aligned face of subsample_size, smooth like make_frame with some fine detail """
+    crop = make_frame(subsample_size, subsample_size)
+    crop[1::2, ::3] //= 2
+    return crop
+
+
+def setup_estimate_norm(process_mgr, face_size, subsample_size):
+    kps = make_kps(face_size, (2 * face_size, 2 * face_size))
+    return None, lambda: estimate_norm(kps, subsample_size)
+
+
+def setup_implode_pixel_boost(process_mgr, subsample_size):
+    aligned = make_crops(subsample_size)
+    return None, lambda: process_mgr.implode_pixel_boost(aligned, MODEL_SIZE, subsample_size // MODEL_SIZE)
+
+
+def setup_prepare_crop_frame(process_mgr, subsample_size):
+    batch = process_mgr.implode_pixel_boost(make_crops(subsample_size), MODEL_SIZE, subsample_size // MODEL_SIZE)
+    return None, lambda: process_mgr.prepare_crop_frame(batch)
+
+
+def setup_normalize_swap_frame(process_mgr, subsample_size):
+    batch = process_mgr.implode_pixel_boost(make_crops(subsample_size), MODEL_SIZE, subsample_size // MODEL_SIZE)
+    # stands in for the swapper output, which is in 0..1
+    swapped = process_mgr.prepare_crop_frame(batch) * np.float32(0.9) + np.float32(0.05)
+    return None, lambda: process_mgr.normalize_swap_frame(swapped)
+
+
+def setup_explode_pixel_boost(process_mgr, subsample_size):
+    total = subsample_size // MODEL_SIZE
+    batch = process_mgr.implode_pixel_boost(make_crops(subsample_size), MODEL_SIZE, total)
+    swapped = process_mgr.normalize_swap_frame(process_mgr.prepare_crop_frame(batch))
+    return None, lambda: process_mgr.explode_pixel_boost(swapped, MODEL_SIZE, total, subsample_size)
+
+
+def setup_paste_upscale(process_mgr, resolution, face_size, subsample_size):
+    width, height = resolution
+    frame = make_frame(width, height)
+    target = frame.copy()
+    M = estimate_norm(make_kps(face_size, (width / 2, height / 2)), subsample_size)
+    fake_face = cv2.resize(make_crops(subsample_size), (UPSCALE_SIZE, UPSCALE_SIZE), interpolation=cv2.INTER_CUBIC)
+    scale_factor = int(UPSCALE_SIZE / subsample_size)
+
+    def reset():
+        # pastes in place
+        np.copyto(target, frame)
+
+    return reset, lambda: process_mgr.paste_upscale(fake_face, fake_face, M, target, scale_factor, MASK_OFFSETS)
+
+
+def setup_blur_area(process_mgr, resolution, face_size):
+    width, height = resolution
+    matte = np.zeros((height, width), dtype=np.uint8)
+    top = (height - face_size) // 2
+    left = (width - face_size) // 2
+    matte[top:top + face_size, left:left + face_size] = 255
+    return None, lambda: process_mgr.blur_area(matte, MASK_OFFSETS[4], MASK_OFFSETS[5])
+
+
+def setup_apply_color_transfer(process_mgr, resolution, face_size):
+    width, height = resolution
+    frame = make_frame(width, height)
+    # the padded mouth box of create_mouth_mask
+    box_width = min(width, int(0.4 * face_size) + 180)
+    box_height = min(height, int(0.15 * face_size) + 562)
+    source = np.ascontiguousarray(frame[:box_height, :box_width][::-1])
+    target = frame[height - box_height:, width - box_width:]
+    return None, lambda: process_mgr.apply_color_transfer(source, target)
+
+
+# kernel -> (parameters it depends on, setup, max. absolute output difference to the baseline)
+KERNELS = {
+    'estimate_norm': (('face_size', 'subsample_size'), setup_estimate_norm, 1e-6),
+    'implode_pixel_boost': (('subsample_size',), setup_implode_pixel_boost, 0),
+    'prepare_crop_frame': (('subsample_size',), setup_prepare_crop_frame, 1e-6),
+    'normalize_swap_frame': (('subsample_size',), setup_normalize_swap_frame, 0),
+    'explode_pixel_boost': (('subsample_size',), setup_explode_pixel_boost, 0),
+    'paste_upscale': (('resolution', 'face_size', 'subsample_size'), setup_paste_upscale, 1),
+    'blur_area': (('resolution', 'face_size'), setup_blur_area, 1),
+    'apply_color_transfer': (('resolution', 'face_size'), setup_apply_color_transfer, 1),
+}
+
+
+def compare_output(output, baseline_output, tolerance: float):
+    """ Returns (passed, description) """
+    if output.shape != baseline_output.shape:
+        return False, f'shape {output.shape} != {baseline_output.shape}'
+    if output.dtype == baseline_output.dtype and np.array_equal(output, baseline_output):
+        return True, 'exact'
+    difference = float(np.max(np.abs(output.astype(np.float64) - baseline_output.astype(np.float64))))
+    return difference <= tolerance, f'max diff {difference:.3g}'
+
+
+def print_results(results: dict, baseline: dict, outputs: dict, baseline_outputs, threshold: float, exact: bool) -> int:
+    """ Prints the results next to the baseline, returns the number of failed cases """
+    rows = [['Case', 'Median ms', 'Min ms', 'Baseline ms', 'Change', 'Output', '']]
+    failures = 0
+    for name, result in results.items():
+        before = baseline.get(name)
+        row = [name, f'{result["median_ms"]:.3f}', f'{result["min_ms"]:.3f}']
+        if before is None or baseline_outputs is None or name not in baseline_outputs:
+            rows.append(row + ['-', '-', '-', ''])
+            continue
+        change = result['median_ms'] / before['median_ms'] - 1.0
+        tolerance = 0 if exact else KERNELS[result['kernel']][2]
+        output_passed, output_description = compare_output(outputs[name], baseline_outputs[name], tolerance)
+        passed = output_passed and change <= threshold
+        failures += not passed
+        rows.append(row + [f'{before["median_ms"]:.3f}', f'{100 * change:+.1f}%', output_description, 'ok' if passed else 'FAIL'])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.ljust(width) if i == 0 else value.rjust(width) for i, (value, width) in enumerate(zip(row, widths))))
+    if baseline_outputs is not None:
+        print(f'{failures} of {len(results)} cases failed')
+    return failures
@@ -0,0 +1,278 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+import psutil
+
+import roop.globals
+from roop.benchmark import stubs
+
+MODES = ['run_batch', 'run_batch_inmem', 'live_swap']
+# RSS is sampled this often while a mode runs, for its peak
+MEMORY_INTERVAL = 0.02
+# fps drop against the previous run with the same configuration which counts as a regression
+DEFAULT_TOLERANCE = 0.1
+FPS = 25
+
+
+def add_arguments(parser):
+    parser.add_argument('--threads', help='Thread counts to measure', dest='threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--modes', help='Processing paths to measure', dest='modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--resolution', help='Frame size of the synthetic video and images, WxH', dest='resolution', default='1280x720')
+    parser.add_argument('--faces', help='Faces per frame', dest='faces', type=int, default=1)
+    parser.add_argument('--face-size', help='Face size in pixels', dest='face_size', type=int, default=200)
+    parser.add_argument('--frames', help='Frames of the synthetic video, also used for live_swap', dest='frames', type=int, default=100)
+    parser.add_argument('--images', help='Number of synthetic images for run_batch', dest='images', type=int, default=20)
+    parser.add_argument('--enhancer', help='Run the GFPGAN stand-in on every face', dest='enhancer', action='store_true')
+    parser.add_argument('--mask', help='Run the XSeg stand-in on every face', dest='mask', action='store_true')
+    parser.add_argument('--worker-mode', help='Worker mode of run_batch_inmem', dest='worker_mode', choices=['threads', 'processes'], default='threads')
+    parser.add_argument('--history', help='JSON file the results are appended to and compared against', dest='history', default='benchmark_history.json')
+    parser.add_argument('--tolerance', help='Relative fps drop reported as regression', dest='tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--label', help='Name of this run in the history, e.g. the change being measured', dest='label', default=None)
+    parser.add_argument('--workdir', help='Folder for stub models and media, kept afterwards. A temporary one by default', dest='workdir', default=None)
+
+
+def run(args) -> bool:
+    """ Measures the configured modes and thread counts on synthetic media with stub models,
+        returns False if any result regressed against the history
+    """
+    width, height = [int(v) for v in args.resolution.lower().split('x')]
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='roop_benchmark_')
+    try:
+        setup(workdir)
+        video, images = create_media(workdir, width, height, args.faces, args.face_size, args.frames, args.images)
+        options = create_options(args.enhancer, args.mask)
+        results = []
+        for mode in args.modes:
+            # live_swap processes one frame at a time, like the preview does
+            for threads in (args.threads if mode != 'live_swap' else [1]):
+                result = measure(mode, threads, options, video, images, workdir, args.worker_mode)
+                print(f'{mode} with {threads} threads: {result["fps"]:.1f} fps, peak {result["peak_rss_mb"]:.0f} MB')
+                results.append(result)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    config = { 'resolution': [width, height], 'faces': args.faces, 'face_size': args.face_size, 'frames': args.frames,
+               'images': args.images, 'enhancer': args.enhancer, 'mask': args.mask, 'worker_mode': args.worker_mode,
+               'execution_providers': roop.globals.execution_providers }
+    entry = { 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'label': args.label, 'revision': get_revision(),
+              'environment': get_environment(), 'config': config, 'results': results }
+    history = load_history(args.history)
+    previous = next((e for e in reversed(history) if e['config'] == config), None)
+    regressions = print_results(results, previous, args.tolerance)
+    history.append(entry)
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
+    print(f'Results appended to {args.history}')
+    return regressions == 0
+
+
+def setup(workdir: str):
+    models_dir = os.path.join(workdir, 'models')
+    if not os.path.isfile(os.path.join(models_dir, stubs.STUB_PACK, 'det_10g.onnx')):
+        stubs.write_stub_models(models_dir)
+    roop.globals.models_path = models_dir
+    roop.globals.CFG.face_analysis_pack = stubs.STUB_PACK
+    roop.globals.video_encoder = 'libx264'
+    roop.globals.video_quality = 14
+    roop.globals.face_swap_mode = 'all'
+    roop.globals.autorotate_faces = False
+    roop.globals.vr_mode = False
+    roop.globals.no_face_action = 0
+
+
+def create_media(workdir: str, width: int, height: int, num_faces: int, face_size: int, num_frames: int, num_images: int):
+    """ Writes a video whose faces drift a little every frame and a folder of images """
+    from roop.ffmpeg_writer import FFMPEG_VideoWriter
+
+    rng = np.random.default_rng(0)
+    background = stubs.make_background(rng, width + 64, height)
+    # faces spread over a grid of columns
+    columns = int(np.ceil(np.sqrt(num_faces * width / height)))
+    rows = int(np.ceil(num_faces / columns))
+    centers = [((i % columns + 0.5) * width / columns, (i // columns + 0.5) * height / rows) for i in range(num_faces)]
+
+    def make_frame(index):
+        # panning background, so frames differ
+        offset = index % 64
+        frame = np.ascontiguousarray(background[:, offset:offset + width])
+        for cx, cy in centers:
+            stubs.draw_face(frame, cx + 8 * np.sin(index / 10.0), cy + 4 * np.cos(index / 10.0), face_size)
+        return frame
+
+    video = os.path.join(workdir, f'synthetic_{width}x{height}_{num_faces}x{face_size}_{num_frames}.mp4')
+    if not os.path.isfile(video):
+        writer = FFMPEG_VideoWriter(video, (width, height), FPS, codec='libx264', crf=14, audiofile=None)
+        for index in range(num_frames):
+            writer.write_frame(make_frame(index))
+        writer.close()
+
+    image_dir = os.path.join(workdir, 'images')
+    shutil.rmtree(image_dir, ignore_errors=True)
+    os.makedirs(image_dir)
+    images = []
+    for index in range(num_images):
+        filename = os.path.join(image_dir, f'image_{index:04d}.png')
+        cv2.imwrite(filename, make_frame(index))
+        images.append(filename)
+    return video, images
+
+
+def create_options(enhancer: bool, mask: bool):
+    from insightface.app.common import Face
+    from roop.FaceSet import FaceSet
+    from roop.ProcessOptions import ProcessOptions
+
+    rng = np.random.default_rng(1)
+    face = Face(bbox=np.zeros(4, dtype=np.float32), kps=np.zeros((5, 2), dtype=np.float32), det_score=1.0)
+    face.embedding = rng.standard_normal(512).astype(np.float32)
+    face.mask_offsets = (0, 0, 0, 0, 1, 20)
+    faceset = FaceSet()
+    faceset.faces.append(face)
+    roop.globals.INPUT_FACESETS = [faceset]
+    roop.globals.TARGET_FACES = []
+
+    processors = { 'faceswap': {} }
+    if mask:
+        processors['mask_xseg'] = {}
+    if enhancer:
+        processors['gfpgan'] = {}
+    return ProcessOptions('InSwapper 128', processors, roop.globals.distance_threshold, roop.globals.blend_ratio,
+                          'all', 0, None, None, 1, 128, False, False)
+
+
+def measure(mode: str, threads: int, options, video: str, images: list, workdir: str, worker_mode: str) -> dict:
+    import roop.core as core
+    from roop.ProcessMgr import ProcessMgr
+
+    roop.globals.processing = True
+    roop.globals.execution_threads = threads
+    roop.globals.CFG.worker_mode = worker_mode
+    process_mgr = ProcessMgr()
+    start = time.perf_counter()
+    process_mgr.initialize(roop.globals.INPUT_FACESETS, roop.globals.TARGET_FACES, options)
+    cap = cv2.VideoCapture(video)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    # the first frame loads the face analyser and creates the sessions
+    process_mgr.process_frame(frames[0])
+    load_time = time.perf_counter() - start
+
+    output_dir = os.path.join(workdir, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+    with MemorySampler() as memory:
+        start = time.perf_counter()
+        if mode == 'run_batch':
+            targets = [os.path.join(output_dir, os.path.basename(f)) for f in images]
+            process_mgr.run_batch(images, targets, threads)
+            num_frames = len(images)
+        elif mode == 'run_batch_inmem':
+            process_mgr.run_batch_inmem('File', video, os.path.join(output_dir, 'output.mp4'), 0, len(frames), FPS, threads)
+            num_frames = len(frames)
+        else:
+            core.process_mgr = process_mgr
+            for frame in frames:
+                core.live_swap(frame, options)
+            num_frames = len(frames)
+        wall_time = time.perf_counter() - start
+    process_mgr.release_resources()
+    core.process_mgr = None
+    roop.globals.processing = False
+    return { 'mode': mode, 'threads': threads, 'frames': num_frames, 'wall_time': wall_time, 'fps': num_frames / wall_time,
+             'load_time': load_time, 'peak_rss_mb': memory.peak / 1024 / 1024 }
+
+
+
+class MemorySampler():
+    """ Polls the RSS of this process and its worker processes in the background and keeps the peak """
+
+    def __init__(self):
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+
+    def __enter__(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.sample, name='memory_sampler', daemon=True)
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *args):
+        self.stop_event.set()
+        self.thread.join()
+
+
+    def sample(self):
+        process = psutil.Process(os.getpid())
+        while True:
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak, rss)
+            if self.stop_event.wait(MEMORY_INTERVAL):
+                break
+
+
+
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_environment() -> dict:
+    import onnxruntime
+
+    return { 'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+             'memory_gb': round(psutil.virtual_memory().total / 1024 ** 3, 1), 'onnxruntime': onnxruntime.__version__,
+             'opencv': cv2.__version__, 'numpy': np.__version__ }
+
+
+def load_history(filename: str) -> list:
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def print_results(results: list, previous: dict, tolerance: float) -> int:
+    """ Prints the results next to the previous matching run, returns the number of regressions """
+    previous_results = {}
+    if previous is not None:
+        print(f'Compared to {previous["time"]} {previous.get("label") or ""} ({previous.get("revision") or "unknown revision"})')
+        previous_results = { (r['mode'], r['threads']): r for r in previous['results'] }
+
+    rows = [['Mode', 'Threads', 'Frames', 'FPS', 'Previous', 'Change', 'Peak MB', 'Load s', '']]
+    regressions = 0
+    for result in results:
+        before = previous_results.get((result['mode'], result['threads']))
+        change = None if before is None else result['fps'] / before['fps'] - 1.0
+        regressed = change is not None and change < -tolerance
+        regressions += regressed
+        rows.append([result['mode'], str(result['threads']), str(result['frames']), f'{result["fps"]:.1f}',
+                     '-' if before is None else f'{before["fps"]:.1f}', '-' if change is None else f'{100 * change:+.1f}%',
+                     f'{result["peak_rss_mb"]:.0f}', f'{result["load_time"]:.1f}', 'REGRESSION' if regressed else ''])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+    return regressions
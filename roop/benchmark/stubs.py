@@ -0,0 +1,216 @@
+"""
+Tiny ONNX stand-ins for the models and synthetic faces they can detect
+
+The stand-ins have the input and output names and shapes of the real models, so the whole
+pipeline runs with them, but compute next to nothing. The detector isn't fixed to any
+positions: a synthetic face is a square whose red channel encodes its size and whose green
+and blue channels are ramps towards its center. Every detector cell fully inside a square
+decodes the same box and keypoints from its averages, NMS keeps one of them.
+"""
+
+import os
+
+import numpy as np
+import onnx
+
+from onnx import helper, numpy_helper, TensorProto
+
+STUB_PACK = 'benchmark_stubs'
+OPSET = 13
+IR_VERSION = 8
+# red values above this are faces, the background stays below BACKGROUND_MAX_RED
+FACE_MIN_RED = 160
+BACKGROUND_MAX_RED = 100
+# keypoints (eyes, nose, mouth corners) relative to the face center in half face sizes, like the arcface template
+KEYPOINTS = np.array([[-0.316, -0.077], [0.313, -0.080], [0.0, 0.281], [-0.258, 0.649], [0.263, 0.646]], dtype=np.float32)
+
+
+def write_stub_models(models_dir: str):
+    """ Writes the swapper, enhancer and mask stand-ins into models_dir and the face analysis ones into models_dir/STUB_PACK """
+    pack_dir = os.path.join(models_dir, STUB_PACK)
+    os.makedirs(pack_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    save_model(make_swapper(rng), os.path.join(models_dir, 'inswapper_128.onnx'))
+    save_model(make_image_model('input', '1288', [1, 3, 512, 512], 'gfpgan'), os.path.join(models_dir, 'GFPGANv1.4.onnx'))
+    save_model(make_xseg(), os.path.join(models_dir, 'xseg.onnx'))
+    save_model(make_detector(), os.path.join(pack_dir, 'det_10g.onnx'))
+    save_model(make_pooled_linear(rng, 192, 212, 'landmark_2d_106'), os.path.join(pack_dir, '2d106det.onnx'))
+    save_model(make_pooled_linear(rng, 192, 3309, 'landmark_3d_68'), os.path.join(pack_dir, '1k3d68.onnx'))
+    save_model(make_pooled_linear(rng, 96, 3, 'genderage'), os.path.join(pack_dir, 'genderage.onnx'))
+    save_model(make_pooled_linear(rng, 112, 512, 'recognition'), os.path.join(pack_dir, 'w600k_r50.onnx'))
+
+
+def save_model(graph, filename: str):
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', OPSET)])
+    model.ir_version = IR_VERSION
+    onnx.checker.check_model(model)
+    onnx.save(model, filename)
+
+
+def const(name: str, value):
+    """ Initializer, int64 for ints like axes and shapes, float32 otherwise """
+    value = np.asarray(value)
+    return numpy_helper.from_array(value.astype(np.int64 if value.dtype.kind == 'i' else np.float32), name)
+
+
+def make_swapper(rng):
+    """ inswapper_128: target [N,3,128,128], source latent [N,512] -> output [N,3,128,128].
+        The emap has to be the last initializer, it is read from there.
+    """
+    emap = (rng.standard_normal((512, 512)) * 0.05 + np.eye(512)).astype(np.float32)
+    weights = np.linspace(-0.1, 0.1, 512, dtype=np.float32).reshape(512, 1)
+    nodes = [
+        helper.make_node('MatMul', ['source', 'weights'], ['shift']),
+        helper.make_node('Unsqueeze', ['shift', 'axes'], ['shift4']),
+        helper.make_node('Mul', ['target', 'factor'], ['scaled']),
+        helper.make_node('Add', ['scaled', 'shift4'], ['output']),
+    ]
+    inputs = [helper.make_tensor_value_info('target', TensorProto.FLOAT, ['N', 3, 128, 128]),
+              helper.make_tensor_value_info('source', TensorProto.FLOAT, ['N', 512])]
+    outputs = [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['N', 3, 128, 128])]
+    initializers = [const('weights', weights), const('axes', [2, 3]), const('factor', 0.9), const('emap', emap)]
+    return helper.make_graph(nodes, 'inswapper_stub', inputs, outputs, initializers)
+
+
+def make_image_model(input_name: str, output_name: str, shape: list, name: str):
+    """ Same shaped output, slightly changed so results differ from the input """
+    nodes = [helper.make_node('Mul', [input_name, 'factor'], ['scaled']),
+             helper.make_node('Tanh', ['scaled'], [output_name])]
+    inputs = [helper.make_tensor_value_info(input_name, TensorProto.FLOAT, shape)]
+    outputs = [helper.make_tensor_value_info(output_name, TensorProto.FLOAT, shape)]
+    return helper.make_graph(nodes, f'{name}_stub', inputs, outputs, [const('factor', 0.95)])
+
+
+def make_xseg():
+    """ XSeg: NHWC face [1,256,256,3] -> mask [1,256,256,1], below the threshold so the whole face is kept """
+    nodes = [helper.make_node('ReduceMean', ['in_face:0'], ['mean'], axes=[3], keepdims=1),
+             helper.make_node('Mul', ['mean', 'factor'], ['out_mask:0'])]
+    inputs = [helper.make_tensor_value_info('in_face:0', TensorProto.FLOAT, [1, 256, 256, 3])]
+    outputs = [helper.make_tensor_value_info('out_mask:0', TensorProto.FLOAT, [1, 256, 256, 1])]
+    return helper.make_graph(nodes, 'xseg_stub', inputs, outputs, [const('factor', 0.05)])
+
+
+def make_pooled_linear(rng, input_size: int, output_size: int, name: str):
+    """ Analysis models: [N,3,size,size] -> [N,output_size], a linear function of the mean colors """
+    weights = (rng.standard_normal((3, output_size)) * 0.1).astype(np.float32)
+    bias = (rng.standard_normal(output_size) * 0.1).astype(np.float32)
+    nodes = [helper.make_node('GlobalAveragePool', ['data'], ['pooled']),
+             helper.make_node('Flatten', ['pooled'], ['flat']),
+             helper.make_node('MatMul', ['flat', 'weights'], ['projected']),
+             helper.make_node('Add', ['projected', 'bias'], ['fc1'])]
+    inputs = [helper.make_tensor_value_info('data', TensorProto.FLOAT, ['N', 3, input_size, input_size])]
+    outputs = [helper.make_tensor_value_info('fc1', TensorProto.FLOAT, ['N', output_size])]
+    return helper.make_graph(nodes, f'{name}_stub', inputs, outputs, [const('weights', weights), const('bias', bias)])
+
+
+def make_detector():
+    """ RetinaFace with 2 anchors on strides 8, 16 and 32 and keypoints: input.1 [N,3,H,W] (RGB, (x-127.5)/128)
+        -> score [K,1], bbox [K,4], kps [K,10] per stride, K = N*H/stride*W/stride*2
+    """
+    nodes = []
+    initializers = [const('channel_starts_r', [0]), const('channel_ends_r', [1]), const('channel_axis', [1]),
+                    const('width_index', 3), const('half', 0.5), const('ramp_scale', 128.0 / 127.0),
+                    const('red_scale', 128.0 / 95.0), const('red_offset', (127.5 - FACE_MIN_RED) / 95.0),
+                    const('score_gain', 40.0), const('score_threshold', 0.2)]
+    # half face size per input width: red decodes to the face size relative to the longer image side,
+    # the image is letterboxed into the square input, so its longer side spans the input width
+    nodes += [helper.make_node('Shape', ['input.1'], ['input_shape']),
+              helper.make_node('Gather', ['input_shape', 'width_index'], ['input_width_int']),
+              helper.make_node('Cast', ['input_width_int'], ['input_width'], to=TensorProto.FLOAT),
+              helper.make_node('Mul', ['input_width', 'half'], ['half_width']),
+              helper.make_node('Slice', ['input.1', 'channel_starts_r', 'channel_ends_r', 'channel_axis'], ['red']),
+              helper.make_node('Neg', ['red'], ['neg_red'])]
+
+    outputs = {}
+    for stride in (8, 16, 32):
+        s = f'_{stride}'
+        initializers += [const('stride' + s, float(stride)), const('half_stride' + s, stride / 2.0),
+                         const('kps_x' + s, KEYPOINTS[:, 0].reshape(1, 5, 1, 1)),
+                         const('kps_y' + s, KEYPOINTS[:, 1].reshape(1, 5, 1, 1))]
+        nodes += [
+            # only cells completely inside a face have a high minimum
+            helper.make_node('MaxPool', ['neg_red'], ['neg_min' + s], kernel_shape=[stride, stride], strides=[stride, stride]),
+            helper.make_node('Neg', ['neg_min' + s], ['min_red' + s]),
+            helper.make_node('Sub', ['min_red' + s, 'score_threshold'], ['score_in' + s]),
+            helper.make_node('Mul', ['score_in' + s, 'score_gain'], ['score_logit' + s]),
+            helper.make_node('Sigmoid', ['score_logit' + s], ['score_map' + s]),
+            # the ramps average to their value at the cell center
+            helper.make_node('AveragePool', ['input.1'], ['mean' + s], kernel_shape=[stride, stride], strides=[stride, stride]),
+            helper.make_node('Split', ['mean' + s], ['mean_r' + s, 'mean_g' + s, 'mean_b' + s], axis=1),
+            helper.make_node('Mul', ['mean_r' + s, 'red_scale'], ['size_scaled' + s]),
+            helper.make_node('Add', ['size_scaled' + s, 'red_offset'], ['size_rel' + s]),
+            helper.make_node('Mul', ['size_rel' + s, 'half_width'], ['half_size' + s]),
+            helper.make_node('Mul', ['mean_g' + s, 'ramp_scale'], ['dx_rel' + s]),
+            helper.make_node('Mul', ['dx_rel' + s, 'half_size' + s], ['dx_cell' + s]),
+            helper.make_node('Mul', ['mean_b' + s, 'ramp_scale'], ['dy_rel' + s]),
+            helper.make_node('Mul', ['dy_rel' + s, 'half_size' + s], ['dy_cell' + s]),
+            # offsets from the anchor, which sits at the top left corner of the cell
+            helper.make_node('Add', ['dx_cell' + s, 'half_stride' + s], ['dx' + s]),
+            helper.make_node('Add', ['dy_cell' + s, 'half_stride' + s], ['dy' + s]),
+            helper.make_node('Sub', ['half_size' + s, 'dx' + s], ['left' + s]),
+            helper.make_node('Sub', ['half_size' + s, 'dy' + s], ['top' + s]),
+            helper.make_node('Add', ['half_size' + s, 'dx' + s], ['right' + s]),
+            helper.make_node('Add', ['half_size' + s, 'dy' + s], ['bottom' + s]),
+            helper.make_node('Concat', ['left' + s, 'top' + s, 'right' + s, 'bottom' + s], ['bbox_px' + s], axis=1),
+            helper.make_node('Div', ['bbox_px' + s, 'stride' + s], ['bbox_map' + s]),
+            helper.make_node('Mul', ['half_size' + s, 'kps_x' + s], ['kx_rel' + s]),
+            helper.make_node('Add', ['kx_rel' + s, 'dx' + s], ['kx_px' + s]),
+            helper.make_node('Mul', ['half_size' + s, 'kps_y' + s], ['ky_rel' + s]),
+            helper.make_node('Add', ['ky_rel' + s, 'dy' + s], ['ky_px' + s]),
+        ]
+        # interleave x and y of the 5 keypoints
+        kps_parts = []
+        for k in range(5):
+            initializers += [const(f'kps_start_{k}' + s, [k]), const(f'kps_end_{k}' + s, [k + 1])]
+            for axis in ('x', 'y'):
+                nodes.append(helper.make_node('Slice', [f'k{axis}_px' + s, f'kps_start_{k}' + s, f'kps_end_{k}' + s, 'channel_axis'], [f'k{axis}{k}' + s]))
+                kps_parts.append(f'k{axis}{k}' + s)
+        nodes += [helper.make_node('Concat', kps_parts, ['kps_px' + s], axis=1),
+                  helper.make_node('Div', ['kps_px' + s, 'stride' + s], ['kps_map' + s])]
+
+        for kind, channels in (('score', 1), ('bbox', 4), ('kps', 10)):
+            name = f'{kind}_map' + s
+            shape_name = f'rows_{channels}'
+            anchors_name = f'anchors_{channels}'
+            if shape_name not in [i.name for i in initializers]:
+                initializers += [const(shape_name, [-1, channels]), const(anchors_name, [-1, channels])]
+            # one row per cell and image, repeated for both anchors
+            nodes += [helper.make_node('Transpose', [name], [name + '_nhwc'], perm=[0, 2, 3, 1]),
+                      helper.make_node('Reshape', [name + '_nhwc', shape_name], [name + '_rows']),
+                      helper.make_node('Concat', [name + '_rows', name + '_rows'], [name + '_pairs'], axis=1),
+                      helper.make_node('Reshape', [name + '_pairs', anchors_name], [f'out_{kind}{stride}'])]
+            outputs[f'out_{kind}{stride}'] = channels
+
+    graph_inputs = [helper.make_tensor_value_info('input.1', TensorProto.FLOAT, ['N', 3, 'H', 'W'])]
+    # insightface expects all scores first, then the boxes, then the keypoints
+    graph_outputs = [helper.make_tensor_value_info(f'out_{kind}{stride}', TensorProto.FLOAT, [None, channels])
+                     for kind, channels in (('score', 1), ('bbox', 4), ('kps', 10)) for stride in (8, 16, 32)]
+    return helper.make_graph(nodes, 'retinaface_stub', graph_inputs, graph_outputs, initializers)
+
+
+def draw_face(frame, center_x: float, center_y: float, size: int):
+    """ Draws a synthetic face of size x size pixels into the BGR frame, the stub detector finds it
+        if it covers at least two detector cells of 8 pixels in each direction
+    """
+    height, width = frame.shape[:2]
+    half = size / 2.0
+    left = max(0, int(round(center_x - half)))
+    right = min(width, int(round(center_x + half)))
+    top = max(0, int(round(center_y - half)))
+    bottom = min(height, int(round(center_y + half)))
+    if left >= right or top >= bottom:
+        return
+    xs = np.arange(left, right, dtype=np.float32) + 0.5
+    ys = np.arange(top, bottom, dtype=np.float32) + 0.5
+    relative_size = min(1.0, size / max(width, height))
+    region = frame[top:bottom, left:right]
+    region[:, :, 2] = np.uint8(round(FACE_MIN_RED + 95 * relative_size))
+    region[:, :, 1] = np.clip(127.5 + 127.0 * (center_x - xs) / half, 0, 255).astype(np.uint8)[None, :]
+    region[:, :, 0] = np.clip(127.5 + 127.0 * (center_y - ys) / half, 0, 255).astype(np.uint8)[:, None]
+
+
+def make_background(rng, width: int, height: int):
+    """ Noisy BGR background, its red channel stays below what the stub detector takes for a face """
+    background = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    background[:, :, 2] = (background[:, :, 2].astype(np.uint16) * BACKGROUND_MAX_RED // 255).astype(np.uint8)
+    return background
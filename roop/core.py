@@ -22,11 +22,13 @@ import roop.globals
 import roop.metadata
 import roop.utilities as util
 import roop.util_ffmpeg as ffmpeg
+import roop.trace_util as trace_util
 from settings import Settings
 from roop.face_util import extract_face_images
 from roop.ProcessEntry import ProcessEntry
 from roop.ProcessMgr import ProcessMgr
 from roop.ProcessOptions import ProcessOptions
+from roop.SegmentRenderer import SegmentRenderer
 from roop.capturer import get_video_frame_total, release_video
 
 
@@ -210,7 +212,7 @@ def live_swap(frame, options):
         return frame
 
     if process_mgr is None:
-        process_mgr = ProcessMgr(None)
+        process_mgr = ProcessMgr()
     
 #    if len(roop.globals.INPUT_FACESETS) <= selected_index:
 #        selected_index = 0
@@ -227,7 +229,7 @@ def batch_process_regular(swap_model, output_method, files:list[ProcessEntry], m
     release_resources()
     limit_resources()
     if process_mgr is None:
-        process_mgr = ProcessMgr(progress)
+        process_mgr = ProcessMgr()
     mask = imagemask["layers"][0] if imagemask is not None else None
     if len(roop.globals.INPUT_FACESETS) <= selected_index:
         selected_index = 0
@@ -244,7 +246,7 @@ def batch_process_with_options(files:list[ProcessEntry], options, progress):
     release_resources()
     limit_resources()
     if process_mgr is None:
-        process_mgr = ProcessMgr(progress)
+        process_mgr = ProcessMgr()
     process_mgr.initialize(roop.globals.INPUT_FACESETS, roop.globals.TARGET_FACES, options)
     roop.globals.keep_frames = False
     roop.globals.wait_after_extraction = False
@@ -311,6 +313,9 @@ def batch_process(output_method, files:list[ProcessEntry], use_new_method) -> No
                 update_status(f'Creating {os.path.basename(v.finalname)} with {fps} FPS...')
 
             start_processing = time()
+            if roop.globals.CFG.trace_processing:
+                trace_util.start_tracing()
+            audio_muxed = False
             if is_streaming_only == False and roop.globals.keep_frames or not use_new_method:
                 util.create_temp(v.filename)
                 update_status('Extracting frames...')
@@ -339,7 +344,12 @@ def batch_process(output_method, files:list[ProcessEntry], use_new_method) -> No
                     skip_audio = True
                 else:
                     skip_audio = roop.globals.skip_audio
-                process_mgr.run_batch_inmem(output_method, v.filename, v.finalname, v.startframe, v.endframe, fps,roop.globals.execution_threads)
+                # the writer copies the audio itself, restore_audio isn't needed then
+                audio_muxed = not skip_audio and not is_streaming_only
+                if roop.globals.CFG.render_segments > 1 and output_method in ("File", "Files"):
+                    SegmentRenderer(process_mgr, roop.globals.CFG.render_segments).run(v.filename, v.finalname, v.startframe, v.endframe, fps, roop.globals.execution_threads, audio_muxed)
+                else:
+                    process_mgr.run_batch_inmem(output_method, v.filename, v.finalname, v.startframe, v.endframe, fps,roop.globals.execution_threads, audio_muxed)
                 
             if not roop.globals.processing:
                 end_processing('Processing stopped!')
@@ -362,13 +372,18 @@ def batch_process(output_method, files:list[ProcessEntry], use_new_method) -> No
                     destination = util.replace_template(video_file_name, index=index)
                     pathlib.Path(os.path.dirname(destination)).mkdir(parents=True, exist_ok=True)
 
-                    if not skip_audio:
+                    if not skip_audio and not audio_muxed:
                         ffmpeg.restore_audio(video_file_name, v.filename, v.startframe, v.endframe, destination)
                         if os.path.isfile(destination):
                             os.remove(video_file_name)
                     else:
                         shutil.move(video_file_name, destination)
 
+                if roop.globals.CFG.timing_report:
+                    process_mgr.timer.save_report(os.path.splitext(destination)[0] + '_timings.json', v.endframe - v.startframe)
+                if roop.globals.tracing:
+                    trace_util.stop_tracing(os.path.splitext(destination)[0] + '_trace.json')
+
             elif is_streaming_only == False:
                 update_status(f'Failed processing {os.path.basename(v.finalname)}!')
             elapsed_time = time() - start_processing
@@ -379,6 +394,9 @@ def batch_process(output_method, files:list[ProcessEntry], use_new_method) -> No
 
 def end_processing(msg:str):
     update_status(msg)
+    if roop.globals.CFG.trace_processing:
+        # a stopped job leaves no trace, stop recording anyway
+        trace_util.stop_tracing()
     roop.globals.target_folder_path = None
     release_resources()
 
@@ -400,6 +418,7 @@ def run() -> None:
     roop.globals.video_encoder = roop.globals.CFG.output_video_codec
     roop.globals.video_quality = roop.globals.CFG.video_quality
     roop.globals.max_memory = roop.globals.CFG.memory_limit if roop.globals.CFG.memory_limit > 0 else None
+    roop.globals.cascade_detection = roop.globals.CFG.cascade_detection
     if roop.globals.startup_args.server_share:
         roop.globals.CFG.server_share = True
     main.run()
@@ -1,3 +1,5 @@
+import glob
+import os
 import threading
 from typing import Any
 import insightface
@@ -8,58 +10,381 @@ from roop.typing import Frame, Face
 import cv2
 import numpy as np
 from skimage import transform as trans
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.attribute import Attribute
+from insightface.model_zoo import model_zoo
+from insightface.model_zoo.landmark import Landmark
+from insightface.model_zoo.retinaface import distance2bbox, distance2kps
+from insightface.utils.face_align import norm_crop
+from insightface.utils.transform import estimate_affine_matrix_3d23d, P2sRt, matrix2angle
 from roop.capturer import get_video_frame
-from roop.utilities import resolve_relative_path, conditional_thread_semaphore
+from roop.utilities import resolve_model_path, conditional_thread_semaphore
 
 FACE_ANALYSER = None
-#THREAD_LOCK_ANALYSER = threading.Lock()
+FACE_ANALYSER_PACK = None
+THREAD_LOCK_ANALYSER = threading.Lock()
 #THREAD_LOCK_SWAPPER = threading.Lock()
 FACE_SWAPPER = None
 
-
-def get_face_analyser() -> Any:
-    global FACE_ANALYSER
-
-    with conditional_thread_semaphore():
-        if FACE_ANALYSER is None or roop.globals.g_current_face_analysis != roop.globals.g_desired_face_analysis:
-            model_path = resolve_relative_path('..')
-            # removed genderage
-            allowed_modules = roop.globals.g_desired_face_analysis
-            roop.globals.g_current_face_analysis = roop.globals.g_desired_face_analysis
+# modules of a whole model pack, used when no subset was requested and for building face sets
+FULL_FACE_ANALYSIS = ["detection", "recognition", "landmark_2d_106", "landmark_3d_68", "genderage"]
+# onnx file -> taskname of the models in the pack seen so far
+MODEL_FILE_TASKS = {}
+# requested modules the model pack doesn't have
+UNAVAILABLE_MODULES = set()
+
+# cascade detection: size the frame is scaled down to for the coarse pass, padding around a coarse hit,
+# relative to its size, and detector size for the full resolution crops
+CASCADE_COARSE_SIZE = (320, 320)
+CASCADE_CROP_PADDING = 0.5
+CASCADE_REFINE_SIZE = (320, 320)
+# model files whose sessions failed to run a batch, they get one image per run
+SINGLE_IMAGE_MODELS = set()
+
+
+def get_face_analyser(modules: list = None) -> Any:
+    """ Returns the face analyser of the configured model pack with at least the analysis modules in
+        'modules' loaded, by default the ones in roop.globals.g_desired_face_analysis. Modules it
+        doesn't have yet are added to the existing analyser instead of creating a new one.
+    """
+    global FACE_ANALYSER, FACE_ANALYSER_PACK
+
+    modules = get_analysis_modules(modules)
+    pack = roop.globals.CFG.face_analysis_pack
+    if (FACE_ANALYSER is not None and FACE_ANALYSER_PACK == pack
+            and not any(m not in FACE_ANALYSER.models and m not in UNAVAILABLE_MODULES for m in modules)):
+        return FACE_ANALYSER
+
+    with conditional_thread_semaphore(), THREAD_LOCK_ANALYSER:
+        if FACE_ANALYSER is None or FACE_ANALYSER_PACK != pack:
             if roop.globals.CFG.force_cpu:
                 print("Forcing CPU for Face Analysis")
-                FACE_ANALYSER = insightface.app.FaceAnalysis(
-                    name="buffalo_l",
-                    root=model_path, providers=["CPUExecutionProvider"],allowed_modules=allowed_modules
-                )
-            else:
-                FACE_ANALYSER = insightface.app.FaceAnalysis(
-                    name="buffalo_l", root=model_path, providers=roop.globals.execution_providers,allowed_modules=allowed_modules
-                )
-            FACE_ANALYSER.prepare(
-                ctx_id=0,
-                det_size=(640, 640) if roop.globals.default_det_size else (320, 320),
-            )
+            FACE_ANALYSER = create_face_analyser(pack, modules, get_analyser_providers())
+            FACE_ANALYSER_PACK = pack
+            UNAVAILABLE_MODULES.clear()
+        else:
+            load_analysis_modules(FACE_ANALYSER, modules)
+        for taskname in modules:
+            if taskname not in FACE_ANALYSER.models:
+                UNAVAILABLE_MODULES.add(taskname)
+        roop.globals.g_current_face_analysis = list(FACE_ANALYSER.models.keys())
     return FACE_ANALYSER
 
 
-def get_first_face(frame: Frame) -> Any:
+def create_face_analyser(pack: str, modules: list, providers: list) -> Any:
+    """ Loads the modules of an insightface model pack from models/<pack>. The official packs are
+        downloaded when missing, any other folder there with a detector and e.g. a recognizer works too.
+    """
+    # insightface looks for <root>/models/<pack>
+    model_path = os.path.dirname(os.path.dirname(resolve_model_path(pack)))
+    analyser = insightface.app.FaceAnalysis(
+        name=pack, root=model_path, providers=providers, allowed_modules=modules
+    )
+    analyser.prepare(
+        ctx_id=0,
+        det_size=(640, 640) if roop.globals.default_det_size else (320, 320),
+    )
+    for model in analyser.models.values():
+        MODEL_FILE_TASKS[model.model_file] = model.taskname
+    return analyser
+
+
+def get_analyser_providers() -> list:
+    if roop.globals.CFG.force_cpu:
+        return ["CPUExecutionProvider"]
+    return roop.globals.execution_providers
+
+
+def get_analysis_modules(modules: list = None) -> list:
+    if modules is None:
+        modules = roop.globals.g_desired_face_analysis
+    if modules is None:
+        return FULL_FACE_ANALYSIS
+    return modules
+
+
+def load_analysis_modules(analyser, modules: list):
+    """ Loads the models of the missing modules from the analyser's model pack and prepares them """
+    models = dict(analyser.models)
+    for onnx_file in sorted(glob.glob(os.path.join(analyser.model_dir, '*.onnx'))):
+        taskname = MODEL_FILE_TASKS.get(onnx_file)
+        if taskname is not None and (taskname in models or taskname not in modules):
+            continue
+        model = model_zoo.get_model(onnx_file, providers=get_analyser_providers())
+        if model is None:
+            continue
+        MODEL_FILE_TASKS[onnx_file] = model.taskname
+        if model.taskname in models or model.taskname not in modules:
+            del model
+            continue
+        print(f'Loading face analysis module {model.taskname}')
+        model.prepare(ctx_id=0)
+        models[model.taskname] = model
+    # replaced as a whole, so threads iterating over the old models aren't disturbed
+    analyser.models = models
+
+
+def get_analysis_models(modules: list = None) -> list:
+    """ The loaded analysis models of the requested modules, without the detector """
+    analyser = get_face_analyser(modules)
+    modules = get_analysis_modules(modules)
+    return [model for taskname, model in analyser.models.items() if taskname != 'detection' and taskname in modules]
+
+
+def get_first_face(frame: Frame, modules: list = None) -> Any:
     try:
-        faces = get_face_analyser().get(frame)
+        faces = analyse_frame(frame, modules)
         return min(faces, key=lambda x: x.bbox[0])
     #   return sorted(faces, reverse=True, key=lambda x: (x.bbox[2] - x.bbox[0]) * (x.bbox[3] - x.bbox[1]))[0]
     except:
         return None
 
 
-def get_all_faces(frame: Frame) -> Any:
+def get_all_faces(frame: Frame, modules: list = None) -> Any:
+    try:
+        faces = analyse_frame(frame, modules)
+        return sorted(faces, key=lambda x: x.bbox[0])
+    except:
+        return None
+
+
+def analyse_frame(frame: Frame, modules: list = None) -> list:
+    if roop.globals.cascade_detection:
+        faces = cascade_detect(frame)
+    else:
+        faces = faces_from_detection(*get_face_analyser(modules).det_model.detect(frame, max_num=0, metric='default'))
+    for face in faces:
+        analyse_face(frame, face, modules=modules)
+    return faces
+
+
+def detect_faces(frame: Frame) -> Any:
+    """ Runs only the detector, the faces just have bbox, kps and det_score until analyse_face is called """
     try:
-        faces = get_face_analyser().get(frame)
+        if roop.globals.cascade_detection:
+            faces = cascade_detect(frame)
+        else:
+            faces = faces_from_detection(*get_face_analyser().det_model.detect(frame, max_num=0, metric='default'))
         return sorted(faces, key=lambda x: x.bbox[0])
     except:
         return None
 
 
+def faces_from_detection(bboxes, kpss, offset = (0, 0)) -> list:
+    faces = []
+    for i in range(bboxes.shape[0]):
+        bbox = bboxes[i, 0:4] + np.array([offset[0], offset[1], offset[0], offset[1]], dtype=np.float32)
+        kps = kpss[i] + np.array(offset, dtype=np.float32) if kpss is not None else None
+        faces.append(Face(bbox=bbox, kps=kps, det_score=bboxes[i, 4]))
+    return faces
+
+
+def cascade_detect(frame: Frame) -> list:
+    """ Finds candidate faces on a copy of the frame scaled down to CASCADE_COARSE_SIZE, then detects
+        each of them again on a padded full resolution crop around it for exact bboxes and kps.
+        Subsequent analysis models already cut their input from the full resolution frame.
+    """
+    det_model = get_face_analyser().det_model
+    scale = min(CASCADE_COARSE_SIZE[0] / frame.shape[1], CASCADE_COARSE_SIZE[1] / frame.shape[0], 1.0)
+    small_frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else frame
+    bboxes, kpss = det_model.detect(small_frame, input_size=CASCADE_COARSE_SIZE, max_num=0, metric='default')
+    bboxes[:, 0:4] /= scale
+    if kpss is not None:
+        kpss /= scale
+    coarse_faces = faces_from_detection(bboxes, kpss)
+    faces = []
+    for coarse_face in coarse_faces:
+        (startX, startY, endX, endY) = coarse_face.bbox
+        padding = int(max(endX - startX, endY - startY) * CASCADE_CROP_PADDING)
+        startX, endX, startY, endY = clamp_cut_values(int(startX) - padding, int(endX) + padding, int(startY) - padding, int(endY) + padding, frame)
+        crop = frame[startY:endY, startX:endX]
+        if crop.size == 0:
+            faces.append(coarse_face)
+            continue
+        refined_faces = faces_from_detection(*det_model.detect(crop, input_size=CASCADE_REFINE_SIZE, max_num=0, metric='default'), offset=(startX, startY))
+        # keep the coarse result if the crop doesn't contain a better one
+        best_face = max(refined_faces, key=lambda f: bbox_overlap(f.bbox, coarse_face.bbox), default=None)
+        if best_face is None or bbox_overlap(best_face.bbox, coarse_face.bbox) <= 0:
+            best_face = coarse_face
+        faces.append(best_face)
+    return faces
+
+
+def bbox_overlap(a, b) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    return float(width * height)
+
+
+def analyse_face(frame: Frame, face: Face, skip_tasks = None, modules: list = None):
+    """ Runs the analysis models of the requested modules except the ones in skip_tasks on a detected face """
+    for model in get_analysis_models(modules):
+        if skip_tasks is not None and model.taskname in skip_tasks:
+            continue
+        model.get(frame, face)
+
+
+def get_all_faces_batch(frames: list) -> list:
+    """ Like get_all_faces for several frames at once. Instead of going through FaceAnalysis.get,
+        the detector runs once for all frames and every analysis model runs once for all faces
+        found in them. Returns the sorted faces of each frame.
+    """
+    try:
+        analyser = get_face_analyser()
+        if roop.globals.cascade_detection:
+            faces_per_frame = [cascade_detect(frame) for frame in frames]
+        else:
+            faces_per_frame = detect_batch(analyser.det_model, frames)
+        for model in get_analysis_models():
+            analyse_batch(model, frames, faces_per_frame)
+        return [sorted(faces, key=lambda x: x.bbox[0]) for faces in faces_per_frame]
+    except:
+        return [get_all_faces(frame) for frame in frames]
+
+
+def run_model_batch(model, blob) -> list:
+    """ Runs a batch of blobs through the session of an insightface model, one by one if it doesn't take batches """
+    if len(blob) > 1 and model.model_file not in SINGLE_IMAGE_MODELS:
+        try:
+            return model.session.run(model.output_names, {model.input_name : blob})
+        except Exception:
+            # exported with a fixed batch size of 1
+            SINGLE_IMAGE_MODELS.add(model.model_file)
+    net_outs = [model.session.run(model.output_names, {model.input_name : blob[i:i+1]}) for i in range(len(blob))]
+    return [np.concatenate(outs) for outs in zip(*net_outs)]
+
+
+def detect_batch(det_model, frames: list) -> list:
+    """ Same as det_model.detect(frame, max_num=0) for every frame, with a single detector run """
+    input_size = det_model.input_size
+    det_imgs = []
+    det_scales = []
+    for frame in frames:
+        im_ratio = float(frame.shape[0]) / frame.shape[1]
+        model_ratio = float(input_size[1]) / input_size[0]
+        if im_ratio > model_ratio:
+            new_height = input_size[1]
+            new_width = int(new_height / im_ratio)
+        else:
+            new_width = input_size[0]
+            new_height = int(new_width * im_ratio)
+        det_img = np.zeros((input_size[1], input_size[0], 3), dtype=np.uint8)
+        det_img[:new_height, :new_width, :] = cv2.resize(frame, (new_width, new_height))
+        det_imgs.append(det_img)
+        det_scales.append(float(new_height) / frame.shape[0])
+
+    blob = cv2.dnn.blobFromImages(det_imgs, 1.0/det_model.input_std, input_size, (det_model.input_mean, det_model.input_mean, det_model.input_mean), swapRB=True)
+    net_outs = run_model_batch(det_model, blob)
+    faces_per_frame = []
+    for i, det_scale in enumerate(det_scales):
+        # models exported without a batch dimension put the anchors of all images after each other
+        frame_outs = [out[i] if out.ndim == 3 else np.split(out, len(frames))[i] for out in net_outs]
+        bboxes, kpss = decode_detection(det_model, frame_outs, input_size, det_scale)
+        faces_per_frame.append(faces_from_detection(bboxes, kpss))
+    return faces_per_frame
+
+
+def decode_detection(det_model, net_outs, input_size, det_scale):
+    """ Turns the raw outputs of the RetinaFace/SCRFD detector for one image into bboxes and kps, like RetinaFace.forward and detect """
+    scores_list = []
+    bboxes_list = []
+    kpss_list = []
+    fmc = det_model.fmc
+    for idx, stride in enumerate(det_model._feat_stride_fpn):
+        scores = net_outs[idx]
+        bbox_preds = net_outs[idx+fmc] * stride
+        height = input_size[1] // stride
+        width = input_size[0] // stride
+        key = (height, width, stride)
+        anchor_centers = det_model.center_cache.get(key)
+        if anchor_centers is None:
+            anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+            anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+            if det_model._num_anchors > 1:
+                anchor_centers = np.stack([anchor_centers] * det_model._num_anchors, axis=1).reshape((-1, 2))
+            if len(det_model.center_cache) < 100:
+                det_model.center_cache[key] = anchor_centers
+
+        pos_inds = np.where(scores >= det_model.det_thresh)[0]
+        scores_list.append(scores[pos_inds])
+        bboxes_list.append(distance2bbox(anchor_centers, bbox_preds)[pos_inds])
+        if det_model.use_kps:
+            kpss = distance2kps(anchor_centers, net_outs[idx+fmc*2] * stride)
+            kpss_list.append(kpss.reshape((kpss.shape[0], -1, 2))[pos_inds])
+
+    scores = np.vstack(scores_list)
+    order = scores.ravel().argsort()[::-1]
+    bboxes = np.vstack(bboxes_list) / det_scale
+    pre_det = np.hstack((bboxes, scores)).astype(np.float32, copy=False)
+    pre_det = pre_det[order, :]
+    keep = det_model.nms(pre_det)
+    kpss = None
+    if det_model.use_kps:
+        kpss = (np.vstack(kpss_list) / det_scale)[order, :, :][keep, :, :]
+    return pre_det[keep, :], kpss
+
+
+def analyse_batch(model, frames: list, faces_per_frame: list):
+    """ Runs an analysis model on all faces of all frames at once, setting the same attributes as model.get """
+    jobs = [(frame, face) for frame, faces in zip(frames, faces_per_frame) for face in faces]
+    if len(jobs) == 0:
+        return
+    if not isinstance(model, (ArcFaceONNX, Attribute, Landmark)):
+        for frame, face in jobs:
+            model.get(frame, face)
+        return
+
+    crops = []
+    matrices = []
+    for frame, face in jobs:
+        if isinstance(model, ArcFaceONNX):
+            crops.append(norm_crop(frame, landmark=face.kps, image_size=model.input_size[0]))
+            continue
+        bbox = face.bbox
+        w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
+        center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
+        _scale = model.input_size[0] / (max(w, h)*1.5)
+        aimg, M = transform(frame, center, model.input_size[0], _scale, 0)
+        crops.append(aimg)
+        matrices.append(M)
+    blob = cv2.dnn.blobFromImages(crops, 1.0/model.input_std, model.input_size, (model.input_mean, model.input_mean, model.input_mean), swapRB=True)
+    preds = run_model_batch(model, blob)[0]
+
+    for i, (frame, face) in enumerate(jobs):
+        pred = preds[i]
+        if isinstance(model, ArcFaceONNX):
+            face.embedding = pred.flatten()
+        elif isinstance(model, Attribute):
+            if model.taskname == 'genderage':
+                face['gender'] = np.argmax(pred[:2])
+                face['age'] = int(np.round(pred[2]*100))
+        else:
+            face[model.taskname] = get_landmarks(model, pred, matrices[i])
+            if model.require_pose:
+                P = estimate_affine_matrix_3d23d(model.mean_lmk, face[model.taskname])
+                s, R, t = P2sRt(P)
+                rx, ry, rz = matrix2angle(R)
+                face['pose'] = np.array([rx, ry, rz], dtype=np.float32)
+
+
+def get_landmarks(model, pred, M):
+    """ Landmarks in frame coordinates from the prediction of a landmark model for a crop cut with M """
+    if pred.shape[0] >= 3000:
+        pred = pred.reshape((-1, 3))
+    else:
+        pred = pred.reshape((-1, 2))
+    if model.lmk_num < pred.shape[0]:
+        pred = pred[model.lmk_num*-1:,:]
+    pred[:, 0:2] += 1
+    pred[:, 0:2] *= (model.input_size[0] // 2)
+    if pred.shape[1] == 3:
+        pred[:, 2] *= (model.input_size[0] // 2)
+    IM = cv2.invertAffineTransform(M)
+    return trans_points(pred, IM)
+
+
 def extract_face_images(source_filename, video_info, extra_padding=-1.0):
     face_data = []
     source_image = None
@@ -73,7 +398,8 @@ def extract_face_images(source_filename, video_info, extra_padding=-1.0):
     else:
         source_image = cv2.imdecode(np.fromfile(source_filename, dtype=np.uint8), cv2.IMREAD_COLOR)
 
-    faces = get_all_faces(source_image)
+    # face sets need the embedding and every other attribute, whatever the last job requested
+    faces = get_all_faces(source_image, FULL_FACE_ANALYSIS)
     if faces is None:
         return face_data
 
@@ -109,7 +435,7 @@ def extract_face_images(source_filename, video_info, extra_padding=-1.0):
                 )
                 face_temp = source_image[startY:endY, startX:endX]
                 face_temp = resize_image_keep_content(face_temp)
-                testfaces = get_all_faces(face_temp)
+                testfaces = get_all_faces(face_temp, FULL_FACE_ANALYSIS)
                 if testfaces is not None and len(testfaces) > 0:
                     i += 1
                     face_data.append([testfaces[0], face_temp])
@@ -0,0 +1,156 @@
+"""
+FFMPEG_VideoReader - read the frames of a video file through an ffmpeg pipe
+
+counterpart of FFMPEG_VideoWriter, seeks on the input side and lets
+ffmpeg decode with all cores while the frames are read as raw bgr24
+"""
+
+import os
+import subprocess as sp
+
+from collections import deque
+from threading import Thread
+
+import numpy as np
+
+FFMPEG_BINARY = "ffmpeg"
+
+
+class FFMPEG_VideoReader:
+    """ A class for FFMPEG-based video reading.
+
+    Behaves like a cv2.VideoCapture which is already positioned at the first
+    wanted frame, read() returns (ret, frame) and read_into() decodes the next
+    frame straight into an existing array, e.g. a shared memory slot.
+
+    Parameters
+    -----------
+
+    filename
+      Any video file ffmpeg can decode.
+
+    size
+      Size (width,height) of the frames, the decoded video is scaled
+      to it if it differs.
+
+    fps
+      Frame rate of the video, used to turn start_frame into a timestamp.
+
+    start_frame
+      Index of the first frame to read. ffmpeg seeks to the keyframe before
+      it and decodes from there, so starting in the middle of a long video
+      doesn't decode everything in front of it.
+
+    num_frames
+      Max. number of frames to read, None reads until the end.
+
+    threads
+      Decoder threads, 0 lets ffmpeg use all cores.
+
+    """
+
+    def __init__(self, filename, size, fps, start_frame=0, num_frames=None, threads=0):
+        self.filename = filename
+        self.size = size
+        self.frame_shape = (size[1], size[0], 3)
+        self.frame_bytes = int(np.prod(self.frame_shape))
+        self.messages = deque(maxlen=20)
+        self.finished = False
+
+        cmd = [
+            FFMPEG_BINARY,
+            '-hide_banner',
+            '-loglevel', 'error',
+            '-threads', str(threads),
+        ]
+        if start_frame > 0:
+            cmd.extend(['-ss', '%.6f' % (start_frame / fps)])
+        cmd.extend([
+            '-i', filename,
+            '-an', '-sn', '-dn',
+        ])
+        if num_frames is not None:
+            cmd.extend(['-frames:v', str(num_frames)])
+        cmd.extend([
+            # every decoded frame once, without adjusting to a constant frame rate
+            '-vsync', 'passthrough',
+            '-s', '%dx%d' % (size[0], size[1]),
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-'
+        ])
+
+        popen_params = {"stdout": sp.PIPE,
+                        "stderr": sp.PIPE,
+                        "stdin": sp.DEVNULL,
+                        "bufsize": self.frame_bytes}
+
+        # This was added so that no extra unwanted window opens on windows
+        # when the child process is created
+        if os.name == "nt":
+            popen_params["creationflags"] = 0x08000000  # CREATE_NO_WINDOW
+
+        self.proc = sp.Popen(cmd, **popen_params)
+        # errors of a damaged file would otherwise fill the pipe and block ffmpeg
+        self.stderr_thread = Thread(target=self.read_messages, daemon=True)
+        self.stderr_thread.start()
+
+
+    def read_messages(self):
+        for line in self.proc.stderr:
+            self.messages.append(line.decode(errors='replace').rstrip())
+
+
+    def read(self):
+        """ Returns (True, frame) for the next frame or (False, None) at the end """
+        frame = np.empty(self.frame_shape, dtype=np.uint8)
+        if not self.read_into(frame):
+            return False, None
+        return True, frame
+
+
+    def read_into(self, frame) -> bool:
+        """ Reads the next frame into the contiguous uint8 array frame, False at the end """
+        if self.proc is None or self.finished:
+            return False
+        buffer = memoryview(frame).cast('B')
+        num_read = 0
+        while num_read < self.frame_bytes:
+            n = self.proc.stdout.readinto(buffer[num_read:])
+            if not n:
+                self.finish()
+                return False
+            num_read += n
+        return True
+
+
+    def finish(self):
+        self.finished = True
+        self.proc.wait()
+        self.stderr_thread.join(timeout=1)
+        if self.proc.returncode != 0:
+            print(f'ffmpeg failed reading {self.filename}:')
+            print('\n'.join(self.messages))
+
+
+    def isOpened(self) -> bool:
+        return self.proc is not None
+
+
+    def release(self):
+        if self.proc:
+            self.proc.stdout.close()
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.wait()
+            self.stderr_thread.join(timeout=1)
+            self.proc.stderr.close()
+        self.proc = None
+
+    # Support the Context Manager protocol, to ensure that resources are cleaned up.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
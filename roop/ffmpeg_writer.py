@@ -14,6 +14,12 @@ Copyright (c) 2023 Janvarev Vladislav
 
 import os
 import subprocess as sp
+import time
+
+from collections import deque
+from threading import Thread
+
+import numpy as np
 
 PIPE = -1
 STDOUT = -2
@@ -55,7 +61,10 @@ class FFMPEG_VideoWriter:
 
     audiofile
       Optional: The name of an audio file that will be incorporated
-      to the video.
+      to the video. Can also be a video, its first audio stream is used.
+
+    audio_start, audio_end
+      Optional: Part of the audio file to use, in seconds.
 
     preset
       Sets the time that FFMPEG will take to compress the video. The slower,
@@ -70,7 +79,7 @@ class FFMPEG_VideoWriter:
     """
 
     def __init__(self, filename, size, fps, codec="libx265", crf=14, audiofile=None,
-                 preset="medium", bitrate=None,
+                 audio_start=None, audio_end=None, preset="medium", bitrate=None,
                  logfile=None, threads=None, ffmpeg_params=['-movflags', 'faststart']):
 
         if logfile is None:
@@ -100,9 +109,16 @@ class FFMPEG_VideoWriter:
         ]
 
         if audiofile is not None:
+            # the audio is cut on the input side and copied along with the encoded frames
+            if audio_start is not None:
+                cmd.extend(['-ss', format(audio_start, ".2f")])
+            if audio_end is not None:
+                cmd.extend(['-to', format(audio_end, ".2f")])
             cmd.extend([
                 '-i', audiofile,
-                '-acodec', 'copy'
+                '-map', '0:v:0', '-map', '1:a:0?',
+                '-acodec', 'copy',
+                '-shortest'
             ])
 
         cmd.extend([
@@ -134,9 +150,11 @@ class FFMPEG_VideoWriter:
         test = str(cmd)
         print(test)
 
+        # unbuffered, frames go from their own memory straight into the pipe
         popen_params = {"stdout": DEVNULL,
                         "stderr": logfile,
-                        "stdin": sp.PIPE}
+                        "stdin": sp.PIPE,
+                        "bufsize": 0}
 
         # This was added so that no extra unwanted window opens on windows
         # when the child process is created
@@ -144,17 +162,40 @@ class FFMPEG_VideoWriter:
             popen_params["creationflags"] = 0x08000000  # CREATE_NO_WINDOW
         
         self.proc = sp.Popen(cmd, **popen_params)
+        self.stdin_fd = self.proc.stdin.fileno()
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.blocked_time = 0.0
+        self.start_time = None
+        self.last_write_time = None
+        # a chatty ffmpeg would block as soon as the stderr pipe is full
+        self.messages = deque(maxlen=50)
+        self.stderr_thread = None
+        if self.proc.stderr is not None:
+            self.stderr_thread = Thread(target=self.read_messages, daemon=True)
+            self.stderr_thread.start()
+
+
+    def read_messages(self):
+        for line in self.proc.stderr:
+            self.messages.append(line)
 
 
     def write_frame(self, img_array):
         """ Writes one frame in the file."""
+        # only frames which aren't contiguous (e.g. rotated views) get copied
+        frame = np.ascontiguousarray(img_array)
+        data = memoryview(frame).cast('B')
+        start = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = start
         try:
-            #if PY3:
-            self.proc.stdin.write(img_array.tobytes())
-            # else:
-            #    self.proc.stdin.write(img_array.tostring())
+            self.write_data(data)
         except IOError as err:
-            _, ffmpeg_error = self.proc.communicate()
+            self.proc.wait()
+            if self.stderr_thread is not None:
+                self.stderr_thread.join(timeout=1)
+            ffmpeg_error = b"".join(self.messages)
             error = (str(err) + ("\n\nroop unleashed error: FFMPEG encountered "
                                  "the following error while writing file %s:"
                                  "\n\n %s" % (self.filename, str(ffmpeg_error))))
@@ -195,13 +236,44 @@ class FFMPEG_VideoWriter:
 
 
             raise IOError(error)
+        self.last_write_time = time.perf_counter()
+        self.blocked_time += self.last_write_time - start
+        self.frames_written += 1
+        self.bytes_written += len(data)
+
+
+    def write_data(self, data):
+        # the pipe may take less than a whole frame at once
+        while len(data) > 0:
+            if hasattr(os, 'writev'):
+                num_written = os.writev(self.stdin_fd, [data])
+            else:
+                num_written = self.proc.stdin.write(data)
+            data = data[num_written:]
+
+
+    def get_stats(self) -> dict:
+        """ Throughput into the encoder and the time spent waiting for it to take the frames """
+        elapsed = self.last_write_time - self.start_time if self.start_time is not None else 0.0
+        return { 'frames': self.frames_written,
+                 'bytes': self.bytes_written,
+                 'seconds': elapsed,
+                 'bytes_per_second': self.bytes_written / elapsed if elapsed > 0 else 0.0,
+                 'blocked_seconds': self.blocked_time }
+
 
     def close(self):
         if self.proc:
             self.proc.stdin.close()
+            self.proc.wait()
+            if self.stderr_thread is not None:
+                self.stderr_thread.join(timeout=1)
             if self.proc.stderr is not None:
                 self.proc.stderr.close()
-            self.proc.wait()
+            if self.frames_written > 0:
+                stats = self.get_stats()
+                print(f"Encoder: {stats['frames']} frames, {stats['bytes'] / 1024**2:.0f} MB in {stats['seconds']:.1f}s "
+                      f"({stats['bytes_per_second'] / 1024**2:.1f} MB/s), blocked {stats['blocked_seconds']:.1f}s")
 
         self.proc = None
 
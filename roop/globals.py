@@ -33,10 +33,14 @@ face_swap_mode = None
 blend_ratio = 0.5
 distance_threshold = 0.65
 default_det_size = True
+# detect on the scaled down frame first, then refine every hit on a full resolution crop
+cascade_detection = False
 
 no_face_action = 0
 
 processing = False
+# spans are recorded for a trace, see trace_util
+tracing = False
 
 g_current_face_analysis = None
 g_desired_face_analysis = None
@@ -53,4 +57,8 @@ BATCH_IMAGE_CHAIN_PROCESSOR = None
 
 CFG: Settings = None
 
+# folder to load the models from instead of models/, e.g. stand-ins for benchmarks.
+# insightface only finds packs in a folder named 'models'
+models_path = None
+
 
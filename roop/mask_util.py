@@ -0,0 +1,77 @@
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+# mouth masks are built for box sizes rounded up to this and resized to the exact box
+MOUTH_MASK_QUANTIZATION = 8
+
+
+def blur_area(img_matte, num_erosion_iterations, blur_amount):
+    # Detect the affine transformed white area
+    mask_h_inds, mask_w_inds = np.where(img_matte==255)
+    # Calculate the size (and diagonal size) of transformed white area width and height boundaries
+    mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+    mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+    mask_size = int(np.sqrt(mask_h*mask_w))
+    # Calculate the kernel size for eroding img_matte by kernel (insightface empirical guess for best size was max(mask_size//10,10))
+    # k = max(mask_size//12, 8)
+    k = max(mask_size//(blur_amount // 2) , blur_amount // 2)
+    kernel = np.ones((k,k),np.uint8)
+    img_matte = cv2.erode(img_matte,kernel,iterations = num_erosion_iterations)
+    #Calculate the kernel size for blurring img_matte by blur_size (insightface empirical guess for best size was max(mask_size//20, 5))
+    # k = max(mask_size//24, 4)
+    k = max(mask_size//blur_amount, blur_amount//5)
+    kernel_size = (k, k)
+    blur_size = tuple(2*i+1 for i in kernel_size)
+    return cv2.GaussianBlur(img_matte, blur_size, 0)
+
+
+def get_face_matte(size: int, mask_offsets):
+    """ Returns the eroded and blurred float matte for a size x size aligned face, which only
+        needs to be warped into the frame. Results are cached, so they must not be modified.
+    """
+    return create_face_matte(int(size), tuple(mask_offsets))
+
+
+@lru_cache(maxsize=32)
+def create_face_matte(size: int, mask_offsets: tuple):
+    img_matte = np.zeros((size, size), dtype=np.uint8)
+    top = int(mask_offsets[0] * size)
+    bottom = int(size - (mask_offsets[1] * size))
+    left = int(mask_offsets[2] * size)
+    right = int(size - (mask_offsets[3] * size))
+    img_matte[top:bottom,left:right] = 255
+    # Blacken the edges by 1 pixel, so erosion also works from the sides touching the border
+    img_matte[:1,:] = img_matte[-1:,:] = img_matte[:,:1] = img_matte[:,-1:] = 0
+    img_matte = blur_area(img_matte, mask_offsets[4], mask_offsets[5])
+    img_matte = img_matte.astype(np.float32) / 255
+    img_matte.flags.writeable = False
+    return img_matte
+
+
+def create_feathered_mask(shape, feather_amount=30):
+    mask = np.zeros(shape[:2], dtype=np.float32)
+    center = (shape[1] // 2, shape[0] // 2)
+    cv2.ellipse(mask, center, (shape[1] // 2 - feather_amount, shape[0] // 2 - feather_amount),
+                0, 0, 360, 1, -1)
+    mask = cv2.GaussianBlur(mask, (feather_amount*2+1, feather_amount*2+1), 0)
+    return mask / np.max(mask)
+
+
+@lru_cache(maxsize=64)
+def create_mouth_mask(width: int, height: int):
+    feather_amount = min(30, width // 15, height // 15)
+    mask = create_feathered_mask((height, width), feather_amount)
+    mask.flags.writeable = False
+    return mask
+
+
+def get_mouth_mask(width: int, height: int):
+    """ Feathered ellipse mask for a mouth box, shared by all boxes of about the same size """
+    quantized_width = -(-width // MOUTH_MASK_QUANTIZATION) * MOUTH_MASK_QUANTIZATION
+    quantized_height = -(-height // MOUTH_MASK_QUANTIZATION) * MOUTH_MASK_QUANTIZATION
+    mask = create_mouth_mask(quantized_width, quantized_height)
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+    return mask
@@ -0,0 +1,72 @@
+import threading
+import numpy as np
+
+
+class InferenceContext():
+    """ State needed to run an onnx session from one thread: an own io binding plus
+        input and output buffers, which are allocated once and reused for every run.
+    """
+
+    def __init__(self, session, devicename: str, output_name: str = None):
+        self.session = session
+        self.devicename = devicename
+        self.output_name = output_name if output_name is not None else session.get_outputs()[0].name
+        self.io_binding = session.io_binding()
+        self.input_buffers = {}
+        self.output_buffers = {}
+
+
+    def input_buffer(self, name: str, shape, dtype=np.float32):
+        """ Returns the preallocated buffer for input 'name', preprocessing writes straight into it """
+        shape = tuple(shape)
+        buffer = self.input_buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.input_buffers[name] = buffer
+        return buffer
+
+
+    def run(self, inputs: dict = None):
+        """ Runs the session on the input buffers plus the optional extra inputs.
+            The returned array belongs to this context and is overwritten by its next run.
+        """
+        bound_inputs = dict(self.input_buffers)
+        if inputs is not None:
+            bound_inputs.update(inputs)
+        for name, value in bound_inputs.items():
+            self.io_binding.bind_cpu_input(name, value)
+
+        key = tuple((name, value.shape) for name, value in bound_inputs.items())
+        output = self.output_buffers.get(key)
+        if output is not None:
+            self.io_binding.bind_output(self.output_name, 'cpu', 0, output.dtype.type, output.shape, output.ctypes.data)
+        else:
+            self.io_binding.bind_output(self.output_name, self.devicename)
+        self.session.run_with_iobinding(self.io_binding)
+        if output is None:
+            output = self.io_binding.copy_outputs_to_cpu()[0]
+            # outputs can only be written into our own memory when running on the cpu
+            if self.devicename == 'cpu':
+                self.output_buffers[key] = output
+        return output
+
+
+
+class ThreadInferenceContexts():
+    """ Hands out one InferenceContext per calling thread, so a processor can be
+        used from several worker threads at once without sharing a binding.
+    """
+
+    def __init__(self, session, devicename: str, output_name: str = None):
+        self.session = session
+        self.devicename = devicename
+        self.output_name = output_name
+        self.local = threading.local()
+
+
+    def get(self) -> InferenceContext:
+        context = getattr(self.local, 'context', None)
+        if context is None:
+            context = InferenceContext(self.session, self.devicename, self.output_name)
+            self.local.context = context
+        return context
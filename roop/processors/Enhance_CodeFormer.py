@@ -5,10 +5,12 @@ import onnxruntime
 import roop.globals
 
 from roop.typing import Face, Frame, FaceSet
-from roop.utilities import resolve_relative_path
+from roop.utilities import resolve_model_path
+from roop.onnx_util import ThreadInferenceContexts
 
 class Enhance_CodeFormer():
     model_codeformer = None
+    contexts:ThreadInferenceContexts = None
 
     plugin_options:dict = None
 
@@ -25,29 +27,27 @@ class Enhance_CodeFormer():
         if self.model_codeformer is None:
             # replace Mac mps with cpu for the moment
             self.devicename = self.plugin_options["devicename"].replace('mps', 'cpu')
-            model_path = resolve_relative_path('../models/CodeFormer/CodeFormerv0.1.onnx')
+            model_path = resolve_model_path('CodeFormer/CodeFormerv0.1.onnx')
             self.model_codeformer = onnxruntime.InferenceSession(model_path, None, providers=roop.globals.execution_providers)
             self.model_inputs = self.model_codeformer.get_inputs()
-            model_outputs = self.model_codeformer.get_outputs()
-            self.io_binding = self.model_codeformer.io_binding()           
-            self.io_binding.bind_cpu_input(self.model_inputs[1].name, np.array([0.5]))
-            self.io_binding.bind_output(model_outputs[0].name, self.devicename)
+            self.contexts = ThreadInferenceContexts(self.model_codeformer, self.devicename)
 
 
     def Run(self, source_faceset: FaceSet, target_face: Face, temp_frame: Frame) -> Frame:
         input_size = temp_frame.shape[1]
         # preprocess
         temp_frame = cv2.resize(temp_frame, (512, 512), cv2.INTER_CUBIC)
-        temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
-        temp_frame = temp_frame.astype('float32') / 255.0
-        temp_frame = (temp_frame - 0.5) / 0.5
-        temp_frame = np.expand_dims(temp_frame, axis=0).transpose(0, 3, 1, 2)
-        
-        self.io_binding.bind_cpu_input(self.model_inputs[0].name, temp_frame.astype(np.float32))
-        self.model_codeformer.run_with_iobinding(self.io_binding)
-        ort_outs = self.io_binding.copy_outputs_to_cpu()
-        result = ort_outs[0][0]
-        del ort_outs
+        context = self.contexts.get()
+        # BGR->RGB, HWC->CHW and normalize to -1..1 right into the input buffer
+        input_frame = context.input_buffer(self.model_inputs[0].name, (1, 3, 512, 512))
+        input_frame[0] = temp_frame[:, :, ::-1].transpose(2, 0, 1)
+        input_frame /= 255.0
+        input_frame -= 0.5
+        input_frame /= 0.5
+        fidelity_weight = context.input_buffer(self.model_inputs[1].name, (1,), np.float64)
+        fidelity_weight[0] = 0.5
+
+        result = context.run()[0]
         
         # post-process
         result = result.transpose((1, 2, 0))
@@ -66,6 +66,5 @@ class Enhance_CodeFormer():
     def Release(self):
         del self.model_codeformer
         self.model_codeformer = None
-        del self.io_binding
-        self.io_binding = None
+        self.contexts = None
 
@@ -5,13 +5,15 @@ import onnxruntime
 import roop.globals
 
 from roop.typing import Face, Frame, FaceSet
-from roop.utilities import resolve_relative_path
+from roop.utilities import resolve_model_path
+from roop.onnx_util import ThreadInferenceContexts
 
 
 class Enhance_GPEN():
     plugin_options:dict = None
 
     model_gpen = None
+    contexts:ThreadInferenceContexts = None
     name = None
     devicename = None
 
@@ -26,10 +28,11 @@ class Enhance_GPEN():
 
         self.plugin_options = plugin_options
         if self.model_gpen is None:
-            model_path = resolve_relative_path('../models/GPEN-BFR-512.onnx')
+            model_path = resolve_model_path('GPEN-BFR-512.onnx')
             self.model_gpen = onnxruntime.InferenceSession(model_path, None, providers=roop.globals.execution_providers)
             # replace Mac mps with cpu for the moment
             self.devicename = self.plugin_options["devicename"].replace('mps', 'cpu')
+            self.contexts = ThreadInferenceContexts(self.model_gpen, self.devicename, "output")
 
         self.name = self.model_gpen.get_inputs()[0].name
 
@@ -38,17 +41,15 @@ class Enhance_GPEN():
         input_size = temp_frame.shape[1]
         temp_frame = cv2.resize(temp_frame, (512, 512), cv2.INTER_CUBIC)
 
-        temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
-        temp_frame = temp_frame.astype('float32') / 255.0
-        temp_frame = (temp_frame - 0.5) / 0.5
-        temp_frame = np.expand_dims(temp_frame, axis=0).transpose(0, 3, 1, 2)
+        context = self.contexts.get()
+        # BGR->RGB, HWC->CHW and normalize to -1..1 right into the input buffer
+        input_frame = context.input_buffer("input", (1, 3, 512, 512))
+        input_frame[0] = temp_frame[:, :, ::-1].transpose(2, 0, 1)
+        input_frame /= 255.0
+        input_frame -= 0.5
+        input_frame /= 0.5
 
-        io_binding = self.model_gpen.io_binding()           
-        io_binding.bind_cpu_input("input", temp_frame)
-        io_binding.bind_output("output", self.devicename)
-        self.model_gpen.run_with_iobinding(io_binding)
-        ort_outs = io_binding.copy_outputs_to_cpu()
-        result = ort_outs[0][0]
+        result = context.run()[0]
 
         # post-process
         result = np.clip(result, -1, 1)
@@ -61,3 +62,4 @@ class Enhance_GPEN():
 
     def Release(self):
         self.model_gpen = None
+        self.contexts = None
@@ -5,11 +5,13 @@ import onnxruntime
 import roop.globals
 
 from roop.typing import Face, Frame, FaceSet
-from roop.utilities import resolve_relative_path
+from roop.utilities import resolve_model_path
+from roop.onnx_util import ThreadInferenceContexts
 
 class Enhance_RestoreFormerPPlus():
     plugin_options:dict = None
     model_restoreformerpplus = None
+    contexts:ThreadInferenceContexts = None
     devicename = None
     name = None
 
@@ -26,27 +28,24 @@ class Enhance_RestoreFormerPPlus():
         if self.model_restoreformerpplus is None:
             # replace Mac mps with cpu for the moment
             self.devicename = self.plugin_options["devicename"].replace('mps', 'cpu')
-            model_path = resolve_relative_path('../models/restoreformer_plus_plus.onnx')
+            model_path = resolve_model_path('restoreformer_plus_plus.onnx')
             self.model_restoreformerpplus = onnxruntime.InferenceSession(model_path, None, providers=roop.globals.execution_providers)
             self.model_inputs = self.model_restoreformerpplus.get_inputs()
-            model_outputs = self.model_restoreformerpplus.get_outputs()
-            self.io_binding = self.model_restoreformerpplus.io_binding()
-            self.io_binding.bind_output(model_outputs[0].name, self.devicename)
+            self.contexts = ThreadInferenceContexts(self.model_restoreformerpplus, self.devicename)
 
     def Run(self, source_faceset: FaceSet, target_face: Face, temp_frame: Frame) -> Frame:
         # preprocess
         input_size = temp_frame.shape[1]
         temp_frame = cv2.resize(temp_frame, (512, 512), cv2.INTER_CUBIC)
-        temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
-        temp_frame = temp_frame.astype('float32') / 255.0
-        temp_frame = (temp_frame - 0.5) / 0.5
-        temp_frame = np.expand_dims(temp_frame, axis=0).transpose(0, 3, 1, 2)
+        context = self.contexts.get()
+        # BGR->RGB, HWC->CHW and normalize to -1..1 right into the input buffer
+        input_frame = context.input_buffer(self.model_inputs[0].name, (1, 3, 512, 512))
+        input_frame[0] = temp_frame[:, :, ::-1].transpose(2, 0, 1)
+        input_frame /= 255.0
+        input_frame -= 0.5
+        input_frame /= 0.5
         
-        self.io_binding.bind_cpu_input(self.model_inputs[0].name, temp_frame) # .astype(np.float32)
-        self.model_restoreformerpplus.run_with_iobinding(self.io_binding)
-        ort_outs = self.io_binding.copy_outputs_to_cpu()
-        result = ort_outs[0][0]
-        del ort_outs 
+        result = context.run()[0]
         
         result = np.clip(result, -1, 1)
         result = (result + 1) / 2
@@ -59,6 +58,5 @@ class Enhance_RestoreFormerPPlus():
     def Release(self):
         del self.model_restoreformerpplus
         self.model_restoreformerpplus = None
-        del self.io_binding
-        self.io_binding = None
+        self.contexts = None
 
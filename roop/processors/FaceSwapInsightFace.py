@@ -1,16 +1,108 @@
+import os
+import glob
+import hashlib
+import json
+import tempfile
 import roop.globals
 import numpy as np
 import onnx
 import onnxruntime
 
 from roop.typing import Face, Frame
-from roop.utilities import resolve_relative_path
+from roop.utilities import resolve_model_path
+from roop.onnx_util import ThreadInferenceContexts
+
+
+FINGERPRINT_CHUNK_SIZE = 1024 * 1024
+# (path, size, mtime) -> fingerprint, so a model is read only once per process
+FINGERPRINTS = {}
+
+
+def get_model_fingerprint(model_path: str) -> str:
+    """ Hash of the whole model file. It is stored in <model>.fingerprint together with the size
+        and mtime it was computed for, so other processes and later starts don't read the model again.
+    """
+    stat = os.stat(model_path)
+    key = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+    fingerprint = FINGERPRINTS.get(key)
+    if fingerprint is not None:
+        return fingerprint
+
+    record_path = f'{model_path}.fingerprint'
+    try:
+        with open(record_path, 'r') as f:
+            record = json.load(f)
+        if record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            fingerprint = record['fingerprint']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    if fingerprint is None:
+        sha = hashlib.sha256()
+        with open(model_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(FINGERPRINT_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        fingerprint = sha.hexdigest()[:16]
+        record = { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fingerprint': fingerprint }
+        try:
+            write_atomically(record_path, lambda f: f.write(json.dumps(record).encode()))
+        except OSError as e:
+            print(f'Unable to write {record_path}: {e}')
+    FINGERPRINTS[key] = fingerprint
+    return fingerprint
+
+
+def write_atomically(path: str, write):
+    """ Calls write with a temporary file of its own next to path, then moves it to path.
+        Processes writing the same file at once never see or mix their partial files.
+    """
+    directory, filename = os.path.split(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=f'{filename}.', suffix='.tmp', delete=False) as f:
+        temp_path = f.name
+        try:
+            write(f)
+        except BaseException:
+            f.close()
+            os.remove(temp_path)
+            raise
+    os.replace(temp_path, path)
+
+
+def load_emap(model_path: str):
+    """ Returns the emap matrix of an inswapper model. It is extracted once into a .npy
+        sidecar next to the model, so the onnx graph doesn't need to be parsed on every start.
+    """
+    sidecar_path = f'{model_path}.{get_model_fingerprint(model_path)}.emap.npy'
+    if os.path.isfile(sidecar_path):
+        try:
+            return np.load(sidecar_path)
+        except Exception as e:
+            print(f'Ignoring unreadable {sidecar_path}: {e}')
+
+    graph = onnx.load(model_path).graph
+    emap = onnx.numpy_helper.to_array(graph.initializer[-1])
+    del graph
+    # remove sidecars of previous versions of this model
+    for stale_path in glob.glob(glob.escape(model_path) + '.*.emap.npy'):
+        if stale_path == sidecar_path:
+            continue
+        try:
+            os.remove(stale_path)
+        except OSError:
+            pass
+    try:
+        write_atomically(sidecar_path, lambda f: np.save(f, emap))
+    except OSError as e:
+        print(f'Unable to write {sidecar_path}: {e}')
+    return emap
 
 
 
 class FaceSwapInsightFace():
     plugin_options:dict = None
     model_swap_insightface = None
+    supports_batch = False
+    contexts:ThreadInferenceContexts = None
+    latent_cache:dict = None
 
     processorname = 'faceswap'
     type = 'swap'
@@ -23,9 +115,9 @@ class FaceSwapInsightFace():
 
         self.plugin_options = plugin_options
         if self.model_swap_insightface is None:
-            model_path = resolve_relative_path('../models/' + self.plugin_options["modelname"])
-            graph = onnx.load(model_path).graph
-            self.emap = onnx.numpy_helper.to_array(graph.initializer[-1])
+            self.latent_cache = {}
+            model_path = resolve_model_path(self.plugin_options["modelname"])
+            self.emap = load_emap(model_path)
             self.devicename = self.plugin_options["devicename"].replace('mps', 'cpu')
             self.input_mean = 0.0
             self.input_std = 255.0
@@ -33,25 +125,70 @@ class FaceSwapInsightFace():
             sess_options = onnxruntime.SessionOptions()
             sess_options.enable_cpu_mem_arena = False
             self.model_swap_insightface = onnxruntime.InferenceSession(model_path, sess_options, providers=roop.globals.execution_providers)
+            batch_dim = self.model_swap_insightface.get_inputs()[0].shape[0]
+            self.supports_batch = not isinstance(batch_dim, int) or batch_dim != 1
+            self.contexts = ThreadInferenceContexts(self.model_swap_insightface, self.devicename, "output")
 
 
 
     def Run(self, source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+        latent = self.CalcLatent(source_face)
+        return self.RunBatch(latent, temp_frame)[0].copy()
+
+
+    def PrepareLatents(self, input_facesets):
+        """ Projects the source embeddings of all input facesets for the current model.
+            Entries still valid from a previous job are reused, everything else is dropped.
+        """
+        cache = {}
+        for faceset in input_facesets:
+            if len(faceset.faces) > 0:
+                face = faceset.faces[0]
+                cache[id(face)] = (face.embedding, self.CalcLatent(face))
+        self.latent_cache = cache
+
+
+    def CalcLatent(self, source_face: Face):
+        # cache entries keep a reference to the embedding they were made from,
+        # a replaced embedding (e.g. averaged faceset) invalidates them
+        cached = self.latent_cache.get(id(source_face))
+        if cached is not None and cached[0] is source_face.embedding:
+            return cached[1]
+
         latent = source_face.normed_embedding.reshape((1,-1))
         latent = np.dot(latent, self.emap)
         latent /= np.linalg.norm(latent)
-        io_binding = self.model_swap_insightface.io_binding()           
-        io_binding.bind_cpu_input("target", temp_frame)
-        io_binding.bind_cpu_input("source", latent)
-        io_binding.bind_output("output", self.devicename)
-        self.model_swap_insightface.run_with_iobinding(io_binding)
-        ort_outs = io_binding.copy_outputs_to_cpu()[0]
-        return ort_outs[0]
+        latent = np.ascontiguousarray(latent, dtype=np.float32)
+        latent.flags.writeable = False
+        self.latent_cache[id(source_face)] = (source_face.embedding, latent)
+        return latent
+
+
+    def RunBatch(self, source_latents, crops):
+        """ Swaps a whole stack of prepared NCHW crops with a single session call.
+            source_latents has one row per crop, results are returned in the same order.
+        """
+        source_latents = np.ascontiguousarray(source_latents, dtype=np.float32)
+        crops = np.ascontiguousarray(crops, dtype=np.float32)
+        if not self.supports_batch and len(crops) > 1:
+            # model has a fixed batch size of 1, run crop by crop
+            results = None
+            for i in range(len(crops)):
+                result = self.RunBatch(source_latents[i:i+1], crops[i:i+1])
+                if results is None:
+                    results = np.empty((len(crops),) + result.shape[1:], dtype=result.dtype)
+                results[i] = result[0]
+            return results
+
+        # the result is the output buffer of this thread, it is only valid until its next run
+        return self.contexts.get().run({"target": crops, "source": source_latents})
 
 
     def Release(self):
         del self.model_swap_insightface
         self.model_swap_insightface = None
+        self.contexts = None
+        self.latent_cache = {}
 
 
                 
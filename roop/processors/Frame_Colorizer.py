@@ -3,12 +3,14 @@ import numpy as np
 import onnxruntime
 import roop.globals
 
-from roop.utilities import resolve_relative_path
+from roop.utilities import resolve_model_path
+from roop.onnx_util import ThreadInferenceContexts
 from roop.typing import Frame
 
 class Frame_Colorizer():
     plugin_options:dict = None
     model_colorizer = None
+    contexts:ThreadInferenceContexts = None
     devicename = None
     prev_type = None
 
@@ -29,28 +31,23 @@ class Frame_Colorizer():
             # replace Mac mps with cpu for the moment
             self.devicename = self.plugin_options["devicename"].replace('mps', 'cpu')
             if self.prev_type == "deoldify_artistic":
-                model_path = resolve_relative_path('../models/Frame/deoldify_artistic.onnx')
+                model_path = resolve_model_path('Frame/deoldify_artistic.onnx')
             elif self.prev_type == "deoldify_stable":
-                model_path = resolve_relative_path('../models/Frame/deoldify_stable.onnx')
+                model_path = resolve_model_path('Frame/deoldify_stable.onnx')
 
             onnxruntime.set_default_logger_severity(3)
             self.model_colorizer = onnxruntime.InferenceSession(model_path, None, providers=roop.globals.execution_providers)
             self.model_inputs = self.model_colorizer.get_inputs()
-            model_outputs = self.model_colorizer.get_outputs()
-            self.io_binding = self.model_colorizer.io_binding()
-            self.io_binding.bind_output(model_outputs[0].name, self.devicename)
+            self.contexts = ThreadInferenceContexts(self.model_colorizer, self.devicename)
 
     def Run(self, input_frame: Frame) -> Frame:
         temp_frame = cv2.cvtColor(input_frame, cv2.COLOR_BGR2GRAY)
         temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_GRAY2RGB)
         temp_frame = cv2.resize(temp_frame, (256, 256))
-        temp_frame = temp_frame.transpose((2, 0, 1))
-        temp_frame = np.expand_dims(temp_frame, axis=0).astype(np.float32)
-        self.io_binding.bind_cpu_input(self.model_inputs[0].name, temp_frame)
-        self.model_colorizer.run_with_iobinding(self.io_binding)
-        ort_outs = self.io_binding.copy_outputs_to_cpu()
-        result = ort_outs[0][0]
-        del ort_outs
+        context = self.contexts.get()
+        model_input = context.input_buffer(self.model_inputs[0].name, (1, 3, 256, 256))
+        model_input[0] = temp_frame.transpose((2, 0, 1))
+        result = context.run()[0]
         colorized_frame = result.transpose(1, 2, 0)
         colorized_frame = cv2.resize(colorized_frame, (input_frame.shape[1], input_frame.shape[0]))
         temp_blue_channel, _, _ = cv2.split(input_frame)
@@ -65,6 +62,5 @@ class Frame_Colorizer():
     def Release(self):
         del self.model_colorizer
         self.model_colorizer = None
-        del self.io_binding
-        self.io_binding = None
+        self.contexts = None
 
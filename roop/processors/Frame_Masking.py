@@ -3,12 +3,14 @@ import numpy as np
 import onnxruntime
 import roop.globals
 
-from roop.utilities import resolve_relative_path
+from roop.utilities import resolve_model_path
+from roop.onnx_util import ThreadInferenceContexts
 from roop.typing import Frame
 
 class Frame_Masking():
     plugin_options:dict = None
     model_masking = None
+    contexts:ThreadInferenceContexts = None
     devicename = None
     name = None
 
@@ -26,29 +28,23 @@ class Frame_Masking():
             # replace Mac mps with cpu for the moment
             self.devicename = self.plugin_options["devicename"]
             self.devicename = self.devicename.replace('mps', 'cpu')
-            model_path = resolve_relative_path('../models/Frame/isnet-general-use.onnx')
+            model_path = resolve_model_path('Frame/isnet-general-use.onnx')
             self.model_masking = onnxruntime.InferenceSession(model_path, None, providers=roop.globals.execution_providers)
             self.model_inputs = self.model_masking.get_inputs()
-            model_outputs = self.model_masking.get_outputs()
-            self.io_binding = self.model_masking.io_binding()
-            self.io_binding.bind_output(model_outputs[0].name, self.devicename)
+            self.contexts = ThreadInferenceContexts(self.model_masking, self.devicename)
 
     def Run(self, temp_frame: Frame) -> Frame:
         # Pre process:Resize, BGR->RGB, float32 cast
         input_image = cv2.resize(temp_frame, (1024, 1024))
         input_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2RGB)
-        mean = [0.5, 0.5, 0.5]
-        std = [1.0, 1.0, 1.0]
-        input_image = (input_image / 255.0 - mean) / std
-        input_image = input_image.transpose(2, 0, 1)
-        input_image = np.expand_dims(input_image, axis=0)
-        input_image = input_image.astype('float32')
-        
-        self.io_binding.bind_cpu_input(self.model_inputs[0].name, input_image)
-        self.model_masking.run_with_iobinding(self.io_binding)
-        ort_outs = self.io_binding.copy_outputs_to_cpu()
-        result = ort_outs[0][0]
-        del ort_outs
+        # mean 0.5, std 1.0
+        context = self.contexts.get()
+        input_frame = context.input_buffer(self.model_inputs[0].name, (1, 3, 1024, 1024))
+        input_frame[0] = input_image.transpose(2, 0, 1)
+        input_frame /= 255.0
+        input_frame -= 0.5
+
+        result = context.run()[0]
         # Post process:squeeze, Sigmoid, Normarize, uint8 cast
         mask = np.squeeze(result[0])
         min_value = np.min(mask)
@@ -66,6 +62,5 @@ class Frame_Masking():
     def Release(self):
         del self.model_masking
         self.model_masking = None
-        del self.io_binding
-        self.io_binding = None
+        self.contexts = None
 
@@ -3,13 +3,15 @@ import numpy as np
 import onnxruntime
 import roop.globals
 
-from roop.utilities import resolve_relative_path, conditional_thread_semaphore
+from roop.utilities import resolve_model_path, conditional_thread_semaphore
+from roop.onnx_util import ThreadInferenceContexts
 from roop.typing import Frame
 
 
 class Frame_Upscale():
     plugin_options:dict = None
     model_upscale = None
+    contexts:ThreadInferenceContexts = None
     devicename = None
     prev_type = None
 
@@ -30,30 +32,27 @@ class Frame_Upscale():
             # replace Mac mps with cpu for the moment
             self.devicename = self.plugin_options["devicename"].replace('mps', 'cpu')
             if self.prev_type == "esrganx4":
-                model_path = resolve_relative_path('../models/Frame/real_esrgan_x4.onnx')
+                model_path = resolve_model_path('Frame/real_esrgan_x4.onnx')
                 self.scale = 4
             elif self.prev_type == "esrganx2":
-                model_path = resolve_relative_path('../models/Frame/real_esrgan_x2.onnx')
+                model_path = resolve_model_path('Frame/real_esrgan_x2.onnx')
                 self.scale = 2
             elif self.prev_type == "lsdirx4":
-                model_path = resolve_relative_path('../models/Frame/lsdir_x4.onnx')
+                model_path = resolve_model_path('Frame/lsdir_x4.onnx')
                 self.scale = 4
             onnxruntime.set_default_logger_severity(3)
             self.model_upscale = onnxruntime.InferenceSession(model_path, None, providers=roop.globals.execution_providers)
             self.model_inputs = self.model_upscale.get_inputs()
-            model_outputs = self.model_upscale.get_outputs()
-            self.io_binding = self.model_upscale.io_binding()
-            self.io_binding.bind_output(model_outputs[0].name, self.devicename)
+            self.contexts = ThreadInferenceContexts(self.model_upscale, self.devicename)
 
     def getProcessedResolution(self, width, height):
         return (width * self.scale, height * self.scale)
 
 # borrowed from facefusion -> https://github.com/facefusion/facefusion
-    def prepare_tile_frame(self, tile_frame : Frame) -> Frame:
-        tile_frame = np.expand_dims(tile_frame[:, :, ::-1], axis = 0)
-        tile_frame = tile_frame.transpose(0, 3, 1, 2)
-        tile_frame = tile_frame.astype(np.float32) / 255
-        return tile_frame
+    def prepare_tile_frame(self, tile_frame : Frame, input_frame : Frame) -> Frame:
+        input_frame[0] = tile_frame[:, :, ::-1].transpose(2, 0, 1)
+        input_frame /= 255
+        return input_frame
 
 
     def normalize_tile_frame(self, tile_frame : Frame) -> Frame:
@@ -105,13 +104,12 @@ class Frame_Upscale():
         temp_height, temp_width = temp_frame.shape[:2]
         upscale_tile_frames, pad_width, pad_height = self.create_tile_frames(temp_frame, size)
 
+        context = self.contexts.get()
         for index, tile_frame in enumerate(upscale_tile_frames):
-            tile_frame = self.prepare_tile_frame(tile_frame)
+            input_frame = context.input_buffer(self.model_inputs[0].name, (1, 3) + tile_frame.shape[:2])
+            self.prepare_tile_frame(tile_frame, input_frame)
             with conditional_thread_semaphore():
-                self.io_binding.bind_cpu_input(self.model_inputs[0].name, tile_frame)
-                self.model_upscale.run_with_iobinding(self.io_binding)
-                ort_outs = self.io_binding.copy_outputs_to_cpu()
-                result = ort_outs[0]
+                result = context.run()
             upscale_tile_frames[index] = self.normalize_tile_frame(result)
         final_frame = self.merge_tile_frames(upscale_tile_frames, temp_width * self.scale
                                                     , temp_height * self.scale
@@ -124,6 +122,5 @@ class Frame_Upscale():
     def Release(self):
         del self.model_upscale
         self.model_upscale = None
-        del self.io_binding
-        self.io_binding = None
+        self.contexts = None
 
@@ -4,7 +4,8 @@ import onnxruntime
 import roop.globals
 
 from roop.typing import Frame
-from roop.utilities import resolve_relative_path, conditional_thread_semaphore
+from roop.utilities import resolve_model_path, conditional_thread_semaphore
+from roop.onnx_util import ThreadInferenceContexts
 
 
 
@@ -12,6 +13,7 @@ class Mask_XSeg():
     plugin_options:dict = None
 
     model_xseg = None
+    contexts:ThreadInferenceContexts = None
 
     processorname = 'mask_xseg'
     type = 'mask'
@@ -24,7 +26,7 @@ class Mask_XSeg():
 
         self.plugin_options = plugin_options
         if self.model_xseg is None:
-            model_path = resolve_relative_path('../models/xseg.onnx')
+            model_path = resolve_model_path('xseg.onnx')
             onnxruntime.set_default_logger_severity(3)
             self.model_xseg = onnxruntime.InferenceSession(model_path, None, providers=roop.globals.execution_providers)
             self.model_inputs = self.model_xseg.get_inputs()
@@ -32,18 +34,16 @@ class Mask_XSeg():
 
             # replace Mac mps with cpu for the moment
             self.devicename = self.plugin_options["devicename"].replace('mps', 'cpu')
+            self.contexts = ThreadInferenceContexts(self.model_xseg, self.devicename, self.model_outputs[0].name)
 
 
     def Run(self, img1, keywords:str) -> Frame:
         temp_frame = cv2.resize(img1, (256, 256), cv2.INTER_CUBIC)
-        temp_frame = temp_frame.astype('float32') / 255.0
-        temp_frame = temp_frame[None, ...]
-        io_binding = self.model_xseg.io_binding()           
-        io_binding.bind_cpu_input(self.model_inputs[0].name, temp_frame)
-        io_binding.bind_output(self.model_outputs[0].name, self.devicename)
-        self.model_xseg.run_with_iobinding(io_binding)
-        ort_outs = io_binding.copy_outputs_to_cpu()
-        result = ort_outs[0][0]
+        context = self.contexts.get()
+        input_frame = context.input_buffer(self.model_inputs[0].name, (1,) + temp_frame.shape)
+        input_frame[0] = temp_frame
+        input_frame /= 255.0
+        result = context.run()[0]
         result = np.clip(result, 0, 1.0)
         result[result < 0.1] = 0
         # invert values to mask areas to keep
@@ -54,5 +54,6 @@ class Mask_XSeg():
     def Release(self):
         del self.model_xseg
         self.model_xseg = None
+        self.contexts = None
 
 
@@ -0,0 +1,70 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import roop.globals
+
+# (name, start, end, pid, tid, args) of the spans recorded in this process
+events = []
+# pid, tid -> (process name, thread name)
+thread_names = {}
+
+
+def start_tracing():
+    """ Starts recording spans, can be called at any time. Worker processes started
+        while tracing is on record as well and hand their spans in when they stop.
+    """
+    events.clear()
+    thread_names.clear()
+    roop.globals.tracing = True
+
+
+def stop_tracing(filename: str = None):
+    """ Stops recording and writes the spans as Trace Event JSON, which chrome://tracing
+        or ui.perfetto.dev can open
+    """
+    roop.globals.tracing = False
+    if filename is not None:
+        save_trace(filename)
+
+
+def add_span(name: str, start: float, end: float = None, args: dict = None):
+    """ Records a span of the calling thread from perf_counter() start to end (default now) """
+    if not roop.globals.tracing:
+        return
+    if end is None:
+        end = time.perf_counter()
+    pid = os.getpid()
+    tid = threading.get_ident()
+    if (pid, tid) not in thread_names:
+        thread_names[(pid, tid)] = (multiprocessing.current_process().name, threading.current_thread().name)
+    events.append((name, start, end, pid, tid, args))
+
+
+def get_trace() -> tuple:
+    return events, thread_names
+
+
+def merge_trace(trace: tuple):
+    """ Adds the spans of another process """
+    other_events, other_thread_names = trace
+    events.extend(other_events)
+    thread_names.update(other_thread_names)
+
+
+def save_trace(filename: str):
+    trace_events = []
+    for (pid, tid), (process_name, thread_name) in thread_names.items():
+        trace_events.append({ 'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': { 'name': process_name } })
+        trace_events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': { 'name': thread_name } })
+    # perf_counter is a system wide monotonic clock, so spans of all processes line up
+    for name, start, end, pid, tid, args in events:
+        event = { 'name': name, 'ph': 'X', 'ts': start * 1000000.0, 'dur': (end - start) * 1000000.0, 'pid': pid, 'tid': tid }
+        if args is not None:
+            event['args'] = args
+        trace_events.append(event)
+    with open(filename, 'w') as f:
+        json.dump({ 'traceEvents': trace_events, 'displayTimeUnit': 'ms' }, f)
+    print(f'Trace with {len(events)} spans written to {filename}')
@@ -30,28 +30,71 @@ def cut_video(original_video: str, cut_video: str, start_frame: int, end_frame:
     else:
         run_ffmpeg(['-ss',  format(start_time, ".2f"), '-i', original_video,  '-frames:v', str(num_frames), '-c:v' ,'copy','-c:a' ,'copy', cut_video])
 
-def join_videos(videos: List[str], dest_filename: str, simple: bool):
+def join_videos(videos: List[str], dest_filename: str, simple: bool, audio_source: str = None, audio_start: float = None, audio_end: float = None):
+    """ Concatenates videos. simple: stream copy with the concat demuxer, all parts need the same codec
+        and parameters, e.g. segments of one render. Otherwise they are decoded and encoded again.
+        The audio of a part of audio_source can be added in the same pass, otherwise the parts keep
+        their audio. When re-encoding, all parts need an audio stream then.
+    """
+    commands = []
     if simple:
-        txtfilename = util.resolve_relative_path('../temp')
-        txtfilename = os.path.join(txtfilename, 'joinvids.txt')
+        txtfilename = os.path.join(os.path.dirname(os.path.abspath(videos[0])), 'joinvids.txt')
         with open(txtfilename, "w", encoding="utf-8") as f:
             for v in videos:
-                 v = v.replace('\\', '/')
-                 f.write(f"file {v}\n")
-        commands = ['-f', 'concat', '-safe', '0', '-i', f'{txtfilename}', '-vcodec', 'copy', f'{dest_filename}']
-        run_ffmpeg(commands)
-
+                v = os.path.abspath(v).replace('\\', '/').replace("'", "'\\''")
+                f.write(f"file '{v}'\n")
+        commands.extend(['-f', 'concat', '-safe', '0', '-i', txtfilename])
     else:
-        inputs = []
         filter = ''
         for i,v in enumerate(videos):
-            inputs.append('-i')
-            inputs.append(v)
-            filter += f'[{i}:v:0][{i}:a:0]'
-        run_ffmpeg([" ".join(inputs), '-filter_complex', f'"{filter}concat=n={len(videos)}:v=1:a=1[outv][outa]"', '-map', '"[outv]"', '-map', '"[outa]"', dest_filename])    
+            commands.extend(['-i', v])
+            filter += f'[{i}:v:0]' if audio_source is not None else f'[{i}:v:0][{i}:a:0]'
+        if audio_source is not None:
+            commands.extend(['-filter_complex', f'{filter}concat=n={len(videos)}:v=1:a=0[outv]'])
+        else:
+            commands.extend(['-filter_complex', f'{filter}concat=n={len(videos)}:v=1:a=1[outv][outa]'])
+
+    num_inputs = 1 if simple else len(videos)
+    if audio_source is not None:
+        if audio_start is not None:
+            commands.extend(['-ss', format(audio_start, ".2f")])
+        if audio_end is not None:
+            commands.extend(['-to', format(audio_end, ".2f")])
+        commands.extend(['-i', audio_source])
+    commands.extend(['-map', '0:v:0' if simple else '[outv]'])
+    if audio_source is not None:
+        commands.extend(['-map', f'{num_inputs}:a:0?', '-c:a', 'copy', '-shortest'])
+    elif simple:
+        commands.extend(['-map', '0:a?', '-c:a', 'copy'])
+    else:
+        commands.extend(['-map', '[outa]'])
+    if simple:
+        commands.extend(['-c:v', 'copy'])
+    else:
+        commands.extend(['-c:v', roop.globals.video_encoder, '-crf', str(roop.globals.video_quality), '-pix_fmt', 'yuv420p'])
+    commands.extend(['-movflags', 'faststart', dest_filename])
+    result = run_ffmpeg(commands)
+    if simple:
+        os.remove(txtfilename)
+    return result
+
 
-        #     filter += f'[{i}:v:0][{i}:a:0]'
-        # run_ffmpeg([" ".join(inputs), '-filter_complex', f'"{filter}concat=n={len(videos)}:v=1:a=1[outv][outa]"', '-map', '"[outv]"', '-map', '"[outa]"', dest_filename])    
+def get_keyframes(video: str) -> List[float]:
+    """ Timestamps of the keyframes of the first video stream, read from the packets without decoding.
+        Empty if ffprobe isn't available or fails.
+    """
+    commands = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0', video]
+    try:
+        output = subprocess.check_output(commands, stderr=subprocess.DEVNULL).decode()
+    except Exception:
+        print("Running ffprobe failed, keyframes unknown")
+        return []
+    keyframes = []
+    for line in output.splitlines():
+        values = line.split(',')
+        if len(values) >= 2 and 'K' in values[1] and values[0] not in ('', 'N/A'):
+            keyframes.append(float(values[0]))
+    return sorted(keyframes)
 
 
 
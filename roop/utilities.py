@@ -224,6 +224,13 @@ def resolve_relative_path(path: str) -> str:
     return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
 
 
+def resolve_model_path(path: str) -> str:
+    """ Path of a file in models/ or in roop.globals.models_path if that is set """
+    if roop.globals.models_path is not None:
+        return os.path.abspath(os.path.join(roop.globals.models_path, path))
+    return resolve_relative_path(os.path.join('../models', path))
+
+
 def get_device() -> str:
     if len(roop.globals.execution_providers) < 1:
         roop.globals.execution_providers = ["CPUExecutionProvider"]
@@ -38,6 +38,33 @@ class Settings:
         self.use_os_temp_folder = self.default_get(data, 'use_os_temp_folder', False)
         self.output_show_video = self.default_get(data, 'output_show_video', True)
         self.launch_browser = self.default_get(data, 'launch_browser', True)
+        # max. number of processed frames waiting to be written in order, 0 = 4 per thread
+        self.reorder_buffer_depth = self.default_get(data, 'reorder_buffer_depth', 0)
+        # 'threads' or 'processes', the latter runs every video worker in an own process
+        self.worker_mode = self.default_get(data, 'worker_mode', 'threads')
+        # run the full face detection only every n-th video frame and track the faces in between, 1 = every frame
+        self.face_detection_interval = self.default_get(data, 'face_detection_interval', 1)
+        # keep recognition and genderage results of a face across frames, only new faces get recognized
+        self.track_face_identities = self.default_get(data, 'track_face_identities', False)
+        # in 'selected' mode match every target face with at most one face of a frame and vice versa,
+        # otherwise a face is swapped with every target face it resembles
+        self.unique_face_matching = self.default_get(data, 'unique_face_matching', False)
+        # number of video frames a worker analyses at once, with one detector and one run per analysis model
+        self.detection_batch_size = self.default_get(data, 'detection_batch_size', 1)
+        # insightface model pack in models/ for face analysis, e.g. buffalo_l, buffalo_s, buffalo_sc or an own folder with a detector/recognizer pair.
+        # The swap models were trained with buffalo_l embeddings, so face sets should keep its recognizer (w600k_r50)
+        self.face_analysis_pack = self.default_get(data, 'face_analysis_pack', 'buffalo_l')
+        # find faces on the scaled down frame first and refine every hit on a full resolution crop
+        self.cascade_detection = self.default_get(data, 'cascade_detection', False)
+        # 'opencv' or 'ffmpeg' for decoding videos, ffmpeg seeks faster and decodes with all cores
+        self.video_reader = self.default_get(data, 'video_reader', 'opencv')
+        # > 1 renders videos as this many segments in parallel processes and joins them without re-encoding,
+        # every process loads its own models
+        self.render_segments = self.default_get(data, 'render_segments', 1)
+        # writes p50/p95/p99 timings of every processing stage as <output>_timings.json next to processed videos
+        self.timing_report = self.default_get(data, 'timing_report', False)
+        # writes a trace of all frames and stages as <output>_trace.json, open it in chrome://tracing or ui.perfetto.dev
+        self.trace_processing = self.default_get(data, 'trace_processing', False)
 
 
 
@@ -60,7 +87,19 @@ class Settings:
             'force_cpu' : self.force_cpu,
 			'output_template' : self.output_template,
             'use_os_temp_folder' : self.use_os_temp_folder,
-            'output_show_video' : self.output_show_video
+            'output_show_video' : self.output_show_video,
+            'reorder_buffer_depth' : self.reorder_buffer_depth,
+            'worker_mode' : self.worker_mode,
+            'face_detection_interval' : self.face_detection_interval,
+            'track_face_identities' : self.track_face_identities,
+            'unique_face_matching' : self.unique_face_matching,
+            'detection_batch_size' : self.detection_batch_size,
+            'face_analysis_pack' : self.face_analysis_pack,
+            'cascade_detection' : self.cascade_detection,
+            'video_reader' : self.video_reader,
+            'render_segments' : self.render_segments,
+            'timing_report' : self.timing_report,
+            'trace_processing' : self.trace_processing
         }
         with open(self.config_file, 'w') as f:
             yaml.dump(data, f)
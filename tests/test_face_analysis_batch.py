@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import roop.globals
+from roop import face_util
+from roop.benchmark import stubs
+from settings import Settings
+
+
+@pytest.fixture(scope='module')
+def stub_pack(tmp_path_factory):
+    # insightface looks for <root>/models/<pack>
+    models_dir = tmp_path_factory.mktemp('stubs') / 'models'
+    stubs.write_stub_models(str(models_dir))
+    saved = { name: getattr(roop.globals, name) for name in ('CFG', 'models_path', 'execution_providers', 'g_desired_face_analysis', 'cascade_detection') }
+    roop.globals.CFG = Settings(str(models_dir / 'config.yaml'))
+    roop.globals.CFG.face_analysis_pack = stubs.STUB_PACK
+    roop.globals.models_path = str(models_dir)
+    roop.globals.execution_providers = ['CPUExecutionProvider']
+    roop.globals.g_desired_face_analysis = None
+    roop.globals.cascade_detection = False
+    yield
+    face_util.FACE_ANALYSER = None
+    face_util.FACE_ANALYSER_PACK = None
+    for name, value in saved.items():
+        setattr(roop.globals, name, value)
+
+
+def make_frames(num_frames, num_faces, width=640, height=360):
+    rng = np.random.default_rng(0)
+    frames = []
+    for index in range(num_frames):
+        frame = stubs.make_background(rng, width, height)
+        for i in range(num_faces):
+            stubs.draw_face(frame, (i + 0.5) * width / num_faces + 3 * index, height / 2 - 2 * index, 90 + 10 * i)
+        frames.append(frame)
+    return frames
+
+
+def analyse_batch(monkeypatch, frames):
+    # the batch has to succeed without falling back to single frames
+    with monkeypatch.context() as m:
+        m.setattr(face_util, 'get_all_faces', None)
+        return face_util.get_all_faces_batch(frames)
+
+
+@pytest.mark.parametrize('num_faces', [0, 1, 3])
+def test_batch_matches_single_frames(stub_pack, monkeypatch, num_faces):
+    frames = make_frames(4, num_faces)
+    batch_faces = analyse_batch(monkeypatch, frames)
+    assert len(batch_faces) == len(frames)
+    for frame, faces in zip(frames, batch_faces):
+        single_faces = face_util.get_all_faces(frame)
+        assert len(faces) == len(single_faces) == num_faces
+        for batch_face, single_face in zip(faces, single_faces):
+            np.testing.assert_allclose(batch_face.bbox, single_face.bbox, atol=1e-3)
+            np.testing.assert_allclose(batch_face.kps, single_face.kps, atol=1e-3)
+            np.testing.assert_allclose(batch_face.embedding, single_face.embedding, rtol=1e-4, atol=1e-4)
+            np.testing.assert_allclose(batch_face.landmark_2d_106, single_face.landmark_2d_106, atol=1e-2)
+            assert (batch_face.sex, batch_face.age) == (single_face.sex, single_face.age)
+
+
+def test_frames_of_different_sizes(stub_pack, monkeypatch):
+    frames = make_frames(1, 2) + make_frames(1, 1, 320, 480)
+    batch_faces = analyse_batch(monkeypatch, frames)
+    assert [len(faces) for faces in batch_faces] == [2, 1]
+    for frame, faces in zip(frames, batch_faces):
+        for batch_face, single_face in zip(faces, face_util.get_all_faces(frame)):
+            np.testing.assert_allclose(batch_face.bbox, single_face.bbox, atol=1e-3)
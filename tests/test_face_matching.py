@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+import roop.globals
+from insightface.app.common import Face
+from roop.ProcessMgr import ProcessMgr
+from roop.ProcessOptions import ProcessOptions
+from settings import Settings
+
+
+def make_embedding(seed):
+    return np.random.default_rng(seed).standard_normal(512).astype(np.float32)
+
+
+def make_face(embedding, x):
+    face = Face(bbox=np.array([x, 0, x + 10, 10], dtype=np.float32), kps=np.zeros((5, 2), dtype=np.float32), det_score=1.0)
+    face.embedding = embedding
+    return face
+
+
+def make_process_mgr(target_embeddings, num_inputs=None, threshold=0.65):
+    process_mgr = ProcessMgr()
+    target_faces = [make_face(embedding, 0) for embedding in target_embeddings]
+    process_mgr.target_face_datas = target_faces
+    process_mgr.input_face_datas = [object()] * (len(target_faces) if num_inputs is None else num_inputs)
+    process_mgr.target_embeddings = np.stack(target_embeddings)
+    process_mgr.target_embeddings /= np.linalg.norm(process_mgr.target_embeddings, axis=1, keepdims=True)
+    process_mgr.options = ProcessOptions('InSwapper 128', {}, threshold, 1.0, 'selected', 0, None, None, 1, 128, False, False)
+    process_mgr.jobs = []
+    process_mgr.process_faces = lambda jobs, frame, temp_frame: process_mgr.jobs.extend(jobs) or temp_frame
+    return process_mgr
+
+
+def swap(process_mgr, faces):
+    frame = np.zeros((16, 16, 3), dtype=np.uint8)
+    num_faces, _ = process_mgr.swap_faces(frame, frame.copy(), faces=list(faces))
+    return num_faces, { id(face): index for index, face in process_mgr.jobs }
+
+
+@pytest.fixture(autouse=True)
+def matching_globals(tmp_path, monkeypatch):
+    monkeypatch.setattr(roop.globals, 'vr_mode', False)
+    monkeypatch.setattr(roop.globals, 'CFG', Settings(str(tmp_path / 'config.yaml')))
+    roop.globals.CFG.unique_face_matching = True
+
+
+def test_pairs_do_not_depend_on_detection_order():
+    alice, bob = make_embedding(1), make_embedding(2)
+    # the first face resembles both targets, but is closer to bob
+    mixed = alice + 2 * bob
+    faces = [make_face(mixed, 0), make_face(alice, 20), make_face(bob + 0.1 * make_embedding(3), 40)]
+    for order in ([0, 1, 2], [2, 1, 0], [1, 2, 0]):
+        process_mgr = make_process_mgr([alice, bob], threshold=0.9)
+        num_faces, jobs = swap(process_mgr, [faces[i] for i in order])
+        assert num_faces == 2
+        assert jobs == { id(faces[1]): 0, id(faces[2]): 1 }
+
+
+def test_every_target_gets_at_most_one_face():
+    alice = make_embedding(1)
+    faces = [make_face(alice + 0.2 * make_embedding(seed), 10 * seed) for seed in range(3)]
+    num_faces, jobs = swap(make_process_mgr([alice]), faces)
+    assert num_faces == 1
+    # the closest one
+    distances = [1.0 - np.dot(f.embedding, alice) / np.linalg.norm(f.embedding) / np.linalg.norm(alice) for f in faces]
+    assert list(jobs) == [id(faces[int(np.argmin(distances))])]
+
+
+def test_faces_over_the_threshold_are_not_swapped():
+    num_faces, jobs = swap(make_process_mgr([make_embedding(1)]), [make_face(make_embedding(2), 0)])
+    assert num_faces == 0
+    assert jobs == {}
+
+
+def test_targets_without_input_face_are_skipped():
+    alice, bob = make_embedding(1), make_embedding(2)
+    num_faces, jobs = swap(make_process_mgr([alice, bob], num_inputs=1), [make_face(bob, 0), make_face(alice, 20)])
+    assert num_faces == 1
+    assert list(jobs.values()) == [0]
+
+
+def test_vr_mode_keeps_both_eyes():
+    roop.globals.vr_mode = True
+    alice = make_embedding(1)
+    num_faces, jobs = swap(make_process_mgr([alice]), [make_face(alice, 0), make_face(alice, 20)])
+    assert num_faces == 2
+    assert len(jobs) == 2
+
+
+def test_no_faces():
+    num_faces, jobs = swap(make_process_mgr([make_embedding(1)]), [])
+    assert num_faces == 0
+
+
+def test_targets_without_input_face_do_not_take_faces():
+    alice, bob = make_embedding(1), make_embedding(2)
+    # closer to bob, who has no input face, but still within the threshold of alice
+    face = make_face(alice + 2 * bob, 0)
+    num_faces, jobs = swap(make_process_mgr([alice, bob], num_inputs=1, threshold=0.9), [face])
+    assert num_faces == 1
+    assert jobs == { id(face): 0 }
+
+
+def test_many_to_many_without_unique_matching():
+    roop.globals.CFG.unique_face_matching = False
+    alice, bob = make_embedding(1), make_embedding(2)
+    faces = [make_face(alice, 0), make_face(alice + 0.2 * make_embedding(3), 20), make_face(bob, 40)]
+    process_mgr = make_process_mgr([alice, bob])
+    num_faces, jobs = swap(process_mgr, faces)
+    assert num_faces == 3
+    assert sorted((index, [id(f) for f in faces].index(id(face))) for index, face in process_mgr.jobs) == [(0, 0), (0, 1), (1, 2)]
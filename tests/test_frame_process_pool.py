@@ -0,0 +1,104 @@
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+import roop.globals
+from roop.FrameProcessPool import FrameProcessPool
+from roop.ProcessMgr import ProcessMgr
+from roop.ProcessOptions import ProcessOptions
+from roop.StageTimer import StageTimer
+from roop.processors.Frame_Filter import Frame_Filter
+from settings import Settings
+
+FRAME_SHAPE = (48, 64, 3)
+NUM_FRAMES = 24
+
+
+class FailingFilterOptions(dict):
+    """ Options of the generic filter which make its fail_at-th frame in a worker raise """
+
+    def __init__(self, fail_at, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_at = fail_at
+        self.calls = 0
+
+
+    def __getitem__(self, key):
+        if key == 'subtype':
+            self.calls += 1
+            if self.calls == self.fail_at:
+                raise ValueError('broken frame')
+        return super().__getitem__(key)
+
+
+
+class FrameList():
+    def __init__(self, frames):
+        self.frames = list(frames)
+
+
+    def read(self):
+        if len(self.frames) == 0:
+            return False, None
+        return True, self.frames.pop(0)
+
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, FRAME_SHAPE, dtype=np.uint8) for _ in range(NUM_FRAMES)]
+
+
+@pytest.fixture(autouse=True)
+def pool_globals(tmp_path, monkeypatch):
+    monkeypatch.setattr(roop.globals, 'CFG', Settings(str(tmp_path / 'config.yaml')))
+    monkeypatch.setattr(roop.globals, 'execution_providers', ['CPUExecutionProvider'])
+    monkeypatch.setattr(roop.globals, 'processing', True)
+
+
+def run_pool(frames, fail_at, num_workers=1):
+    process_mgr = ProcessMgr()
+    process_mgr.input_face_datas = []
+    process_mgr.target_face_datas = []
+    process_mgr.options = ProcessOptions(None, { 'filter_generic': FailingFilterOptions(fail_at, subtype='C64') },
+                                         0.65, 1.0, 'all', 0, None, None, 1, 128, False, False)
+    process_mgr.timer = StageTimer(False)
+    written = []
+    result = {}
+
+    def run():
+        try:
+            FrameProcessPool(process_mgr, num_workers).run(FrameList(frames), 0, len(frames), FRAME_SHAPE, FRAME_SHAPE, lambda frame: written.append(frame.copy()), lambda: None)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(120)
+    assert not thread.is_alive(), 'FrameProcessPool.run hangs'
+    return written, result.get('error')
+
+
+def expected_frame(frame):
+    return cv2.resize(Frame_Filter().RenderC64Screen(frame), (FRAME_SHAPE[1], FRAME_SHAPE[0]))
+
+
+def test_all_frames_are_written_in_order(frames):
+    written, error = run_pool(frames, fail_at=None, num_workers=2)
+    assert error is None
+    assert len(written) == NUM_FRAMES
+    for frame, result in zip(frames, written):
+        np.testing.assert_array_equal(result, expected_frame(frame))
+
+
+def test_an_exception_in_a_worker_aborts_the_job(frames):
+    # the last frame, the number of frames is known by then
+    written, error = run_pool(frames, fail_at=NUM_FRAMES)
+    assert isinstance(error, RuntimeError)
+    assert 'broken frame' in str(error)
+    assert len(written) < NUM_FRAMES
+    for frame, result in zip(frames, written):
+        np.testing.assert_array_equal(result, expected_frame(frame))
@@ -0,0 +1,81 @@
+import threading
+
+from roop.FrameReorderBuffer import FrameReorderBuffer
+
+
+def run_in_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_frames_come_out_in_order():
+    buffer = FrameReorderBuffer(8)
+    for frame_index in [2, 0, 3, 1]:
+        buffer.put(frame_index, f'frame {frame_index}')
+    buffer.finish(4)
+    assert [buffer.get() for _ in range(4)] == [(i, f'frame {i}') for i in range(4)]
+    assert buffer.get() is None
+
+
+def test_skipped_frames_are_handed_out_as_none():
+    buffer = FrameReorderBuffer(4)
+    buffer.put(1, 'frame 1')
+    buffer.put(0, None)
+    buffer.finish(2)
+    assert buffer.get() == (0, None)
+    assert buffer.get() == (1, 'frame 1')
+    assert buffer.get() is None
+
+
+def test_finish_ends_get_at_the_frame_count():
+    buffer = FrameReorderBuffer(4)
+    buffer.finish(0)
+    assert buffer.get() is None
+
+
+def test_get_waits_for_the_next_frame():
+    buffer = FrameReorderBuffer(4)
+    results = []
+    reader = run_in_thread(lambda: results.append(buffer.get()))
+    buffer.put(1, 'frame 1')
+    reader.join(0.2)
+    assert reader.is_alive()
+    buffer.put(0, 'frame 0')
+    reader.join(5)
+    assert results == [(0, 'frame 0')]
+
+
+def test_put_waits_while_too_far_ahead():
+    buffer = FrameReorderBuffer(2)
+    writer = run_in_thread(buffer.put, 2, 'frame 2')
+    writer.join(0.2)
+    assert writer.is_alive()
+    buffer.put(0, 'frame 0')
+    assert buffer.get() == (0, 'frame 0')
+    writer.join(5)
+    assert not writer.is_alive()
+    assert len(buffer) == 1
+
+
+def test_abort_releases_a_waiting_get():
+    buffer = FrameReorderBuffer(4)
+    buffer.put(1, 'frame 1')
+    results = []
+    reader = run_in_thread(lambda: results.append(buffer.get()))
+    reader.join(0.2)
+    buffer.abort()
+    reader.join(5)
+    assert not reader.is_alive()
+    assert results == [None]
+
+
+def test_abort_releases_a_waiting_put():
+    buffer = FrameReorderBuffer(1)
+    writer = run_in_thread(buffer.put, 5, 'frame 5')
+    writer.join(0.2)
+    assert writer.is_alive()
+    buffer.abort()
+    writer.join(5)
+    assert not writer.is_alive()
+    assert buffer.get() is None
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+
+import roop.processors.FaceSwapInsightFace as swapper
+from roop.processors.FaceSwapInsightFace import FINGERPRINT_CHUNK_SIZE, get_model_fingerprint, write_atomically
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(swapper, 'FINGERPRINTS', {})
+
+
+def write(path, data, mtime):
+    path.write_bytes(data)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_changes_in_the_middle_change_the_fingerprint(tmp_path):
+    data = bytearray(os.urandom(3 * FINGERPRINT_CHUNK_SIZE))
+    model = tmp_path / 'model.onnx'
+    write(model, bytes(data), 1_000_000_000)
+    before = get_model_fingerprint(str(model))
+    data[len(data) // 2] ^= 0xff
+    write(model, bytes(data), 2_000_000_000)
+    assert get_model_fingerprint(str(model)) != before
+
+
+def test_same_content_same_fingerprint(tmp_path):
+    data = os.urandom(FINGERPRINT_CHUNK_SIZE + 123)
+    write(tmp_path / 'a.onnx', data, 1_000_000_000)
+    write(tmp_path / 'b.onnx', data, 3_000_000_000)
+    assert get_model_fingerprint(str(tmp_path / 'a.onnx')) == get_model_fingerprint(str(tmp_path / 'b.onnx'))
+
+
+def test_fingerprint_is_stored_next_to_the_model(tmp_path, monkeypatch):
+    model = tmp_path / 'model.onnx'
+    write(model, os.urandom(1000), 1_000_000_000)
+    fingerprint = get_model_fingerprint(str(model))
+    assert (tmp_path / 'model.onnx.fingerprint').is_file()
+
+    # another process: the stored fingerprint is used as long as size and mtime match
+    monkeypatch.setattr(swapper, 'FINGERPRINTS', {})
+    write(model, os.urandom(1000), 1_000_000_000)
+    assert get_model_fingerprint(str(model)) == fingerprint
+
+    monkeypatch.setattr(swapper, 'FINGERPRINTS', {})
+    os.utime(model, ns=(2_000_000_000, 2_000_000_000))
+    assert get_model_fingerprint(str(model)) != fingerprint
+
+
+def test_unreadable_record_is_replaced(tmp_path):
+    model = tmp_path / 'model.onnx'
+    write(model, os.urandom(1000), 1_000_000_000)
+    (tmp_path / 'model.onnx.fingerprint').write_text('{ broken')
+    fingerprint = get_model_fingerprint(str(model))
+    assert fingerprint in (tmp_path / 'model.onnx.fingerprint').read_text()
+
+
+def test_write_atomically_leaves_no_temporary_files(tmp_path):
+    target = tmp_path / 'emap.npy'
+    write_atomically(str(target), lambda f: np.save(f, np.arange(4)))
+    np.testing.assert_array_equal(np.load(target), np.arange(4))
+
+    def fail(f):
+        f.write(b'partial')
+        raise OSError('disk full')
+
+    with pytest.raises(OSError):
+        write_atomically(str(target), fail)
+    np.testing.assert_array_equal(np.load(target), np.arange(4))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['emap.npy']
@@ -0,0 +1,36 @@
+import cv2
+import numpy as np
+
+from roop.ProcessMgr import ProcessMgr
+
+
+def inverse_transform(scale, x, y, angle=0.0):
+    # aligned face -> frame, like the inverted affine matrix of a face crop
+    M = cv2.getRotationMatrix2D((0, 0), angle, scale)
+    M[:, 2] += (x, y)
+    return M
+
+
+def test_region_around_a_face_inside_the_frame():
+    region = ProcessMgr().get_paste_region(inverse_transform(2.0, 100, 50), (128, 128), (720, 1280))
+    assert region == (99, 49, 358, 308)
+
+
+def test_region_covers_a_rotated_face():
+    IM = inverse_transform(1.0, 300, 300, 45)
+    start_x, start_y, end_x, end_y = ProcessMgr().get_paste_region(IM, (128, 128), (720, 1280))
+    # every pixel the warp can touch lies inside
+    warped = cv2.warpAffine(np.full((128, 128), 255, dtype=np.uint8), IM, (1280, 720))
+    ys, xs = np.nonzero(warped)
+    assert start_x <= xs.min() and xs.max() < end_x
+    assert start_y <= ys.min() and ys.max() < end_y
+
+
+def test_region_is_clipped_to_the_frame():
+    assert ProcessMgr().get_paste_region(inverse_transform(2.0, -100, -60), (128, 128), (720, 1280)) == (0, 0, 158, 198)
+    assert ProcessMgr().get_paste_region(inverse_transform(2.0, 1200, 650), (128, 128), (720, 1280)) == (1199, 649, 1280, 720)
+
+
+def test_face_outside_the_frame_has_no_region():
+    assert ProcessMgr().get_paste_region(inverse_transform(1.0, 2000, 100), (128, 128), (720, 1280)) is None
+    assert ProcessMgr().get_paste_region(inverse_transform(1.0, -500, -500), (128, 128), (720, 1280)) is None
@@ -0,0 +1,41 @@
+from roop.SegmentRenderer import MIN_SEGMENT_FRAMES, split_segments
+
+
+def assert_covers(segments, frame_start, frame_end):
+    assert segments[0][0] == frame_start
+    assert segments[-1][1] == frame_end
+    for (_, end), (start, _) in zip(segments, segments[1:]):
+        assert end == start
+
+
+def test_even_split_without_keyframes():
+    segments = split_segments([], 0, 400, 4)
+    assert segments == [(0, 100), (100, 200), (200, 300), (300, 400)]
+
+
+def test_boundaries_snap_to_the_nearest_keyframe():
+    keyframes = list(range(0, 400, 30))
+    segments = split_segments(keyframes, 0, 400, 4)
+    assert_covers(segments, 0, 400)
+    assert [start for start, _ in segments[1:]] == [90, 210, 300]
+
+
+def test_short_ranges_get_fewer_segments():
+    assert split_segments([], 10, 10 + MIN_SEGMENT_FRAMES - 1, 4) == [(10, 10 + MIN_SEGMENT_FRAMES - 1)]
+    assert len(split_segments([], 0, 3 * MIN_SEGMENT_FRAMES, 8)) == 3
+
+
+def test_segments_are_not_shorter_than_the_minimum():
+    # only keyframes close to the start and end
+    keyframes = [0, 10, 290, 299]
+    segments = split_segments(keyframes, 0, 300, 3)
+    assert segments == [(0, 300)]
+    keyframes = [0, 60, 70, 240]
+    segments = split_segments(keyframes, 0, 300, 3)
+    assert_covers(segments, 0, 300)
+    assert all(end - start >= MIN_SEGMENT_FRAMES for start, end in segments)
+
+
+def test_offset_range():
+    segments = split_segments([], 1000, 1200, 2)
+    assert segments == [(1000, 1100), (1100, 1200)]
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import roop.globals
+import roop.util_ffmpeg as ffmpeg
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    calls = []
+
+    def run_ffmpeg(args):
+        calls.append(list(args))
+        if '-f' in args and args[args.index('-f') + 1] == 'concat':
+            # the concat list exists while ffmpeg runs
+            with open(args[args.index('-i') + 1], encoding='utf-8') as f:
+                calls.append(f.read())
+        return True
+
+    monkeypatch.setattr(ffmpeg, 'run_ffmpeg', run_ffmpeg)
+    monkeypatch.setattr(roop.globals, 'video_encoder', 'libx264')
+    monkeypatch.setattr(roop.globals, 'video_quality', 14)
+    return calls
+
+
+def test_simple_join_copies_video_and_audio(tmp_path, commands):
+    videos = [str(tmp_path / 'segment_000.mp4'), str(tmp_path / "it's.mp4")]
+    assert ffmpeg.join_videos(videos, 'out.mp4', True)
+    args, concat_list = commands
+    listfile = str(tmp_path / 'joinvids.txt')
+    assert args == ['-f', 'concat', '-safe', '0', '-i', listfile, '-map', '0:v:0', '-map', '0:a?', '-c:a', 'copy',
+                    '-c:v', 'copy', '-movflags', 'faststart', 'out.mp4']
+    assert concat_list == f"file '{videos[0]}'\nfile '{tmp_path}/it'\\''s.mp4'\n"
+    assert not os.path.exists(listfile)
+
+
+def test_simple_join_with_audio_source(tmp_path, commands):
+    videos = [str(tmp_path / 'segment_000.mp4'), str(tmp_path / 'segment_001.mp4')]
+    ffmpeg.join_videos(videos, 'out.mp4', True, 'source.mp4', 1.5, 9.25)
+    args = commands[0]
+    assert args[6:] == ['-ss', '1.50', '-to', '9.25', '-i', 'source.mp4', '-map', '0:v:0', '-map', '1:a:0?', '-c:a', 'copy', '-shortest',
+                        '-c:v', 'copy', '-movflags', 'faststart', 'out.mp4']
+
+
+def test_reencoding_join_keeps_the_audio_of_the_parts(commands):
+    ffmpeg.join_videos(['a.mp4', 'b.mp4'], 'out.mp4', False)
+    assert commands[0] == ['-i', 'a.mp4', '-i', 'b.mp4', '-filter_complex', '[0:v:0][0:a:0][1:v:0][1:a:0]concat=n=2:v=1:a=1[outv][outa]',
+                           '-map', '[outv]', '-map', '[outa]', '-c:v', 'libx264', '-crf', '14', '-pix_fmt', 'yuv420p',
+                           '-movflags', 'faststart', 'out.mp4']
+
+
+def test_reencoding_join_with_audio_source(commands):
+    ffmpeg.join_videos(['a.mp4', 'b.mp4', 'c.mp4'], 'out.mp4', False, 'source.mp4')
+    assert commands[0] == ['-i', 'a.mp4', '-i', 'b.mp4', '-i', 'c.mp4', '-filter_complex', '[0:v:0][1:v:0][2:v:0]concat=n=3:v=1:a=0[outv]',
+                           '-i', 'source.mp4', '-map', '[outv]', '-map', '3:a:0?', '-c:a', 'copy', '-shortest',
+                           '-c:v', 'libx264', '-crf', '14', '-pix_fmt', 'yuv420p', '-movflags', 'faststart', 'out.mp4']